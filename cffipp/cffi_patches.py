@@ -1,18 +1,291 @@
+import collections
+import concurrent.futures
+import copyreg
+import hashlib
+import io
+import os
+import pickle
+import re
+import tempfile
+
 import cffi
 import cffi.api
 import cffi.cparser
 import pycparser
 import pycparser.c_ast
 
+from . import index
+from . import prune
+
+try:
+	from pycparser.c_parser import Coord
+except ImportError:
+	# pycparser < 3
+	from pycparser.plyparser import Coord
+
 __all__ = [
+	"AST_CACHE_SIZE",
+	"PARALLEL_PARSE_MIN_SIZE",
 	"BetterParser",
 	"FFIWithBetterParser",
 ]
 
+# Increment this whenever the format of AST cache files changes.
+AST_CACHE_VERSION = 1
+# Maximum total length of the source code whose ASTs are kept in memory (shared by all BetterParser instances). The size of an AST is roughly proportional to the length of its source.
+AST_CACHE_SIZE = 64*1024
+# Minimum length of source code that is parsed in parallel if BetterParser.parse_workers is set. Shorter source is parsed faster than it can be sent to the worker processes and back.
+PARALLEL_PARSE_MIN_SIZE = 256*1024
+
+# Maps cache keys to tuples (length of the source, result of _parse pickled with _dump_ast). The results are stored pickled, so that every hit gets new AST nodes: cffi maps the nodes of structs and unions to their types, and reusing them would hide duplicate declarations.
+_ast_cache = collections.OrderedDict()
+_ast_cache_size = 0
+_identifier_pat = re.compile(r"[A-Za-z_]\w*")
+
+# Type names that cffi always defines, they are used for "..." in declarations.
+_dotdotdot_type_names = frozenset(("__dotdotdotint__", "__dotdotdotfloat__", "__dotdotdot__"))
+
+class _IncrementalCParser(pycparser.CParser):
+	"""A pycparser.CParser that knows the typedef names that were declared by earlier cdef calls.
+	
+	cffi's parser declares all known typedef names again before every parse (by prepending "typedef int X;" for each of them to the source), which makes every cdef call slower than the last. This parser looks them up in the declarations of the cffi parser instead, as if they were declared in a scope outside of the file scope.
+	"""
+	
+	def __init__(self, cffi_parser=None):
+		super().__init__()
+		self._cffi_parser = cffi_parser
+		# Type names that are known in addition to the typedefs declared in the cffi parser (if any), such as the common type names that are used in the source being parsed (see cffi.cparser._common_type_names).
+		self.extra_type_names = set()
+	
+	def _is_known_type(self, name):
+		return (
+			name in _dotdotdot_type_names
+			or name in self.extra_type_names
+			or (self._cffi_parser is not None and "typedef " + name in self._cffi_parser._declarations)
+		)
+	
+	def _is_type_in_scope(self, name):
+		for scope in reversed(self._scope_stack):
+			if name in scope:
+				return scope[name]
+		return self._is_known_type(name)
+	
+	def _add_identifier(self, name, coord):
+		# The known typedef names behave as if they were declared in the file scope.
+		if len(self._scope_stack) == 1 and name not in self._scope_stack[-1] and self._is_known_type(name):
+			self._parse_error("Non-typedef {!r} previously declared as typedef in this scope".format(name), coord)
+		super()._add_identifier(name, coord)
+
+def _reduce_node(node):
+	return (type(node), tuple(getattr(node, name) for name in type(node).__slots__ if name != "__weakref__"))
+
+def _reduce_coord(coord):
+	return (type(coord), (coord.file, coord.line, coord.column))
+
+class _ASTPickler(pickle.Pickler):
+	"""Pickler that stores pycparser AST nodes as their constructor arguments, which is much more compact than the default format for objects with __slots__."""
+	
+	dispatch_table = copyreg.dispatch_table.copy()
+
+for _cls in vars(pycparser.c_ast).values():
+	if isinstance(_cls, type) and issubclass(_cls, pycparser.c_ast.Node) and _cls is not pycparser.c_ast.Node:
+		_ASTPickler.dispatch_table[_cls] = _reduce_node
+del _cls
+_ASTPickler.dispatch_table[Coord] = _reduce_coord
+
+def _dump_ast(obj):
+	"""Pickle an AST (or an object containing ASTs) with _ASTPickler and return the bytes."""
+	
+	f = io.BytesIO()
+	_ASTPickler(f, pickle.HIGHEST_PROTOCOL).dump(obj)
+	return f.getvalue()
+
+# The parser of a parallel parsing worker process.
+_worker_c_parser = None
+
+def _parse_group(line, csource, type_names):
+	"""Parse a group of top-level declarations in a worker process.
+	
+	line is the line number at which the group starts in the complete source, and type_names the typedef names that are known at that point. Returns the AST (pickled with _ASTPickler) and the names of the typedefs that the group declares.
+	"""
+	
+	global _worker_c_parser
+	
+	if _worker_c_parser is None:
+		_worker_c_parser = _IncrementalCParser()
+	
+	_worker_c_parser.extra_type_names = type_names
+	try:
+		ast = _worker_c_parser.parse('# {} "{}"\n{}\n'.format(line, cffi.cparser.CDEF_SOURCE_STRING, csource))
+	finally:
+		_worker_c_parser.extra_type_names = set()
+	
+	typedef_names = {decl.name for decl in ast.ext if isinstance(decl, pycparser.c_ast.Typedef)}
+	return _dump_ast(ast), typedef_names
+
 class BetterParser(cffi.cparser.Parser):
+	"""cffi's Parser with support for more constant expressions, faster parsing of many small cdefs (see _IncrementalCParser) and a cache of parsed source code.
+	
+	Parsed chunks are cached in memory, keyed by the source text and the typedef names it uses (which affect how it is parsed). If ast_cache_dir is set, they are also stored in that directory, so that later runs can skip pycparser for source that was parsed before.
+	
+	If parse_workers is greater than 1 and there is more than one CPU, source of at least PARALLEL_PARSE_MIN_SIZE characters is split into groups of top-level declarations, which are parsed in a pool of up to that many processes (but no more than there are CPUs). The pool only exists while the source is parsed. The resulting declarations are processed in source order as usual.
+	"""
+	
 	def __init__(self, ffi):
 		super().__init__()
 		self._ffi = ffi
+		self._c_parser = None
+		self.ast_cache_dir = None
+		self.parse_workers = 1
+	
+	def _ast_cache_key(self, csource):
+		typedef_names = sorted(name for name in set(_identifier_pat.findall(csource)) if "typedef " + name in self._declarations)
+		state = (
+			AST_CACHE_VERSION,
+			cffi.__version__,
+			pycparser.__version__,
+			csource,
+			typedef_names,
+		)
+		return hashlib.sha256(repr(state).encode("utf-8")).hexdigest()
+	
+	def _ast_cache_load(self, key):
+		"""Return the result stored under the given key in ast_cache_dir and its pickled form as a tuple (result, data), or None if there is no valid entry."""
+		
+		try:
+			with open(os.path.join(self.ast_cache_dir, key + ".pickle"), "rb") as f:
+				data = f.read()
+			return pickle.loads(data), data
+		except (OSError, EOFError, pickle.UnpicklingError):
+			return None
+	
+	def _ast_cache_store(self, key, data):
+		os.makedirs(self.ast_cache_dir, exist_ok=True)
+		fd, tmpname = tempfile.mkstemp(dir=self.ast_cache_dir, suffix=".tmp")
+		try:
+			with os.fdopen(fd, "wb") as tmp:
+				tmp.write(data)
+			os.replace(tmpname, os.path.join(self.ast_cache_dir, key + ".pickle"))
+		except BaseException:
+			os.unlink(tmpname)
+			raise
+	
+	def _parse(self, csource):
+		global _ast_cache_size
+		
+		key = self._ast_cache_key(csource)
+		entry = _ast_cache.get(key)
+		if entry is not None:
+			_ast_cache.move_to_end(key)
+			return pickle.loads(entry[1])
+		
+		loaded = None
+		if self.ast_cache_dir is not None:
+			loaded = self._ast_cache_load(key)
+		
+		if loaded is not None:
+			result, data = loaded
+		else:
+			result = self._parse_uncached(csource)
+			if self.ast_cache_dir is None and len(csource) > AST_CACHE_SIZE:
+				# Not cached at all, so there is no need to pickle it.
+				return result
+			data = _dump_ast(result)
+			if self.ast_cache_dir is not None:
+				self._ast_cache_store(key, data)
+		
+		if len(csource) <= AST_CACHE_SIZE:
+			_ast_cache[key] = (len(csource), data)
+			_ast_cache_size += len(csource)
+			while _ast_cache_size > AST_CACHE_SIZE:
+				_, (size, _) = _ast_cache.popitem(last=False)
+				_ast_cache_size -= size
+		
+		return result
+	
+	def _parse_uncached(self, csource):
+		csource, macros = cffi.cparser._preprocess(csource)
+		
+		common_type_names = cffi.cparser._common_type_names(csource)
+		common_type_names = {name for name in common_type_names if "typedef " + name not in self._declarations}
+		
+		ast = None
+		workers = min(self.parse_workers, os.cpu_count() or 1)
+		if workers > 1 and len(csource) >= PARALLEL_PARSE_MIN_SIZE:
+			ast = self._parse_parallel(csource, common_type_names, workers)
+		
+		if ast is None:
+			if self._c_parser is None:
+				self._c_parser = _IncrementalCParser(self)
+			
+			# Force pycparser to consider the source as the file called <cdef source string>, so that cffi can find the location of errors.
+			fullcsource = '# 1 "{}"\n{}\n'.format(cffi.cparser.CDEF_SOURCE_STRING, csource)
+			self._c_parser.extra_type_names = common_type_names
+			try:
+				ast = self._c_parser.parse(fullcsource)
+			except pycparser.c_parser.ParseError as e:
+				self.convert_pycparser_error(e, csource)
+			finally:
+				self._c_parser.extra_type_names = set()
+		
+		return ast, macros, csource
+	
+	def _parse_parallel(self, csource, common_type_names, workers):
+		"""Parse preprocessed source in parallel in the given number of processes (see parse_workers) and return the combined AST.
+		
+		Each group is parsed with the typedef names that are declared before it. These are determined by scanning the source (see cffipp.index.scan_header) and checked against the typedefs that were actually parsed. Returns None if the source can't be parsed this way, for example because of a syntax error or a typedef that the scan missed. The caller then parses it normally, which also reports any errors.
+		"""
+		
+		parts = prune.split_declarations(csource)
+		group_size = len(csource) // (workers * 4) + 1
+		groups = []
+		start = 0
+		size = 0
+		for i, part in enumerate(parts, 1):
+			size += len(part)
+			if size >= group_size or i == len(parts):
+				groups.append(parts[start:i])
+				start = i
+				size = 0
+		
+		# Each task is (line, source, known typedef names), and expected contains the typedef names that each group should declare.
+		tasks = []
+		expected = []
+		declared = set()
+		line = 1
+		for group in groups:
+			text = "".join(group)
+			type_names = {
+				name for name in set(_identifier_pat.findall(text))
+				if name in declared or name in common_type_names or "typedef " + name in self._declarations
+			}
+			tasks.append((line, text, type_names))
+			
+			typedef_names = set()
+			for part in group:
+				if "typedef" in part:
+					typedef_names.update(index.scan_header(part)["typedef"])
+			expected.append(typedef_names)
+			declared.update(typedef_names)
+			line += text.count("\n")
+		
+		try:
+			with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+				futures = [executor.submit(_parse_group, *task) for task in tasks]
+				results = [future.result() for future in futures]
+		except pycparser.c_parser.ParseError:
+			return None
+		except (OSError, ImportError, NotImplementedError, concurrent.futures.BrokenExecutor):
+			# Processes are not available (for example on iOS), or the pool was broken by a crashed worker.
+			return None
+		
+		ext = []
+		for (data, typedef_names), expected_names in zip(results, expected):
+			if typedef_names != expected_names:
+				return None
+			ext.extend(pickle.loads(data).ext)
+		
+		return pycparser.c_ast.FileAST(ext)
 	
 	def _declare(self, name, obj, included=False, quals=0):
 		if name in self._declarations:
@@ -20,7 +293,7 @@ class BetterParser(cffi.cparser.Parser):
 			if prevobj == obj and prevquals == quals:
 				return
 			if not self._options.get('override'):
-				raise cffi.api.FFIError(
+				raise cffi.FFIError(
 					"multiple declarations of %s (for interactive usage, "
 					"try cdef(xx, override=True))" % (name,))
 		assert '__dotdotdot__' not in name.split()
@@ -28,6 +301,12 @@ class BetterParser(cffi.cparser.Parser):
 		if included:
 			self._included_declarations.add(obj)
 	
+	def _add_constants(self, key, val):
+		# Like _declare, allow changing the value of a constant with override=True.
+		if key in self._int_constants and self._int_constants[key] != val and not self._options.get('override'):
+			raise cffi.FFIError("multiple declarations of constant: %s" % (key,))
+		self._int_constants[key] = val
+	
 	def _get_type_and_quals(self, typenode, *args, **kwargs):
 		if isinstance(typenode, pycparser.c_ast.Typename):
 			return self._get_type_and_quals(typenode.type, *args, **kwargs)
@@ -96,13 +375,8 @@ class BetterParser(cffi.cparser.Parser):
 		ast, macros, csource = self._parse(csource)
 		# add the macros
 		self._process_macros(macros)
-		# find the first "__dotdotdot__" and use that as a separator
-		# between the repeated typedefs and the real csource
+		# There are no repeated typedefs before the real csource, see _IncrementalCParser.
 		iterator = iter(ast.ext)
-		for decl in iterator:
-			if decl.name == '__dotdotdot__':
-				break
-		#
 		try:
 			self._inside_extern_python = '__cffi_extern_python_stop'
 			for decl in iterator:
@@ -128,7 +402,7 @@ class BetterParser(cffi.cparser.Parser):
 					self._declare('typedef ' + decl.name, realtype, quals=quals)
 				else:
 					raise cffi.api.CDefError("unrecognized construct", decl)
-		except cffi.api.FFIError as e:
+		except cffi.FFIError as e:
 			msg = self._convert_pycparser_error(e, csource)
 			if msg:
 				e.args = (e.args[0] + "\n    *** Err: %s" % msg,)
@@ -0,0 +1,328 @@
+"""Evaluation of C constant expressions, as used in #if and #elif directives.
+
+Expressions are parsed with a small Pratt parser and evaluated with the semantics of C's intmax_t and uintmax_t (64-bit two's complement). Identifiers that remain after macro expansion evaluate to 0. The operands of &&, || and ?: that are not evaluated are still parsed, but errors such as division by zero are ignored in them.
+"""
+
+import functools
+import re
+
+__all__ = [
+	"ExpressionError",
+	"evaluate",
+]
+
+_BITS = 64
+_MASK = (1 << _BITS) - 1
+_SIGN = 1 << (_BITS - 1)
+
+_integer_pat = re.compile(r"(0[xX][0-9a-fA-F]+|\d+)([uUlL]*)\Z")
+_char_escapes = {
+	"a": 7,
+	"b": 8,
+	"f": 12,
+	"n": 10,
+	"r": 13,
+	"t": 9,
+	"v": 11,
+	"e": 27,
+}
+
+# Binding powers of the binary operators. ? binds the whole conditional expression.
+_binary_bp = {
+	",": 1,
+	"?": 3,
+	"||": 4,
+	"&&": 5,
+	"|": 6,
+	"^": 7,
+	"&": 8,
+	"==": 9,
+	"!=": 9,
+	"<": 10,
+	">": 10,
+	"<=": 10,
+	">=": 10,
+	"<<": 11,
+	">>": 11,
+	"+": 12,
+	"-": 12,
+	"*": 13,
+	"/": 13,
+	"%": 13,
+}
+_unary_bp = 14
+
+# Operators that consist of two single-character tokens.
+_two_char_ops = frozenset(("||", "&&", "==", "!=", "<=", ">=", "<<", ">>"))
+
+class ExpressionError(Exception):
+	pass
+
+def _wrap(value, unsigned):
+	"""Reduce value to the range of uintmax_t or intmax_t."""
+	
+	value &= _MASK
+	if not unsigned and value & _SIGN:
+		value -= 1 << _BITS
+	return value
+
+def _parse_integer(text):
+	match = _integer_pat.match(text)
+	if match is None:
+		raise ExpressionError("Invalid integer constant {}".format(text))
+	
+	digits, suffix = match.groups()
+	if digits[:2] in ("0x", "0X"):
+		value = int(digits[2:], 16)
+	elif len(digits) > 1 and digits[0] == "0":
+		try:
+			value = int(digits, 8)
+		except ValueError:
+			raise ExpressionError("Invalid digit in octal constant {}".format(text))
+	else:
+		value = int(digits)
+	
+	unsigned = "u" in suffix or "U" in suffix
+	if value > _MASK:
+		raise ExpressionError("Integer constant {} is too large".format(text))
+	elif value >= _SIGN:
+		# Too large for intmax_t, so it is unsigned.
+		unsigned = True
+	
+	return value, unsigned
+
+def _parse_char(text):
+	wide = text[0] == "L"
+	body = text[2:-1] if wide else text[1:-1]
+	
+	chars = []
+	i = 0
+	while i < len(body):
+		c = body[i]
+		i += 1
+		if c != "\\":
+			chars.append(ord(c))
+			continue
+		
+		if i >= len(body):
+			raise ExpressionError("Invalid character constant {}".format(text))
+		c = body[i]
+		i += 1
+		if c == "x":
+			j = i
+			while j < len(body) and body[j] in "0123456789abcdefABCDEF":
+				j += 1
+			if j == i:
+				raise ExpressionError("Invalid character constant {}".format(text))
+			chars.append(int(body[i:j], 16))
+			i = j
+		elif c in "01234567":
+			j = i
+			while j < len(body) and j < i + 2 and body[j] in "01234567":
+				j += 1
+			chars.append(int(body[i-1:j], 8))
+			i = j
+		else:
+			chars.append(_char_escapes.get(c, ord(c)))
+	
+	if not chars:
+		raise ExpressionError("Empty character constant {}".format(text))
+	
+	if wide:
+		# wchar_t is a signed 32-bit type.
+		value = chars[-1] & 0xffffffff
+		if value & 0x80000000:
+			value -= 1 << 32
+	elif len(chars) == 1:
+		# char is signed.
+		value = chars[0] & 0xff
+		if value & 0x80:
+			value -= 1 << 8
+	else:
+		# Multi-character constants have type int, with the first character in the most significant position.
+		value = 0
+		for c in chars:
+			value = ((value << 8) | (c & 0xff)) & 0xffffffff
+		if value & 0x80000000:
+			value -= 1 << 32
+	
+	return value, False
+
+class _Parser(object):
+	def __init__(self, tokens):
+		self.tokens = tokens
+		self.pos = 0
+	
+	def peek(self):
+		return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+	
+	def next(self):
+		tok = self.peek()
+		if tok is None:
+			raise ExpressionError("Unexpected end of expression")
+		self.pos += 1
+		return tok
+	
+	def expect(self, value):
+		tok = self.peek()
+		if tok != value:
+			raise ExpressionError("Expected {!r}, found {}".format(value, "end of expression" if tok is None else repr(tok)))
+		self.pos += 1
+	
+	def parse(self):
+		result = self.expression(0, True)
+		tok = self.peek()
+		if tok is not None:
+			raise ExpressionError("Missing binary operator before {!r}".format(tok))
+		return result
+	
+	def expression(self, rbp, live):
+		"""Parse an expression whose operators bind more tightly than rbp. If live is false, the expression is not actually evaluated."""
+		
+		left = self.prefix(live)
+		while True:
+			op = self.peek()
+			bp = _binary_bp.get(op)
+			if bp is None or bp <= rbp:
+				return left
+			self.pos += 1
+			
+			if op == "?":
+				cond = left[0] != 0
+				then = self.expression(0, live and cond)
+				self.expect(":")
+				# Right associative.
+				other = self.expression(bp - 1, live and not cond)
+				unsigned = then[1] or other[1]
+				value = then[0] if cond else other[0]
+				left = (_wrap(value, unsigned), unsigned)
+			elif op == "&&":
+				right = self.expression(bp, live and left[0] != 0)
+				left = (int(left[0] != 0 and right[0] != 0), False)
+			elif op == "||":
+				right = self.expression(bp, live and left[0] == 0)
+				left = (int(left[0] != 0 or right[0] != 0), False)
+			else:
+				right = self.expression(bp, live)
+				left = self.binary(op, left, right, live)
+	
+	def prefix(self, live):
+		tok = self.next()
+		c = tok[0]
+		
+		if c.isdigit():
+			return _parse_integer(tok)
+		elif c == "'" or (c == "L" and tok[1:2] == "'"):
+			return _parse_char(tok)
+		elif c.isalpha() or c == "_":
+			# Identifiers that are not macros are 0.
+			return (0, False)
+		elif tok == "(":
+			result = self.expression(0, live)
+			self.expect(")")
+			return result
+		elif tok in ("+", "-", "~", "!"):
+			value, unsigned = self.expression(_unary_bp, live)
+			if tok == "+":
+				return (value, unsigned)
+			elif tok == "-":
+				return (_wrap(-value, unsigned), unsigned)
+			elif tok == "~":
+				return (_wrap(~value, unsigned), unsigned)
+			else:
+				return (int(value == 0), False)
+		elif c == '"':
+			raise ExpressionError("String literal {} in expression".format(tok))
+		else:
+			raise ExpressionError("Unexpected {!r} in expression".format(tok))
+	
+	def binary(self, op, left, right, live):
+		lvalue, lunsigned = left
+		rvalue, runsigned = right
+		
+		if op in ("<<", ">>"):
+			# The result has the type of the left operand. Negative shifts go the other way.
+			if not runsigned and rvalue < 0:
+				op = "<<" if op == ">>" else ">>"
+				rvalue = -rvalue
+			if lunsigned:
+				lvalue &= _MASK
+			if op == "<<":
+				value = lvalue << rvalue if rvalue < _BITS else 0
+			else:
+				value = lvalue >> min(rvalue, _BITS)
+			return (_wrap(value, lunsigned), lunsigned)
+		elif op == ",":
+			return right
+		
+		# The usual arithmetic conversions.
+		unsigned = lunsigned or runsigned
+		if unsigned:
+			lvalue &= _MASK
+			rvalue &= _MASK
+		
+		if op == "+":
+			value = lvalue + rvalue
+		elif op == "-":
+			value = lvalue - rvalue
+		elif op == "*":
+			value = lvalue * rvalue
+		elif op in ("/", "%"):
+			if rvalue == 0:
+				if live:
+					raise ExpressionError("Division by zero")
+				return (0, unsigned)
+			# C division truncates towards zero.
+			quotient = abs(lvalue) // abs(rvalue)
+			if (lvalue < 0) != (rvalue < 0):
+				quotient = -quotient
+			value = quotient if op == "/" else lvalue - rvalue * quotient
+		elif op == "&":
+			value = lvalue & rvalue
+		elif op == "^":
+			value = lvalue ^ rvalue
+		elif op == "|":
+			value = lvalue | rvalue
+		elif op == "==":
+			return (int(lvalue == rvalue), False)
+		elif op == "!=":
+			return (int(lvalue != rvalue), False)
+		elif op == "<":
+			return (int(lvalue < rvalue), False)
+		elif op == ">":
+			return (int(lvalue > rvalue), False)
+		elif op == "<=":
+			return (int(lvalue <= rvalue), False)
+		else:
+			return (int(lvalue >= rvalue), False)
+		
+		return (_wrap(value, unsigned), unsigned)
+
+@functools.lru_cache(maxsize=4096)
+def evaluate(tokens):
+	"""Evaluate a constant expression and return its value as an int.
+	
+	tokens is a tuple of the texts of the expression's tokens after macro expansion, with whitespace tokens given as " ". Because the tokens determine the value completely, results are cached, so that expressions that are evaluated again (for example the same #if in a header that is included several times) are not parsed again.
+	
+	Raises ExpressionError if the expression is invalid.
+	"""
+	
+	# Join operators that the lexer splits into single characters, unless they are separated by whitespace.
+	parts = []
+	adjacent = False
+	for tok in tokens:
+		if tok == " ":
+			adjacent = False
+			continue
+		
+		if adjacent and parts[-1] + tok in _two_char_ops:
+			parts[-1] += tok
+			adjacent = False
+		else:
+			parts.append(tok)
+			adjacent = True
+	
+	if not parts:
+		raise ExpressionError("Empty expression")
+	
+	return _Parser(parts).parse()[0]
@@ -0,0 +1,469 @@
+"""An index of the symbols declared in the headers on an include path.
+
+The index is built by scanning the headers lexically, without preprocessing them, so it is fast but not exact: declarations in conditional blocks are recorded regardless of the condition, and unusual declarations may be missed. It is meant to find the headers that need to be included to declare a symbol, which are then preprocessed normally.
+"""
+
+import os
+import pickle
+import re
+import tempfile
+
+__all__ = [
+	"INDEX_VERSION",
+	"KINDS",
+	"SymbolIndex",
+	"scan_header",
+]
+
+# Increment this whenever the format of saved indexes or the scanner's results change.
+INDEX_VERSION = 2
+
+# The kinds of symbols that are recorded. "constant" is an enum constant, "variable" a global variable.
+KINDS = ("macro", "function", "typedef", "struct", "union", "enum", "constant", "variable")
+
+_continuation_pat = re.compile(r"\\\r?\n")
+# The tokens that the scanner needs: comments, string and character literals, identifiers, numbers, newlines and single punctuation characters. Other whitespace is skipped.
+_token_pat = re.compile(r"""/\*.*?\*/|//[^\n]*|"(?:\\.|[^"\\\n])*"|'(?:\\.|[^'\\\n])*'|[A-Za-z_]\w*|\d\w*|\n|[^\s\w]""", re.DOTALL)
+_aggregate_keywords = frozenset(("struct", "union", "enum"))
+# Keywords and qualifiers that are never the name of a declaration.
+_keywords = frozenset((
+	"auto", "char", "const", "double", "enum", "extern", "float", "inline", "int", "long", "register", "restrict",
+	"short", "signed", "static", "struct", "typedef", "union", "unsigned", "void", "volatile", "_Bool", "_Complex",
+))
+
+# Keywords that may come before or in the type of a declaration, but are not a type themselves.
+_storage_keywords = frozenset(("auto", "const", "extern", "inline", "register", "restrict", "static", "typedef", "volatile"))
+
+# Attributes and similar extensions that may appear in declarations.
+_attributes = frozenset(("asm", "__asm", "__asm__", "__attribute", "__attribute__", "__declspec", "_Pragma", "__typeof__"))
+
+def _is_attribute(name):
+	"""Return whether name is a known attribute or similar extension (such as __attribute__) rather than the name of a declaration."""
+	
+	return name in _attributes
+
+def _looks_like_macro(name):
+	"""Guess whether name is an annotation macro (such as API_AVAILABLE) from its spelling. Constants, types and functions are often spelled like this too, so this is only used to choose between the names that are followed by an argument list (see _function_name)."""
+	
+	return name.isupper() and "_" in name
+
+def _top_level_calls(tokens):
+	"""Return the positions of the identifiers in a list of token values that are followed by an argument list and are not in parentheses themselves, other than keywords and attributes."""
+	
+	calls = []
+	depth = 0
+	for i, value in enumerate(tokens[:-1]):
+		if value == "(":
+			depth += 1
+		elif value == ")":
+			depth -= 1
+		elif depth == 0 and tokens[i+1] == "(" and _is_identifier(value) and value not in _keywords and not _is_attribute(value):
+			calls.append(i)
+	return calls
+
+def _is_type_name(tokens, i):
+	"""Guess whether the identifier at position i of a declaration is (part of) its type, as opposed to the name that it declares or an annotation macro without arguments."""
+	
+	value = tokens[i]
+	if value in _storage_keywords or _is_attribute(value):
+		return False
+	elif value in _keywords:
+		return True
+	
+	# An identifier is the type unless it follows the type, in which case it is the declared name. Qualifiers and annotations without arguments (such as CF_EXPORT) are skipped.
+	j = i - 1
+	while j >= 0 and (tokens[j] in _storage_keywords or _looks_like_macro(tokens[j])):
+		j -= 1
+	if j < 0 or tokens[j] in _aggregate_keywords:
+		return True
+	return not (tokens[j] == "*" or (_is_identifier(tokens[j]) and _is_type_name(tokens, j)))
+
+def _function_name(tokens):
+	"""Return the name of the function declared by a statement (a list of token values), or None if it doesn't declare a function.
+	
+	Annotation macros with arguments, such as API_AVAILABLE(macos(10.0)), look like function declarators too. They are told apart by their spelling, and if the function name is spelled the same way, by their position: an annotation comes at the start of the declaration or after the declarator, a function name after the return type.
+	"""
+	
+	calls = _top_level_calls(tokens)
+	for i in calls:
+		if not _looks_like_macro(tokens[i]):
+			return tokens[i]
+	
+	for i in calls:
+		if i == 0 or tokens[i-1] in (")", "]") or tokens[i-1] in _storage_keywords or tokens[i-1] in _aggregate_keywords:
+			continue
+		elif tokens[i-1] in ("*", "^") or (_is_identifier(tokens[i-1]) and _is_type_name(tokens, i - 1)):
+			return tokens[i]
+	return None
+
+def _declarator_name(tokens):
+	"""Return the name declared by a declarator (a list of token values), or None if there isn't one."""
+	
+	# A function pointer or block, such as (*name)(args) or (^name)(args).
+	for i, value in enumerate(tokens[:-2]):
+		if value == "(" and tokens[i+1] in ("*", "^") and _is_identifier(tokens[i+2]):
+			return tokens[i+2]
+	
+	# The last identifier that is not in parentheses or brackets. An identifier with arguments after the name is an annotation such as API_AVAILABLE(...), before the name it is a function type such as name(args).
+	name = None
+	depth = 0
+	for i, value in enumerate(tokens):
+		if value in ("(", "["):
+			depth += 1
+		elif value in (")", "]"):
+			depth -= 1
+		elif depth == 0 and _is_identifier(value) and value not in _keywords and not _is_attribute(value):
+			if name is None or tokens[i+1:i+2] != ["("]:
+				name = value
+	return name
+
+def _tag_name(tokens):
+	"""Return the tag of a struct, union or enum given the token values after the keyword, up to the body, or None if it has no tag. Attributes are skipped."""
+	
+	tag = None
+	depth = 0
+	for i, value in enumerate(tokens):
+		if value == "(":
+			depth += 1
+		elif value == ")":
+			depth -= 1
+		elif depth == 0 and _is_identifier(value) and not _is_attribute(value) and tokens[i+1:i+2] != ["("]:
+			tag = value
+	return tag
+
+def _is_identifier(value):
+	return value[:1].isalpha() or value[:1] == "_"
+
+def _split_top_level(tokens, separator):
+	"""Split a list of token values at the separators that are not in parentheses."""
+	
+	parts = [[]]
+	depth = 0
+	for value in tokens:
+		if value == "(":
+			depth += 1
+		elif value == ")":
+			depth -= 1
+		elif value == separator and depth == 0:
+			parts.append([])
+			continue
+		parts[-1].append(value)
+	return parts
+
+def _enum_macro_name(tokens):
+	"""Return the name declared by an enum macro such as CF_ENUM(CFIndex, Name) or NS_OPTIONS(NSUInteger, Name) in the statement, if any."""
+	
+	for i, value in enumerate(tokens[:-1]):
+		if (value.endswith("_ENUM") or value.endswith("_OPTIONS")) and tokens[i+1] == "(":
+			depth = 0
+			name = None
+			for arg in tokens[i+1:]:
+				if arg == "(":
+					depth += 1
+				elif arg == ")":
+					depth -= 1
+					if depth == 0:
+						return name
+				elif depth == 1 and _is_identifier(arg):
+					name = arg
+	return None
+
+def _scan_statement(tokens, symbols):
+	"""Record the names declared by a top-level statement (a list of token values, without the final semicolon)."""
+	
+	if not tokens:
+		return
+	
+	if tokens[0] == "typedef":
+		name = _enum_macro_name(tokens)
+		if name is not None:
+			symbols["typedef"].add(name)
+			symbols["enum"].add(name)
+			return
+		
+		for part in _split_top_level(tokens[1:], ","):
+			name = _declarator_name(part)
+			if name is not None:
+				symbols["typedef"].add(name)
+		return
+	
+	# A function prototype.
+	name = _function_name(tokens)
+	if name is not None:
+		symbols["function"].add(name)
+		return
+	
+	# A struct, union or enum definition or forward declaration without a declarator.
+	if tokens[0] in _aggregate_keywords and (len(tokens) == 2 or tokens[-1] == "{}"):
+		return
+	
+	# Otherwise, a variable declaration.
+	for part in _split_top_level(tokens, ","):
+		name = _declarator_name(part)
+		if name is not None:
+			symbols["variable"].add(name)
+
+def scan_header(text):
+	"""Scan the text of a header and return a dict that maps each of KINDS to the set of names of that kind that it declares."""
+	
+	symbols = {kind: set() for kind in KINDS}
+	text = _continuation_pat.sub(" ", text)
+	
+	# The non-whitespace tokens of the current top-level statement.
+	statement = []
+	# Stack of the kinds of the currently open braces: "aggregate", "enum", "function", "block" or "extern" (an extern "C" block, whose contents are top-level).
+	braces = []
+	# The number of open braces that are not extern "C" blocks, and the kind of the outermost one.
+	depth = 0
+	body = None
+	# Inside an enum body: whether the next identifier is the name of a constant.
+	expect_constant = False
+	# Nesting of parentheses in the enum body, so that commas in constant values are ignored.
+	enum_depth = 0
+	
+	line_start = True
+	directive = None
+	for value in _token_pat.findall(text):
+		if value == "\n" or (value[:2] == "/*" and "\n" in value):
+			line_start = True
+			directive = None
+			continue
+		elif value[:2] in ("//", "/*"):
+			continue
+		
+		if directive is not None:
+			# Inside a preprocessor directive. Only the name of a #define is interesting.
+			if directive == "define" and _is_identifier(value):
+				symbols["macro"].add(value)
+				directive = ""
+			elif directive == "#":
+				directive = value
+			continue
+		elif line_start and value == "#":
+			directive = "#"
+			continue
+		line_start = False
+		
+		if depth:
+			# Inside a function, struct or enum body.
+			if value == "{":
+				braces.append("block")
+				depth += 1
+			elif value == "}":
+				braces.pop()
+				depth -= 1
+				if not depth and body == "function":
+					# The end of an inline function definition, which doesn't end with a semicolon.
+					statement = []
+			elif depth == 1 and body == "enum":
+				if value in ("(", "["):
+					enum_depth += 1
+				elif value in (")", "]"):
+					enum_depth -= 1
+				elif value == "," and enum_depth == 0:
+					expect_constant = True
+				elif expect_constant and _is_identifier(value):
+					symbols["constant"].add(value)
+					expect_constant = False
+			continue
+		
+		if value == "{":
+			tags = [i for i, v in enumerate(statement) if v in _aggregate_keywords]
+			if statement[-2:] == ["extern", "\"C\""]:
+				braces.append("extern")
+				statement = []
+				continue
+			elif tags:
+				keyword = statement[tags[-1]]
+				tag = _tag_name(statement[tags[-1]+1:])
+				if tag is not None:
+					symbols[keyword].add(tag)
+				if keyword == "enum":
+					braces.append("enum")
+					expect_constant = True
+					enum_depth = 0
+				else:
+					braces.append("aggregate")
+			elif _enum_macro_name(statement) is not None:
+				braces.append("enum")
+				expect_constant = True
+				enum_depth = 0
+			elif "(" in statement:
+				_scan_statement(statement, symbols)
+				braces.append("function")
+			else:
+				braces.append("block")
+				statement = []
+			depth = 1
+			body = braces[-1]
+			# The body itself is not part of the statement, but what follows it (such as the name in a typedef) is.
+			statement.append("{}")
+		elif value == "}":
+			# The end of an extern "C" block.
+			if braces:
+				braces.pop()
+			statement = []
+		elif value == ";":
+			_scan_statement(statement, symbols)
+			statement = []
+		else:
+			statement.append(value)
+	
+	return symbols
+
+class _FileEntry(object):
+	"""The symbols declared by one header, with the modification time and size of the file when it was scanned."""
+	
+	__slots__ = ("path", "mtime", "size", "symbols")
+	
+	def __init__(self, path, mtime, size, symbols):
+		self.path = path
+		self.mtime = mtime
+		self.size = size
+		self.symbols = symbols
+	
+	def __getstate__(self):
+		return (self.path, self.mtime, self.size, self.symbols)
+	
+	def __setstate__(self, state):
+		self.path, self.mtime, self.size, self.symbols = state
+
+class SymbolIndex(object):
+	"""An index of the symbols declared by the headers in a list of include directories.
+	
+	Headers are identified by their name relative to the include directory, i.e. the name that would be used in an #include. If a header exists in several directories, only the first one is indexed, because that is the one #include finds.
+	"""
+	
+	def __init__(self, roots):
+		self.roots = [os.path.abspath(root) for root in roots]
+		# Maps header names to _FileEntry objects.
+		self.files = {}
+		# Maps symbol names to lists of (header, kind) pairs.
+		self.symbols = {}
+	
+	def update(self):
+		"""Scan all headers that were added or changed since the last update, and forget the ones that were removed.
+		
+		Returns the number of headers that were scanned or removed.
+		"""
+		
+		found = {}
+		for root in self.roots:
+			for dirpath, dirnames, filenames in os.walk(root):
+				dirnames.sort()
+				for filename in filenames:
+					if not filename.endswith(".h"):
+						continue
+					
+					path = os.path.join(dirpath, filename)
+					header = os.path.relpath(path, root).replace(os.sep, "/")
+					if header not in found:
+						found[header] = path
+		
+		changed = 0
+		for header in set(self.files) - set(found):
+			del self.files[header]
+			changed += 1
+		
+		for header, path in found.items():
+			try:
+				st = os.stat(path)
+			except OSError:
+				continue
+			
+			entry = self.files.get(header)
+			if entry is not None and entry.path == path and entry.mtime == st.st_mtime_ns and entry.size == st.st_size:
+				continue
+			
+			with open(path, "r", encoding="utf-8", errors="replace") as f:
+				symbols = scan_header(f.read())
+			self.files[header] = _FileEntry(path, st.st_mtime_ns, st.st_size, {kind: sorted(names) for kind, names in symbols.items() if names})
+			changed += 1
+		
+		if changed or not self.symbols:
+			self._build_symbols()
+		
+		return changed
+	
+	def _build_symbols(self):
+		self.symbols = {}
+		for header in sorted(self.files):
+			for kind, names in self.files[header].symbols.items():
+				for name in names:
+					self.symbols.setdefault(name, []).append((header, kind))
+	
+	def lookup(self, name):
+		"""Return a list of (header, kind) pairs for the headers that declare the given name."""
+		
+		return list(self.symbols.get(name, ()))
+	
+	def header_for(self, name):
+		"""Return the header that should be included to declare the given name, or None if it is not in the index.
+		
+		If several headers declare the name, the smallest one is used, since it is the cheapest to include. This is a heuristic: it may pick a header that only declares the name in a conditional block that isn't taken, or an internal header instead of the public one that includes it.
+		"""
+		
+		headers = {header for header, kind in self.symbols.get(name, ())}
+		if not headers:
+			return None
+		return min(headers, key=lambda header: (self.files[header].size, header))
+	
+	def headers_for(self, names):
+		"""Return the headers that should be included to declare all of the given names, in the order of the names.
+		
+		Raises KeyError for the names that are not in the index.
+		"""
+		
+		headers = []
+		missing = []
+		for name in names:
+			header = self.header_for(name)
+			if header is None:
+				missing.append(name)
+			elif header not in headers:
+				headers.append(header)
+		
+		if missing:
+			raise KeyError("Symbols not found in index: {}".format(", ".join(missing)))
+		
+		return headers
+	
+	def save(self, filename):
+		"""Save the index to a file."""
+		
+		data = {
+			"version": INDEX_VERSION,
+			"roots": self.roots,
+			"files": self.files,
+		}
+		
+		dirname = os.path.dirname(os.path.abspath(filename))
+		os.makedirs(dirname, exist_ok=True)
+		fd, tmpname = tempfile.mkstemp(dir=dirname, suffix=".tmp")
+		try:
+			with os.fdopen(fd, "wb") as f:
+				pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+			os.replace(tmpname, filename)
+		except BaseException:
+			os.unlink(tmpname)
+			raise
+	
+	@classmethod
+	def load(cls, filename, roots):
+		"""Load an index for the given include directories from a file.
+		
+		Returns None if the file doesn't exist or was saved by a different version or for different directories. The loaded index still needs to be updated.
+		"""
+		
+		try:
+			with open(filename, "rb") as f:
+				data = pickle.load(f)
+		except (OSError, pickle.UnpicklingError, EOFError):
+			return None
+		
+		index = cls(roots)
+		if not isinstance(data, dict) or data.get("version") != INDEX_VERSION or data.get("roots") != index.roots:
+			return None
+		
+		index.files = data["files"]
+		return index
@@ -0,0 +1,278 @@
+"""Instrumentation hooks for the preprocessor.
+
+If the instrument attribute of a Preprocessor (or the instrument argument of CFFIPreprocessor) is set to a callable, it is called with an Event for every file that is entered and left, every directive, every line that is macro expanded and every call to ffi.cdef. If it is None (the default), no events are created, and the only cost is a check for None.
+
+TimingCollector is an instrument that records the events as a tree of included files with their inclusive and exclusive times, and IncludeTracer prints the structure of the included files as it is processed.
+
+MacroProfile records statistics about the expansions of every macro. It is enabled separately, using the macro_profile attribute of a Preprocessor (or the macro_profile argument of CFFIPreprocessor), and its report method lists the macros that are the most expensive to expand.
+
+The times of files are measured between entering and leaving them. As the preprocessor produces its output lazily, this includes the time spent consuming the output, such as assembling it and (if the output is streamed) passing it to the FFI. Headers that are preprocessed in worker processes by cdef_include_many are not instrumented.
+"""
+
+import sys
+import time
+
+__all__ = [
+	"CDEF",
+	"DIRECTIVE",
+	"EXPANSION",
+	"INCLUDE_ENTER",
+	"INCLUDE_EXIT",
+	"Event",
+	"IncludeTracer",
+	"MacroProfile",
+	"MacroStats",
+	"TimingCollector",
+	"TimingNode",
+]
+
+# A file is entered. The name is the file name, and bytes is the size of its text (0 if it is skipped because of its include guard).
+INCLUDE_ENTER = "include_enter"
+# A file is left. tokens is the number of tokens of output that it produced, including the output of the files it included.
+INCLUDE_EXIT = "include_exit"
+# A directive was processed. The name is the name of the directive (such as "if" or "define"), and tokens is the number of tokens in the directive line. #include and #import directives are reported as INCLUDE_ENTER and INCLUDE_EXIT instead.
+DIRECTIVE = "directive"
+# A line was macro expanded. tokens is the number of tokens in the line before expansion. Lines that don't contain any macros are not reported.
+EXPANSION = "expansion"
+# Preprocessed source was passed to ffi.cdef. bytes is the size of the source.
+CDEF = "cdef"
+
+class Event(object):
+	"""An instrumentation event.
+	
+		.kind - The kind of the event (one of the constants in this module)
+		.name - The file name for include events, the directive name for directive events, otherwise None
+		.time - The time at which the event started, from time.perf_counter
+		.depth - The include nesting depth (0 for the source passed to the preprocessor)
+		.bytes - The number of bytes (characters) involved, or None
+		.tokens - The number of tokens involved, or None
+		.seconds - The duration of the event, or None for include events
+	"""
+	
+	__slots__ = ("kind", "name", "time", "depth", "bytes", "tokens", "seconds")
+	
+	def __init__(self, kind, name, time, depth, bytes=None, tokens=None, seconds=None):
+		self.kind = kind
+		self.name = name
+		self.time = time
+		self.depth = depth
+		self.bytes = bytes
+		self.tokens = tokens
+		self.seconds = seconds
+	
+	def __repr__(self):
+		return "{cls.__module__}.{cls.__name__}({self.kind!r}, {self.name!r}, time={self.time!r}, depth={self.depth!r}, bytes={self.bytes!r}, tokens={self.tokens!r}, seconds={self.seconds!r})".format(cls=type(self), self=self)
+
+class TimingNode(object):
+	"""A file (or a call of ffi.cdef) in the tree recorded by TimingCollector.
+	
+		.name - The file name, or "<ffi.cdef>"
+		.inclusive - The time spent in the file, including the files it included
+		.bytes - The size of the file's text, or of the source passed to ffi.cdef
+		.tokens - The number of tokens of output
+		.directives - The number of directives processed in the file
+		.directive_seconds - The time spent processing them
+		.expansions - The number of lines of the file that were macro expanded
+		.expansion_seconds - The time spent expanding them
+		.children - The TimingNodes of the files that the file included and the ffi.cdef calls made while it was processed
+	"""
+	
+	def __init__(self, name, bytes=None):
+		self.name = name
+		self.inclusive = 0.0
+		self.bytes = bytes
+		self.tokens = 0
+		self.directives = 0
+		self.directive_seconds = 0.0
+		self.expansions = 0
+		self.expansion_seconds = 0.0
+		self.children = []
+	
+	def __repr__(self):
+		return "<{cls.__module__}.{cls.__name__} {self.name!r}: {self.inclusive:.6f}s inclusive, {self.exclusive:.6f}s exclusive, {n} children>".format(cls=type(self), self=self, n=len(self.children))
+	
+	@property
+	def exclusive(self):
+		"""The time spent in the file itself, excluding the files it included and the ffi.cdef calls made meanwhile."""
+		
+		return self.inclusive - sum(child.inclusive for child in self.children)
+	
+	def walk(self, depth=0):
+		"""Yield pairs (depth, node) for this node and all nodes below it, in order."""
+		
+		yield depth, self
+		for child in self.children:
+			yield from child.walk(depth + 1)
+
+class TimingCollector(object):
+	"""An instrument that records a tree of TimingNodes. The roots attribute is the list of nodes for the sources passed to the preprocessor (and the ffi.cdef calls made outside of them), in order."""
+	
+	def __init__(self):
+		self.roots = []
+		# The nodes of the files that are currently open, with the times at which they were entered.
+		self._stack = []
+	
+	def __call__(self, event):
+		kind = event.kind
+		if kind == INCLUDE_ENTER:
+			node = TimingNode(event.name, event.bytes)
+			self._children().append(node)
+			self._stack.append((node, event.time))
+		elif kind == INCLUDE_EXIT:
+			node, start = self._stack.pop()
+			node.inclusive = event.time - start
+			node.tokens = event.tokens
+		elif kind == CDEF:
+			node = TimingNode("<ffi.cdef>", event.bytes)
+			node.inclusive = event.seconds
+			self._children().append(node)
+		elif self._stack:
+			node = self._stack[-1][0]
+			if kind == DIRECTIVE:
+				node.directives += 1
+				node.directive_seconds += event.seconds
+			elif kind == EXPANSION:
+				node.expansions += 1
+				node.expansion_seconds += event.seconds
+	
+	def _children(self):
+		return self._stack[-1][0].children if self._stack else self.roots
+	
+	def headers(self):
+		"""Return a dict that maps file names to lists [count, inclusive, exclusive] with the number of times each file was entered and the total time spent in it. The inclusive times of recursively included files are counted once per inclusion."""
+		
+		totals = {}
+		for root in self.roots:
+			for _, node in root.walk():
+				entry = totals.setdefault(node.name, [0, 0.0, 0.0])
+				entry[0] += 1
+				entry[1] += node.inclusive
+				entry[2] += node.exclusive
+		return totals
+	
+	def render(self, min_seconds=0.0):
+		"""Return the tree as a string, one line per node with its inclusive and exclusive time in milliseconds, the number of tokens of output and the name indented by its depth. Nodes whose inclusive time is less than min_seconds are left out (together with the nodes below them)."""
+		
+		lines = ["{:>12} {:>12} {:>9}  {}".format("inclusive", "exclusive", "tokens", "file")]
+		
+		def render_node(node, depth):
+			if node.inclusive < min_seconds:
+				return
+			lines.append("{:10.3f}ms {:10.3f}ms {:>9}  {}{}".format(node.inclusive * 1000, node.exclusive * 1000, node.tokens, "  " * depth, node.name))
+			for child in node.children:
+				render_node(child, depth + 1)
+		
+		for root in self.roots:
+			render_node(root, 0)
+		
+		return "\n".join(lines)
+
+class IncludeTracer(object):
+	"""An instrument that prints '#include "name" {' and '}' around every file that is entered, indented by its depth."""
+	
+	def __init__(self, file=None):
+		self.file = sys.stdout if file is None else file
+	
+	def __call__(self, event):
+		if event.kind == INCLUDE_ENTER:
+			print('{}#include "{}" {{'.format("\t" * event.depth, event.name), file=self.file) # }}
+		elif event.kind == INCLUDE_EXIT:
+			# {
+			print("{}}}".format("\t" * event.depth), file=self.file)
+
+class MacroStats(object):
+	"""Statistics about the expansions of a macro, recorded by MacroProfile.
+	
+		.name - The name of the macro
+		.source - Where the macro was defined, as a tuple (file name, line number), or None (see cffipp.preprocessor.Macro)
+		.calls - The number of times the macro was expanded
+		.tokens - The number of tokens in its replacements, before they were expanded further
+		.seconds - The time spent expanding it, including the macros in its arguments and replacement
+		.self_seconds - The time spent expanding it, excluding the macros that were expanded meanwhile
+		.max_depth - The maximum number of macro expansions in progress when it was expanded, including itself
+	"""
+	
+	def __init__(self, name, source):
+		self.name = name
+		self.source = source
+		self.calls = 0
+		self.tokens = 0
+		self.seconds = 0.0
+		self.self_seconds = 0.0
+		self.max_depth = 0
+	
+	def __repr__(self):
+		return "{cls.__module__}.{cls.__name__}({self.name!r}, source={self.source!r}, calls={self.calls!r}, tokens={self.tokens!r}, seconds={self.seconds!r}, self_seconds={self.self_seconds!r}, max_depth={self.max_depth!r})".format(cls=type(self), self=self)
+	
+	@property
+	def location(self):
+		"""The source as a string "file:line", or "<unknown>"."""
+		
+		if self.source is None:
+			return "<unknown>"
+		return "{}:{}".format(*self.source)
+
+class MacroProfile(object):
+	"""Records MacroStats for every macro that is expanded by a Preprocessor whose macro_profile is set to this object.
+	
+	The stats attribute maps tuples (name, source) to MacroStats, so a macro that is defined in several places has separate statistics for each definition.
+	"""
+	
+	def __init__(self):
+		self.stats = {}
+		# Lists [stats, start time, time spent in nested expansions] for the expansions in progress, innermost last.
+		self._stack = []
+	
+	def enter(self, macro):
+		"""Called by the preprocessor when it starts expanding a macro."""
+		
+		key = (macro.name, macro.source)
+		stats = self.stats.get(key)
+		if stats is None:
+			stats = self.stats[key] = MacroStats(macro.name, macro.source)
+		
+		stats.calls += 1
+		if len(self._stack) >= stats.max_depth:
+			stats.max_depth = len(self._stack) + 1
+		self._stack.append([stats, time.perf_counter(), 0.0])
+	
+	def produce(self, tokens):
+		"""Called by the preprocessor with the number of tokens in the replacement of the macro that is being expanded."""
+		
+		self._stack[-1][0].tokens += tokens
+	
+	def leave(self, name):
+		"""Called by the preprocessor when it has finished expanding the macro with the given name."""
+		
+		now = time.perf_counter()
+		# Expansions that were aborted by an error are never left, so skip over them.
+		while self._stack:
+			stats, start, nested = self._stack.pop()
+			elapsed = now - start
+			stats.seconds += elapsed
+			stats.self_seconds += elapsed - nested
+			if self._stack:
+				self._stack[-1][2] += elapsed
+			if stats.name == name:
+				break
+	
+	def top(self, n=20, key="seconds"):
+		"""Return the n MacroStats with the highest value of the given attribute (such as "seconds", "self_seconds", "calls" or "tokens"), highest first."""
+		
+		return sorted(self.stats.values(), key=lambda stats: getattr(stats, key), reverse=True)[:n]
+	
+	def report(self, n=20, key="seconds"):
+		"""Return a table of the top n macros (see top) as a string."""
+		
+		lines = ["{:>10} {:>10} {:>9} {:>10} {:>5}  {:<32} {}".format("total", "self", "calls", "tokens", "depth", "macro", "defined at")]
+		for stats in self.top(n, key):
+			lines.append("{:8.3f}ms {:8.3f}ms {:>9} {:>10} {:>5}  {:<32} {}".format(
+				stats.seconds * 1000,
+				stats.self_seconds * 1000,
+				stats.calls,
+				stats.tokens,
+				stats.max_depth,
+				stats.name,
+				stats.location,
+			))
+		return "\n".join(lines)
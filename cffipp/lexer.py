@@ -1,12 +1,48 @@
 """Lexer part of the preprocessor. Based on ply/cpp.py from the PLY library by David Beazley (http://www.dabeaz.com). See the LICENSE file for license info."""
 
+import sys
+
 import ply
 import ply.lex
 
 __all__ = [
+	"Token",
 	"build",
+	"shared_lexer",
+	"tokenize",
 ]
 
+# The lexer shared by all preprocessors, see shared_lexer.
+_shared = None
+
+class Token(object):
+	"""A preprocessor token.
+	
+	This is a more compact replacement for ply's LexToken, which has a __dict__ and may keep a reference to the lexer that created it. Tokens are shared between macro definitions and their expansions, so they must not be modified after they have been created. Use copy to get a modified copy instead.
+	"""
+	
+	__slots__ = ("type", "value", "lineno", "lexpos")
+	
+	def __init__(self, type, value, lineno=0, lexpos=0):
+		self.type = type
+		self.value = value
+		self.lineno = lineno
+		self.lexpos = lexpos
+	
+	def __repr__(self):
+		return "Token({self.type}, {self.value!r}, {self.lineno}, {self.lexpos})".format(self=self)
+	
+	def __reduce__(self):
+		return (Token, (self.type, self.value, self.lineno, self.lexpos))
+	
+	def copy(self, **kwargs):
+		"""Return a copy of this token, with the attributes given as keyword arguments changed."""
+		
+		tok = Token(self.type, self.value, self.lineno, self.lexpos)
+		for name, value in kwargs.items():
+			setattr(tok, name, value)
+		return tok
+
 # Default preprocessor lexer definitions. These tokens are enough to get
 # a basic preprocessor working. Other modules may import these if they want.
 
@@ -76,13 +112,139 @@ def t_CPP_COMMENT2(t):
 	t.type = 'CPP_WS'
 	t.value = '\n'
 	return t
-	
+
 def t_error(t):
 	t.type = t.value[0]
 	t.value = t.value[0]
 	t.lexer.skip(1)
 	return t
 
+# How tokenize handles the tokens produced by the token rule functions, without calling the functions.
+_PLAIN = 0 # Use the matched text as the value.
+_COUNT = 1 # Like _PLAIN, but the text may contain newlines, which need to be counted.
+_COMMENT1 = 2 # Block comment, replaced with whitespace like in t_CPP_COMMENT1.
+_COMMENT2 = 3 # Line comment, replaced with a newline like in t_CPP_COMMENT2.
+_ID = 4 # Identifier, interned.
+_CHAR = 5 # Literal or unknown character (see t_error), the type is the character itself.
+
+_fast_rules = {
+	t_CPP_WS: _COUNT,
+	CPP_INTEGER: _PLAIN,
+	t_CPP_STRING: _COUNT,
+	t_CPP_CHAR: _COUNT,
+	t_CPP_COMMENT1: _COMMENT1,
+	t_CPP_COMMENT2: _COMMENT2,
+}
+
+# Scanners used by tokenize, keyed by the id of the lexer's master regex list.
+_scanners = {}
+
+def _get_scanner(lex):
+	"""Return a tuple (lexre, scanner, kinds, types) for the given lexer, or None if tokenize can't use the fast path for it.
+	
+	The scanner is ply's master regex with an additional catch-all group at the end, so that it matches at every position and finditer can be used. kinds and types map group numbers to the way the token is handled (see _fast_rules) and the token type.
+	"""
+	
+	try:
+		scanner = _scanners[id(lex.lexre)]
+	except KeyError:
+		pass
+	else:
+		if scanner[0] is lex.lexre:
+			return scanner
+	
+	if len(lex.lexre) != 1 or lex.lexignore or lex.lexerrorf is not t_error or lex.lexstate != "INITIAL":
+		return None
+	
+	regex, indexfunc = lex.lexre[0]
+	kinds = []
+	types = []
+	for entry in indexfunc:
+		if not entry:
+			kinds.append(None)
+			types.append(None)
+		elif entry[0] is None:
+			kinds.append(_ID if entry[1] == 'CPP_ID' else _PLAIN)
+			types.append(entry[1])
+		elif entry[0] in _fast_rules:
+			kinds.append(_fast_rules[entry[0]])
+			types.append(entry[1])
+		else:
+			return None
+	
+	kinds.append(_CHAR)
+	types.append(None)
+	
+	scanner = (lex.lexre, ply.lex.re.compile(regex.pattern + r"|([\s\S])", regex.flags), kinds, types)
+	_scanners[id(lex.lexre)] = scanner
+	return scanner
+
+def tokenize(lex, data, lineno=1):
+	"""Split data into a list of Tokens using the given ply lexer, starting at the given line number.
+	
+	For lexers built from this module, ply's master regex is used directly, without creating a LexToken or calling a rule function for every token. Identifiers are interned. Other lexers are run normally and their tokens are converted.
+	"""
+	
+	scanner = _get_scanner(lex)
+	if scanner is None:
+		lex = lex.clone()
+		lex.input(data)
+		lex.lineno = lineno
+		return [Token(tok.type, tok.value, tok.lineno, tok.lexpos) for tok in iter(lex.token, None)]
+	
+	lexre, scanner, kinds, types = scanner
+	tokens = []
+	append = tokens.append
+	intern = sys.intern
+	
+	for m in scanner.finditer(data):
+		i = m.lastindex
+		kind = kinds[i]
+		value = m.group()
+		if kind == _ID:
+			append(Token('CPP_ID', intern(value), lineno, m.start()))
+		elif kind == _COUNT:
+			append(Token(types[i], value, lineno, m.start()))
+			if "\n" in value:
+				lineno += value.count("\n")
+		elif kind == _PLAIN:
+			append(Token(types[i], value, lineno, m.start()))
+		elif kind == _CHAR:
+			append(Token(value, value, lineno, m.start()))
+		elif kind == _COMMENT1:
+			ncr = value.count("\n")
+			append(Token('CPP_WS', '\n' * ncr if ncr else ' ', lineno, m.start()))
+			lineno += ncr
+		else:
+			# Like the original rule, this doesn't count the newline.
+			append(Token('CPP_WS', '\n', lineno, m.start()))
+	
+	return tokens
+
+def shared_lexer(lextab=None, outputdir=None):
+	"""Return the lexer that is shared by all preprocessors, building it on the first call.
+	
+	If lextab is given, it is the module name of persisted lexer tables. If the module can be imported, the tables are loaded from it instead of reflecting over this module and compiling the rules again. Otherwise the tables are built normally and written to outputdir. Both arguments are ignored once the shared lexer has been built.
+	
+	The shared lexer should not be used directly, use build to get a cheap clone of it.
+	"""
+	
+	global _shared
+	if _shared is None:
+		if lextab is None:
+			_shared = ply.lex.lex(module=sys.modules[__name__])
+		else:
+			_shared = ply.lex.lex(module=sys.modules[__name__], optimize=True, lextab=lextab, outputdir=outputdir)
+	return _shared
+
 def build(*args, **kwargs):
-	return ply.lex.lex(*args, **kwargs)
+	"""Return a lexer for the preprocessor.
+	
+	Without arguments, this returns a clone of the shared lexer, which is much cheaper than building a new one. Otherwise all arguments are passed to ply.lex.lex to build a new lexer from scratch.
+	"""
+	
+	if args or kwargs:
+		return ply.lex.lex(*args, **kwargs)
+	else:
+		return shared_lexer().clone()
 
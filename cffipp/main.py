@@ -1,16 +1,29 @@
+import concurrent.futures
+import contextlib
+import hashlib
+import io
 import os
+import pickle
 import re
 import sys
+import tempfile
+import time
 import warnings
 
 import cffi.backend_ctypes
 
+from . import expression
+from . import index
+from . import instrument
 from . import lexer
+from . import pch
 from . import preprocessor
+from . import prune
 from . import cffi_patches
 
 __all__ = [
 	"CFFIPreprocessor",
+	"OutputStats",
 ]
 
 DEFAULT_INCLUDE_PATH = [
@@ -27,6 +40,223 @@ DEFAULT_INCLUDE_PATH = [
 	for path in DEFAULT_INCLUDE_PATH
 ]
 
+BUILTIN_PRELUDE = """
+#define __asm(...) // Marks Assembler function names - not important here
+#define __attribute__(...) // GCC attributes - can usually be ignored
+#define __has_extension(...) 0 // No extensions here
+#define __has_feature(...) 0 // Whatever feature it is, we probably don't support it
+#define __has_include_next(...) 0 // #include_next isn't supported
+#define _DARWIN_C_SOURCE // Enable the full Darwin APIs
+
+// Nonstandard type qualifiers that pycparser/cffi doesn't understand
+#define _Nonnull
+#define _Null_unspecified
+#define _Nullable
+
+// sys/cdefs.h defines some really annoying macros for some keywords, which confuses pycparser/cffi.
+#include <sys/cdefs.h>
+#undef const
+#undef inline
+#undef signed
+#undef volatile
+#define __const const
+#define __inline inline
+#define __signed signed
+#define __volatile volatile
+#define __asm__ asm
+#define __const__ const
+#define __inline__ inline
+#define __signed__ signed
+#define __typeof__ typeof
+#define __volatile__ volatile
+"""
+
+# Increment this whenever the format of cache entries or the preprocessor output changes, to invalidate old caches.
+CACHE_VERSION = 9
+
+_identifier_pat = re.compile(r"[A-Za-z_]\w*")
+# Built-in macros that are redefined all the time, and are never exported as constants.
+_special_macros = frozenset(("__DATE__", "__FILE__", "__LINE__", "__TIME__"))
+
+# The Preprocessor of a cdef_include_many worker process, and the (macros, included_files, include_guards) state that every header starts from.
+_worker_pp = None
+_worker_state = None
+
+class OutputStats(object):
+	"""Statistics about the preprocessed output assembled by CFFIPreprocessor.cdef.
+	
+		.lines - The number of output lines, including blank lines and directives
+		.characters - The number of characters of output passed on to the FFI
+		.seconds - The time spent preprocessing and assembling the output (excluding the time spent in the FFI)
+	"""
+	
+	def __init__(self):
+		self.lines = 0
+		self.characters = 0
+		self.seconds = 0.0
+	
+	def __repr__(self):
+		return "{cls.__module__}.{cls.__name__}(lines={self.lines!r}, characters={self.characters!r}, seconds={self.seconds!r})".format(cls=type(self), self=self)
+	
+	@property
+	def lines_per_second(self):
+		return self.lines / self.seconds if self.seconds else 0.0
+	
+	@property
+	def characters_per_second(self):
+		return self.characters / self.seconds if self.seconds else 0.0
+
+def _preprocess_chunks(pp, text, filename, stream_size=None, stats=None):
+	"""Preprocess the given C source with the given Preprocessor and yield the output as (text, packed) pairs. A new chunk starts at every #pragma cffi packed directive.
+	
+	If stream_size is given, a new chunk also starts after the first complete top-level declaration that brings the current chunk to at least stream_size characters, so that the output never has to be held in memory all at once.
+	
+	If stats is given, it is an OutputStats object that is updated with the amount of output and the time spent producing it.
+	"""
+	
+	start_time = time.perf_counter()
+	pp.parse(text, filename)
+	
+	t_SPACE = pp.t_SPACE
+	buffer = io.StringIO()
+	write = buffer.write
+	line_count = 0
+	size = 0
+	total_size = 0
+	packed = False
+	# Nesting depth of braces and parentheses, and whether the last token was a semicolon at depth 0.
+	depth = 0
+	complete = True
+	
+	for line in pp.lines():
+		line_count += 1
+		if line.blank:
+			continue
+		elif line.directive is not None:
+			# Preprocessor directive not handled by the parser.
+			if line.directive == "pragma" and len(line.args) >= 3 and line.args[:2] == ["cffi", "packed"]:
+				chunk = buffer.getvalue()
+				buffer = io.StringIO()
+				write = buffer.write
+				total_size += size
+				size = 0
+				if stats is not None:
+					stats.seconds += time.perf_counter() - start_time
+				yield chunk, packed
+				start_time = time.perf_counter()
+				packed = {"false": False, "true": True}[line.args[2]]
+				continue
+			else:
+				raise preprocessor.PreprocessorError("Unknown #pragma directive:\n{}".format(line.text))
+		
+		for tok in line.tokens:
+			size += write(tok.value)
+			if tok.type != t_SPACE:
+				if tok.value == "{" or tok.value == "(":
+					depth += 1
+				elif tok.value == "}" or tok.value == ")":
+					depth -= 1
+				complete = depth == 0 and tok.value == ";"
+		
+		if stream_size is not None and complete and size >= stream_size:
+			chunk = buffer.getvalue()
+			buffer = io.StringIO()
+			write = buffer.write
+			total_size += size
+			size = 0
+			if stats is not None:
+				stats.seconds += time.perf_counter() - start_time
+			yield chunk, packed
+			start_time = time.perf_counter()
+	
+	chunk = buffer.getvalue()
+	total_size += size
+	if stats is not None:
+		stats.lines += line_count
+		stats.characters += total_size
+		stats.seconds += time.perf_counter() - start_time
+	yield chunk, packed
+
+def _read_header(pp, header):
+	"""Find the header with the given name and return a tuple (filename, text), or None if it is protected by an include guard that is already defined."""
+	
+	filename = pp.find_file(header, pp.path)
+	if filename is None:
+		raise FileNotFoundError('Header "{}" not found in include path'.format(header))
+	
+	guard = pp.include_guards.get(filename)
+	if guard is not None and guard in pp.macros:
+		return None
+	
+	text = pp.header_cache.read(filename)
+	if pp.dependencies is not None:
+		pp.dependencies[filename] = pp.header_cache.signature(filename)
+	
+	return filename, text
+
+def _init_worker(path, deterministic, compile_macros, state):
+	global _worker_pp, _worker_state
+	
+	_worker_pp = preprocessor.Preprocessor(lexer.build(), deterministic=deterministic, compile_macros=compile_macros)
+	for p in path:
+		_worker_pp.add_path(p)
+	_worker_state = state
+
+def _preprocess_header(header):
+	"""Preprocess a header in a cdef_include_many worker process, starting from the state passed to _init_worker. Returns the output and the changes to the preprocessor state as a dict."""
+	
+	pp = _worker_pp
+	macros, included_files, include_guards = _worker_state
+	pp.macros = dict(macros)
+	pp.invalidate_expansions()
+	pp.included_files = set(included_files)
+	pp.included_files.add(header)
+	pp.include_guards = dict(include_guards)
+	pp.dependencies = {}
+	
+	chunks = []
+	packed_attribute = None
+	header_file = _read_header(pp, header)
+	if header_file is not None:
+		filename, text = header_file
+		if "__attribute__((packed))" in text:
+			packed_attribute = filename
+		chunks = list(_preprocess_chunks(pp, text, filename))
+	
+	# All identifiers in the files that were read and in the replacement lists of the macros that they could expand to, as an upper bound for the macros that the output depends on. A signature of None means that the file doesn't exist.
+	read_files = {filename for filename, signature in pp.dependencies.items() if signature is not None}
+	identifiers = set()
+	for filename in read_files:
+		identifiers.update(_identifier_pat.findall(pp.header_cache.read(filename)))
+	# Files that were already included are skipped without reading them if their include guard is defined.
+	identifiers.update(include_guards.values())
+	_add_macro_identifiers(identifiers, macros, pp.t_ID)
+	
+	return {
+		"chunks": chunks,
+		# The name of the header file if it uses __attribute__((packed)), which cdef warns about.
+		"packed_attribute": packed_attribute,
+		"macros": {name: macro for name, macro in pp.macros.items() if macros.get(name) is not macro},
+		"undefined": set(macros) - set(pp.macros),
+		"included_files": pp.included_files - included_files,
+		"include_guards": {filename: guard for filename, guard in pp.include_guards.items() if include_guards.get(filename) != guard},
+		"dependencies": pp.dependencies,
+		"identifiers": identifiers,
+	}
+
+def _add_macro_identifiers(identifiers, macros, t_ID):
+	"""Add the identifiers in the replacement lists of the macros (a dict mapping names to Macros) that the given set of identifiers can reach to the set, directly or through other macros. t_ID is the token type of identifiers (see Preprocessor.t_ID)."""
+	
+	pending = list(identifiers)
+	while pending:
+		macro = macros.get(pending.pop())
+		if macro is None:
+			continue
+		for tok in macro.value:
+			if tok.type == t_ID and tok.value not in identifiers:
+				identifiers.add(tok.value)
+				pending.append(tok.value)
+
 class CFFIPreprocessor(object):
 	"""Wrapper around a cffipp.preprocessor.Preprocessor and a customized cffi.FFI.
 	
@@ -36,12 +266,63 @@ class CFFIPreprocessor(object):
 	The FFI's cdef method does not do any preprocessing!
 	
 	To include a header file, use the cdef_include method.
+	
+	If cache_dir is given, the results of cdef_include are cached in that directory. A cache entry is only reused if the macro state, include path and ABI are the same as when it was created, and none of the files that were (or would have been) read have changed. Caching turns on deterministic __DATE__ and __TIME__ by default, otherwise the macro state would be different in every run. The ASTs of the source passed to the FFI are cached as well (in the ast subdirectory, see cffipp.cffi_patches.BetterParser), so that replaying a cache entry doesn't need to parse it again.
+	
+	If snapshot is given, it is the name of a file that the fully initialized state (after the built-in headers have been processed) is saved to, and restored from in later runs. If cache_dir is given, a snapshot is stored in the cache directory by default.
+	
+	If pch_dir is given, cdef_include stores a precompiled header (see build_pch) for every header in that directory, and loads it instead of processing the header again if it is still valid. Like caching, this turns on deterministic __DATE__ and __TIME__ by default, because a PCH is only loaded in the macro state it was built in.
+	
+	If compile_macros is true, the preprocessor compiles function-like macros into Python functions, see cffipp.preprocessor.Preprocessor.compile_macro.
+	
+	If stream_size is given, cdef passes the preprocessed output to the FFI in chunks of about that many characters (split after complete top-level declarations) while preprocessing, instead of all at once at the end. This limits the memory needed for large headers.
+	
+	The output_stats attribute is an OutputStats object with the number of lines and characters of output produced by cdef so far, and the throughput of preprocessing.
+	
+	If parse_workers is greater than 1, large amounts of preprocessed source are parsed in parallel in that many processes, see cffipp.cffi_patches.BetterParser.
+	
+	If instrument is given, it is a callable that is called with an event for every file, directive, macro expansion and ffi.cdef call (see cffipp.instrument). It can also be changed later using the instrument attribute of the preprocessor (pp).
+	
+	If macro_profile is given, it is a cffipp.instrument.MacroProfile that records how often each macro is expanded and how long that takes. Like instrument, it can be changed later using the macro_profile attribute of the preprocessor.
+	
+	If watch is true, the files that each top-level cdef_include (or cdef_include_many) depends on are recorded, so that changed headers can be included again later without restarting, see reload.
+	
+	cdef and cdef_include accept an optional set of names to keep. If it is given, only the declarations that are needed for these names are passed to the FFI (see cffipp.prune). The other declarations are deferred, and can be declared later using cdef_deferred.
 	"""
 	
-	def __init__(self, include_path=None, **kwargs):
+	def __init__(self, include_path=None, cache_dir=None, deterministic=None, snapshot=None, pch_dir=None, compile_macros=False, stream_size=None, parse_workers=1, instrument=None, macro_profile=None, watch=False, **kwargs):
+		if deterministic is None:
+			deterministic = cache_dir is not None or pch_dir is not None
+		
 		self.ffi = cffi_patches.FFIWithBetterParser(backend=cffi.backend_ctypes.CTypesBackend())
-		self.pp = preprocessor.Preprocessor(lexer.build())
+		self.ffi._parser.parse_workers = parse_workers
+		self.pp = preprocessor.Preprocessor(lexer.build(), deterministic=deterministic, compile_macros=compile_macros)
+		# Signatures of all files read since construction, used to validate snapshots.
+		self.pp.dependencies = {}
+		self.pp.instrument = instrument
+		self.pp.macro_profile = macro_profile
+		self.cache_dir = cache_dir
+		if cache_dir is not None:
+			self.ffi._parser.ast_cache_dir = os.path.join(cache_dir, "ast")
+		self.pch_dir = pch_dir
+		self.stream_size = stream_size
+		# Statistics about the output of all cdef calls.
+		self.output_stats = OutputStats()
+		self.deterministic = deterministic
+		# Absolute names of all PCH files that were loaded or built, in order.
+		self._pch_files = []
 		self._last_source = None
+		# If not None, a list that every (text, packed) pair passed to the FFI is appended to.
+		self._cdef_log = None
+		self._symbol_index = None
+		# Declarations that were left out by cdef calls with keep.
+		self._deferred = prune.DeclarationPool()
+		self.watch = watch
+		# In watch mode, maps the top-level headers to dicts with the information that reload needs, see _watch_include.
+		self._watched = {}
+		self._watching = False
+		# Whether declarations passed to the FFI may replace existing ones, which is the case while reloading headers.
+		self._override = False
 		
 		if include_path is None:
 			include_path = DEFAULT_INCLUDE_PATH
@@ -49,54 +330,34 @@ class CFFIPreprocessor(object):
 		for path in include_path:
 			self.pp.add_path(path)
 		
+		if sys.maxsize > 2**31 - 1:
+			self.abi = "arm64"
+		else:
+			self.abi = "arm32"
+		
 		if sys.platform != "ios":
 			warnings.warn(UserWarning("This library is meant to run in the Pythonista app on iOS. You seem to be on a different platform. Things may not work well."))
 		
+		if snapshot is None and cache_dir is not None:
+			snapshot = os.path.join(cache_dir, "snapshot-{}.pickle".format(self._snapshot_key()))
+		
+		if snapshot is not None and self.load_snapshot(snapshot):
+			return
+		
 		self.cdef_include("builtin_arm.h")
+		self.cdef_include("builtin_{}.h".format(self.abi))
 		
-		if sys.maxsize > 2**31 - 1:
-			# 64-bit
-			self.cdef_include("builtin_arm64.h")
-		else:
-			# 32-bit
-			self.cdef_include("builtin_arm32.h")
-		
-		self.cdef("""
-		#define __asm(...) // Marks Assembler function names - not important here
-		#define __attribute__(...) // GCC attributes - can usually be ignored
-		#define __has_extension(...) 0 // No extensions here
-		#define __has_feature(...) 0 // Whatever feature it is, we probably don't support it
-		#define __has_include(...) 0 // Would be annoying to implement properly
-		#define __has_include_next(...) 0 // Same
-		#define _DARWIN_C_SOURCE // Enable the full Darwin APIs
-		
-		// Nonstandard type qualifiers that pycparser/cffi doesn't understand
-		#define _Nonnull
-		#define _Null_unspecified
-		#define _Nullable
-		
-		// sys/cdefs.h defines some really annoying macros for some keywords, which confuses pycparser/cffi.
-		#include <sys/cdefs.h>
-		#undef const
-		#undef inline
-		#undef signed
-		#undef volatile
-		#define __const const
-		#define __inline inline
-		#define __signed signed
-		#define __volatile volatile
-		#define __asm__ asm
-		#define __const__ const
-		#define __inline__ inline
-		#define __signed__ signed
-		#define __typeof__ typeof
-		#define __volatile__ volatile
-		""", "<built-in>")
-	
-	def cdef(self, text, filename="<cdef>", header=None):
+		self.cdef(BUILTIN_PRELUDE, "<built-in>")
+		
+		if snapshot is not None:
+			self.save_snapshot(snapshot)
+	
+	def cdef(self, text, filename="<cdef>", header=None, keep=None):
 		"""Preprocess the given C source and pass it to the FFI.
 		
 		filename sets the value of the __FILE__ macro. header is an internal argument used by cdef_include to pass the original name of the header file.
+		
+		If keep is given, it is a collection of names of functions, types, variables and constants (or "struct X", "union X" and "enum X" for tags). Only the declarations that these names need, directly or indirectly, are passed to the FFI, and the rest are deferred until they are needed by a later cdef or cdef_deferred call. Declarations that don't declare any name are always kept.
 		"""
 		
 		if header is None:
@@ -109,125 +370,722 @@ class CFFIPreprocessor(object):
 		if "__attribute__((packed))" in text:
 			warnings.warn(UserWarning("Use of unsupported __attribute__((packed)) in file {}".format(filename)))
 		
-		self.pp.parse(text, filename)
+		chunks = _preprocess_chunks(self.pp, text, filename, self.stream_size, self.output_stats)
+		self._cdef_chunks(chunks, keep)
 		
-		line = []
-		lines = []
-		packed = False
+		# {
+		##print("}")
+	
+	def _cdef_chunks(self, chunks, keep=None):
+		"""Pass preprocessed (text, packed) chunks to the FFI, pruning them if keep is given (see cdef)."""
 		
-		def _do_cdef():
-			text = "".join(lines)
-			self._last_source = text
-			##text = re.sub(r"^\s*\n\s*", "\n", text)
-			##print(text)
-			self.ffi.cdef(text, packed=packed)
-			line.clear()
-			lines.clear()
-		
-		for tok in self.pp:
-			if tok.type == self.pp.t_SPACE and "\n" in tok.value:
-				line.append(tok.value)
-				append = True
-				joined = "".join(line)
-				parts = joined.split()
-				
-				if not joined.strip():
-					append = False
-				elif parts and parts[0].startswith("#"):
-					# Preprocessor directive not handled by the parser.
-					if parts[0] == "#":
-						directive = parts[1]
-						args = parts[2:]
-					else:
-						directive = parts[0][1:]
-						args = parts[1:]
-					
-					if directive == "pragma" and len(args) >= 3 and args[:2] == ["cffi", "packed"]:
-						_do_cdef()
-						packed = {"false": False, "true": True}[args[2]]
-						append = False
-					else:
-						raise preprocessor.PreprocessorError("Unknown #pragma directive:\n{}".format(joined))
-				
-				if append:
-					##print(joined, end="")
-					lines.append(joined)
-				
-				line.clear()
-			else:
-				line.append(tok.value)
+		if keep is None:
+			for text, packed in chunks:
+				self._cdef_text(text, packed)
+		else:
+			declarations = []
+			for text, packed in chunks:
+				declarations.extend(prune.Declaration(part, packed) for part in prune.split_declarations(text))
+			self._deferred.add(declarations)
+			self._cdef_declarations(self._deferred.take(keep, self._is_declared))
+	
+	def _cdef_text(self, text, packed):
+		"""Pass preprocessed source to the FFI."""
 		
-		lines.append("".join(line))
-		_do_cdef()
+		self._last_source = text
+		##text = re.sub(r"^\s*\n\s*", "\n", text)
+		##print(text)
+		self._ffi_cdef(text, packed)
+		if self._cdef_log is not None:
+			self._cdef_log.append((text, packed))
+	
+	def _ffi_cdef(self, text, packed):
+		"""Call the FFI's cdef, and report it to the instrument if there is one."""
 		
-		# {
-		##print("}")
+		if self.pp.instrument is None:
+			self.ffi.cdef(text, packed=packed, override=self._override)
+			return
+		
+		start = time.perf_counter()
+		self.ffi.cdef(text, packed=packed, override=self._override)
+		self.pp.instrument(instrument.Event(instrument.CDEF, None, start, self.pp.include_depth, bytes=len(text), seconds=time.perf_counter() - start))
+	
+	def _cdef_declarations(self, declarations):
+		"""Pass a list of cffipp.prune.Declaration objects to the FFI, in as few cdef calls as possible."""
+		
+		start = 0
+		for i in range(1, len(declarations) + 1):
+			if i == len(declarations) or declarations[i].packed != declarations[start].packed:
+				self._cdef_text("".join(decl.text for decl in declarations[start:i]), declarations[start].packed)
+				start = i
+	
+	def _is_declared(self, name):
+		"""Return whether the FFI already has a declaration for the given name (in the format used by cffipp.prune). Structs and unions only count if they are complete."""
+		
+		parser = self.ffi._parser
+		kind, _, tag = name.rpartition(" ")
+		if kind in ("struct", "union"):
+			decl = parser._declarations.get(name)
+			return decl is not None and decl[0].fldnames is not None
+		elif kind:
+			return name in parser._declarations
+		else:
+			return name in parser._int_constants or any(
+				prefix + name in parser._declarations
+				for prefix in ("typedef ", "function ", "variable ", "constant ")
+			)
 	
-	def cdef_include(self, header, once=False):
-		"""Include the header with the given name."""
+	def cdef_deferred(self, names):
+		"""Declare the given names using the declarations that were deferred by earlier cdef calls with keep, together with the deferred declarations that they need.
+		
+		Returns whether any declarations were passed to the FFI.
+		"""
+		
+		if isinstance(names, str):
+			names = [names]
+		
+		declarations = self._deferred.take(names, self._is_declared)
+		self._cdef_declarations(declarations)
+		return bool(declarations)
+	
+	def cdef_include(self, header, once=False, keep=None):
+		"""Include the header with the given name. If keep is given, the declarations that aren't needed for these names are deferred, see cdef."""
 		
 		if once and header in self.pp.included_files:
 			return
 		else:
 			self.pp.included_files.add(header)
 		
-		for path in self.pp.path:
-			filename = os.path.join(path, header)
-			try:
-				f = open(filename, "r", encoding="utf-8")
-			except FileNotFoundError:
-				pass
-			else:
-				break
+		with self._watch_include(header, keep):
+			self._cdef_include_top(header, keep)
+	
+	def _cdef_include_top(self, header, keep=None):
+		"""Include a header for cdef_include, using a PCH if pch_dir is set and the cache otherwise."""
+		
+		if self.pch_dir is not None:
+			# The base name is only there for readability, the hash distinguishes headers such as a/b_c.h and a_b/c.h.
+			keep = None if keep is None else sorted(keep)
+			digest = hashlib.sha256(repr((header, keep)).encode("utf-8")).hexdigest()[:32]
+			filename = os.path.join(self.pch_dir, "{}-{}.pch".format(os.path.basename(header), digest))
+			if not self.load_pch(filename, [header], keep):
+				self.build_pch(filename, [header], keep)
 		else:
-			raise FileNotFoundError('Header "{}" not found in include path'.format(header))
+			self._cdef_include_cached(header, keep)
+	
+	def _cdef_include_cached(self, header, keep=None, result=None):
+		"""Include the header with the given name, using the cache if there is one. result is passed on to _cdef_include."""
 		
-		with f:
-			text = f.read()
+		if self.cache_dir is None:
+			self._cdef_include(header, keep, result)
+			return
+		
+		key = self._cache_key(header, keep)
+		if self._cache_load(key):
+			return
+		
+		old_dependencies, self.pp.dependencies = self.pp.dependencies, {}
+		old_log, self._cdef_log = self._cdef_log, []
+		deferred_count = len(self._deferred.declarations)
+		# The include may take declarations that were already deferred before it. The pool is part of the cache key, so a cache hit can take the same ones again.
+		deferred_positions = self._deferred.pending_positions()
+		try:
+			self._cdef_include(header, keep, result)
+			entry = {
+				"version": CACHE_VERSION,
+				"header": header,
+				"dependencies": self.pp.dependencies,
+				"cdefs": self._cdef_log,
+				"deferred": self._deferred.pending(deferred_count),
+				"taken": self._deferred.taken_since(deferred_positions),
+				"macros": self.pp.macros,
+				"included_files": self.pp.included_files,
+				"include_guards": self.pp.include_guards,
+			}
+		finally:
+			dependencies, self.pp.dependencies = self.pp.dependencies, old_dependencies
+			log, self._cdef_log = self._cdef_log, old_log
 		
-		self.cdef(text, filename, header)
+		# Nested cdef_include calls need to be reflected in the outer cache entries as well.
+		if old_dependencies is not None:
+			old_dependencies.update(dependencies)
+		if old_log is not None:
+			old_log.extend(log)
+		
+		self._cache_store(key, entry)
 	
-	"""
-	def load_macros(self):
-		lines = []
+	def _cdef_include(self, header, keep=None, result=None):
+		"""Find the header with the given name and cdef it, without checking the cache.
+		
+		If result is given, it is the result of preprocessing the header in a worker process (see cdef_include_many), which is applied instead of preprocessing the header again.
+		"""
+		
+		if result is not None:
+			self._apply_include_result(result, keep)
+			return
+		
+		header_file = _read_header(self.pp, header)
+		if header_file is not None:
+			filename, text = header_file
+			self.cdef(text, filename, header, keep)
+	
+	def _apply_include_result(self, result, keep=None):
+		"""Apply the changes to the preprocessor state recorded in the result of _preprocess_header, and cdef its output."""
+		
+		for name in result["undefined"]:
+			self.pp.macros.pop(name, None)
+		self.pp.macros.update(result["macros"])
+		self.pp.invalidate_expansions(set(result["undefined"]) | set(result["macros"]))
+		self.pp.included_files.update(result["included_files"])
+		self.pp.include_guards.update(result["include_guards"])
+		if self.pp.dependencies is not None:
+			self.pp.dependencies.update(result["dependencies"])
+		
+		if result["packed_attribute"] is not None:
+			warnings.warn(UserWarning("Use of unsupported __attribute__((packed)) in file {}".format(result["packed_attribute"])))
+		
+		self._cdef_chunks(result["chunks"], keep)
+	
+	def cdef_include_many(self, headers, workers=None):
+		"""Include the given headers, preprocessing them in parallel in up to workers processes (by default one per CPU).
+		
+		The result is the same as calling cdef_include for each header in order. Every worker starts from the current macro state, and the results are passed to the FFI in the given order. If the result for a header could depend on the headers before it, because it could expand a macro that they changed (such as the include guard of a header that they both include) or includes a file that they included first, the header is preprocessed again in this process instead. If processes are not available or pch_dir is set, the headers are simply included one after another (using a PCH for each header if pch_dir is set, as cdef_include does).
+		"""
+		
+		headers = list(headers)
+		if workers is None:
+			workers = os.cpu_count() or 1
+		
+		results = {}
+		if self.pch_dir is None and workers > 1 and len(headers) > 1:
+			results = self._preprocess_parallel(headers, workers)
 		
-		for name, macro in self.macros.items():
-			value = None
+		# Macros changed and include names (for #import) first included by the headers that were already included.
+		changed_macros = set()
+		included_files = set()
+		for header in headers:
+			result = results.pop(header, None)
+			if result is not None and (not changed_macros.isdisjoint(result["identifiers"]) or not included_files.isdisjoint(result["included_files"])):
+				result = None
 			
-			if macro.arglist is None:
-				macro_tokens = list(macro.value)
-				negative = False
-				
-				done = False
-				while not done:
-					# Strip parens and whitespace around integers.
-					# Loop exits when one iteration completes without any "cleanup actions".
-					done = True
-					
-					if macro_tokens and macro_tokens[0].value == "(" and macro_tokens[-1].value == ")":
-						del macro_tokens[0]
-						del macro_tokens[-1]
-						done = False
-					
-					if macro_tokens and (macro_tokens[0].type == self.pp.t_SPACE or macro_tokens[0].value == "+"):
-						del macro_tokens[0]
-						done = False
-					
-					if macro_tokens and macro_tokens[-1].type == self.pp.t_SPACE:
-						del macro_tokens[-1]
-						done = False
-					
-					if macro_tokens and macro_tokens[0].value == "-":
-						negative = not negative
-						del macro_tokens[0]
-						done = False
-				
-				if len(macro_tokens) == 1 and macro_tokens[0].type == self.pp.t_INTEGER:
-					value = ("-" if negative else "") + macro_tokens[0].value
+			macros_before = dict(self.pp.macros)
+			included_before = set(self.pp.included_files)
+			old_dependencies, self.pp.dependencies = self.pp.dependencies, {}
+			try:
+				self.pp.included_files.add(header)
+				with self._watch_include(header):
+					if self.pch_dir is not None:
+						self._cdef_include_top(header)
+					else:
+						self._cdef_include_cached(header, result=result)
+			finally:
+				dependencies, self.pp.dependencies = self.pp.dependencies, old_dependencies
 			
-			if value is not None:
-				lines.append("#define {} {}\n".format(name, value))
+			if old_dependencies is not None:
+				old_dependencies.update(dependencies)
+			included_files.update(self.pp.included_files - included_before)
+			changed_macros.update(name for name, macro in self.pp.macros.items() if macros_before.get(name) is not macro)
+			changed_macros.update(set(macros_before) - set(self.pp.macros))
+			# __FILE__ is set for every header, but only used while it is preprocessed.
+			changed_macros.discard("__FILE__")
+	
+	def _preprocess_parallel(self, headers, workers):
+		"""Preprocess the given headers in a process pool, each starting from the current state. Returns a dict mapping headers to the results of _preprocess_header. Headers that could not be preprocessed are left out, so that the error is raised when they are preprocessed again in this process."""
 		
-		self.ffi.cdef("".join(lines))
-	#"""
-
+		# Larger headers are started first, so that the pool doesn't end up waiting for a single large header.
+		costs = {}
+		for header in headers:
+			filename = self.pp.find_file(header, self.pp.path)
+			costs[header] = 0 if filename is None else os.path.getsize(filename)
+		order = sorted(costs, key=costs.get, reverse=True)
+		
+		state = (self.pp.macros, self.pp.included_files, self.pp.include_guards)
+		results = {}
+		try:
+			with concurrent.futures.ProcessPoolExecutor(
+				max_workers=min(workers, len(order)),
+				initializer=_init_worker,
+				initargs=(self.pp.path, self.deterministic, self.pp.compile_macros, state),
+			) as executor:
+				futures = {header: executor.submit(_preprocess_header, header) for header in order}
+				for header, future in futures.items():
+					try:
+						results[header] = future.result()
+					except Exception:
+						pass
+		except (OSError, ImportError, NotImplementedError, concurrent.futures.BrokenExecutor):
+			# Processes are not available (for example on iOS).
+			pass
+		
+		return results
+	
+	def symbol_index(self):
+		"""Return the index of the symbols declared by the headers on the include path (see cffipp.index.SymbolIndex).
+		
+		The index is built when it is first needed. If cache_dir is given, it is saved in the cache directory, so that later runs only need to scan the headers that changed.
+		"""
+		
+		if self._symbol_index is None:
+			filename = None
+			symbol_index = None
+			if self.cache_dir is not None:
+				key = hashlib.sha256(repr((index.INDEX_VERSION, [os.path.abspath(path) for path in self.pp.path])).encode("utf-8")).hexdigest()
+				filename = os.path.join(self.cache_dir, "index-{}.pickle".format(key))
+				symbol_index = index.SymbolIndex.load(filename, self.pp.path)
+			
+			if symbol_index is None:
+				symbol_index = index.SymbolIndex(self.pp.path)
+			
+			if symbol_index.update() and filename is not None:
+				symbol_index.save(filename)
+			
+			self._symbol_index = symbol_index
+		
+		return self._symbol_index
+	
+	def cdef_symbols(self, names):
+		"""Declare the given functions, types, constants and macros by including only the headers that declare them, according to the symbol index. Only the declarations that the names need are passed to the FFI, the others are deferred (see cdef). Headers that were already included are not included again, the names are taken from their deferred declarations instead.
+		
+		Returns the list of headers that declare the names. Raises PreprocessorError if any of the names are not in the index.
+		
+		The index is lexical, so it doesn't know which branch of an #if a declaration is in. If a name is only declared in a branch that isn't taken in the current state (such as the #else of #if __arm64__), its header is included but the name is not declared. If several headers declare a name, the smallest one is included (see cffipp.index.SymbolIndex.header_for), which is not necessarily the one that a C program would include.
+		"""
+		
+		if isinstance(names, str):
+			names = [names]
+		
+		try:
+			headers = self.symbol_index().headers_for(names)
+		except KeyError as e:
+			raise preprocessor.PreprocessorError(e.args[0])
+		
+		self.cdef_deferred(names)
+		for header in headers:
+			self.cdef_include(header, once=True, keep=names)
+		
+		return headers
+	
+	@contextlib.contextmanager
+	def _watch_include(self, header, keep=None):
+		"""In watch mode, record the files that the top-level header included in the with block depends on, the include names and the FFI declarations that it adds, and keep for reload. Nested includes are part of the top-level include that they happen in."""
+		
+		if not self.watch or self._watching:
+			yield
+			return
+		
+		parser = self.ffi._parser
+		declarations_before = set(parser._declarations)
+		included_before = set(self.pp.included_files)
+		old_dependencies, self.pp.dependencies = self.pp.dependencies, {}
+		self._watching = True
+		try:
+			yield
+		finally:
+			self._watching = False
+			dependencies, self.pp.dependencies = self.pp.dependencies, old_dependencies
+			if old_dependencies is not None:
+				old_dependencies.update(dependencies)
+		
+		self._watched[header] = {
+			"keep": keep,
+			"dependencies": dependencies,
+			"included_files": (self.pp.included_files - included_before) | {header},
+			"declarations": [name for name in parser._declarations if name not in declarations_before],
+		}
+	
+	def changed_includes(self):
+		"""Return the top-level headers included in watch mode that depend on files that have changed since, in the order in which they were included. Files are checked using their modification time and size (see cffipp.preprocessor.signature_valid), so this is cheap enough to be called regularly."""
+		
+		return [
+			header
+			for header, entry in self._watched.items()
+			if not all(preprocessor.signature_valid(filename, signature) for filename, signature in entry["dependencies"].items())
+		]
+	
+	def reload(self, headers=None):
+		"""Include the given top-level headers (by default the ones returned by changed_includes) again, and replace their old declarations in the FFI with the new ones. Only headers that were included in watch mode can be reloaded. Returns the list of headers that were reloaded.
+		
+		The headers are preprocessed again on top of the current macro state, after removing the include guards of the files that they read. Macros that a header no longer defines are not removed. Declarations from other headers that refer to a struct, union or enum of a reloaded header keep referring to the old type, so such headers have to be reloaded as well.
+		"""
+		
+		if headers is None:
+			headers = self.changed_includes()
+		
+		parser = self.ffi._parser
+		for header in headers:
+			entry = self._watched[header]
+			
+			for filename in entry["dependencies"]:
+				guard = self.pp.include_guards.pop(filename, None)
+				if guard is not None:
+					self.pp.undef(guard)
+			self.pp.included_files -= entry["included_files"]
+			# Including the header again may find files that were added since, such as a header that shadows one later on the include path.
+			self.pp.invalidate_dir_index({os.path.dirname(filename) for filename in entry["dependencies"]})
+			
+			# cffi doesn't allow redefining the fields of a struct or union, even with override, so the old tags are removed first.
+			for name in entry["declarations"]:
+				if name.partition(" ")[0] in ("struct", "union", "enum", "anonymous"):
+					parser._declarations.pop(name, None)
+			
+			self._override = True
+			try:
+				self.pp.included_files.add(header)
+				with self._watch_include(header, entry["keep"]):
+					self._cdef_include_top(header, entry["keep"])
+			finally:
+				self._override = False
+		
+		if headers:
+			# cffi caches types by their names and backend types by equality, which doesn't distinguish a reloaded struct from the old one, so all cached types are built again.
+			with self.ffi._lock:
+				self.ffi._parsed_types.clear()
+				self.ffi._cached_btypes.clear()
+				self.ffi._typecache.clear()
+		
+		return headers
+	
+	def integer_macros(self, names=None):
+		"""Return a dict that maps the names of the object-like macros whose expansion is an integer constant expression (such as O_RDONLY or (1 << 3) | FLAG) to their values.
+		
+		If names is given, only these macros are considered, otherwise all of them. Macros whose expansion contains identifiers, strings or floating-point numbers are left out, as are macros whose expansion can't be evaluated.
+		
+		The expansions are taken from the preprocessor's expansion cache, which also stores the expansions of the macros that they refer to, so macros that refer to each other are only expanded once.
+		"""
+		
+		pp = self.pp
+		t_INTEGER = pp.t_INTEGER
+		t_WS = pp.t_WS
+		values = {}
+		
+		for name, macro in pp.macros.items() if names is None else ((name, pp.macros.get(name)) for name in names):
+			if macro is None or macro.arglist is not None or not macro.value or name in _special_macros:
+				continue
+			
+			entry = pp.expansion_cache.get(name)
+			if entry is None:
+				entry = pp.expand_object_macro(macro)
+			if not entry:
+				continue
+			
+			key = []
+			for tok in entry[0]:
+				if tok.type in t_WS:
+					key.append(" ")
+				elif tok.type == t_INTEGER or not (tok.value[0].isalnum() or tok.value[0] in "_.\"'"):
+					key.append(tok.value)
+				else:
+					break
+			else:
+				try:
+					values[name] = expression.evaluate(tuple(key))
+				except expression.ExpressionError:
+					pass
+		
+		return values
+	
+	def cdef_integer_macros(self, names=None):
+		"""Declare the integer constant macros found by integer_macros as constants of the FFI, so that they can be used as attributes of a library (see cffi.FFI.dlopen). All constants are passed to the FFI in a single cdef call. Macros that the FFI already has a constant for are skipped.
+		
+		Returns a dict of the constants that were declared.
+		"""
+		
+		parser = self.ffi._parser
+		values = {
+			name: value
+			for name, value in self.integer_macros(names).items()
+			if name not in parser._int_constants and "macro " + name not in parser._declarations
+		}
+		
+		if values:
+			self._cdef_text("".join("#define {} {}\n".format(name, value) for name, value in values.items()), False)
+		
+		return values
+	
+	def _macro_state(self):
+		"""Return a hashable representation of the current macro table and included files.
+		__FILE__ is ignored, because it is redefined whenever a file is preprocessed.
+		"""
+		
+		macros = []
+		for name, macro in sorted(self.pp.macros.items()):
+			if name != "__FILE__":
+				macros.append((
+					name,
+					macro.arglist and tuple(macro.arglist),
+					macro.variadic,
+					tuple((tok.type, str(tok.value)) for tok in macro.value),
+				))
+		
+		return (tuple(macros), tuple(sorted(self.pp.included_files)))
+	
+	def _state_digest(self):
+		"""Return a digest of the current macro table, included files and deferred declarations."""
+		
+		return hashlib.sha256(repr((self._macro_state(), self._deferred.digest())).encode("utf-8")).hexdigest()
+	
+	def _cache_key(self, header, keep=None):
+		"""Compute the cache key for including the given header in the current state."""
+		
+		state = (
+			CACHE_VERSION,
+			header,
+			None if keep is None else tuple(sorted(keep)),
+			tuple(os.path.abspath(path) for path in self.pp.path),
+			self.abi,
+			self._macro_state(),
+			self._deferred.digest(),
+		)
+		return hashlib.sha256(repr(state).encode("utf-8")).hexdigest()
+	
+	def _snapshot_key(self):
+		"""Compute a key identifying the configuration that a snapshot was created with."""
+		
+		state = (
+			CACHE_VERSION,
+			tuple(os.path.abspath(path) for path in self.pp.path),
+			self.abi,
+			self.deterministic,
+			BUILTIN_PRELUDE,
+		)
+		return hashlib.sha256(repr(state).encode("utf-8")).hexdigest()
+	
+	def _get_state(self):
+		"""Return the complete preprocessor and FFI state as a picklable dict."""
+		
+		parser = self.ffi._parser
+		return {
+			"macros": self.pp.macros,
+			"included_files": self.pp.included_files,
+			"include_guards": self.pp.include_guards,
+			"dependencies": self.pp.dependencies,
+			"last_source": self._last_source,
+			"declarations": parser._declarations,
+			"included_declarations": parser._included_declarations,
+			"anonymous_counter": parser._anonymous_counter,
+			"int_constants": parser._int_constants,
+			"cdefsources": self.ffi._cdefsources,
+			"deferred": self._deferred,
+		}
+	
+	def _set_state(self, state):
+		"""Restore a state returned by _get_state."""
+		
+		parser = self.ffi._parser
+		self.pp.macros = state["macros"]
+		self.pp.invalidate_expansions()
+		self.pp.included_files = state["included_files"]
+		self.pp.include_guards = state["include_guards"]
+		self.pp.dependencies = state["dependencies"]
+		self._last_source = state["last_source"]
+		parser._declarations = state["declarations"]
+		parser._included_declarations = state["included_declarations"]
+		parser._anonymous_counter = state["anonymous_counter"]
+		parser._int_constants = state["int_constants"]
+		self.ffi._cdefsources = state["cdefsources"]
+		self._deferred = state["deferred"]
+	
+	def save_snapshot(self, filename):
+		"""Save the current state of the preprocessor and the FFI to the given file, so it can be restored later using load_snapshot."""
+		
+		snapshot = {
+			"version": CACHE_VERSION,
+			"key": self._snapshot_key(),
+			"state": self._get_state(),
+		}
+		
+		dirname = os.path.dirname(os.path.abspath(filename))
+		os.makedirs(dirname, exist_ok=True)
+		fd, tmpname = tempfile.mkstemp(dir=dirname, suffix=".tmp")
+		try:
+			with os.fdopen(fd, "wb") as f:
+				pickle.dump(snapshot, f, pickle.HIGHEST_PROTOCOL)
+			os.replace(tmpname, filename)
+		except BaseException:
+			os.unlink(tmpname)
+			raise
+	
+	def load_snapshot(self, filename):
+		"""Restore the state saved by save_snapshot from the given file.
+		
+		The snapshot is only restored if it was created with the same configuration and none of the files read before it was created have changed. Returns whether the snapshot was restored.
+		"""
+		
+		try:
+			with open(filename, "rb") as f:
+				snapshot = pickle.load(f)
+		except (OSError, EOFError, pickle.UnpicklingError):
+			return False
+		
+		if snapshot.get("version") != CACHE_VERSION or snapshot.get("key") != self._snapshot_key():
+			return False
+		
+		state = snapshot["state"]
+		for filename, signature in state["dependencies"].items():
+			if not preprocessor.signature_valid(filename, signature):
+				return False
+		
+		if not self.deterministic:
+			# The snapshot contains the date and time from when it was created.
+			for name in ("__DATE__", "__TIME__"):
+				state["macros"][name] = self.pp.macros[name]
+		
+		self._set_state(state)
+		return True
+	
+	def build_pch(self, filename, headers, keep=None):
+		"""Include the given headers and save the macros and declarations that they added as a precompiled header to the given file. If keep is given, it is passed on to cdef_include, and the deferred declarations are stored in the PCH as well.
+		
+		The PCH can only be loaded into a CFFIPreprocessor with the same configuration, macro state and deferred declarations as this one had before the headers were included. If a PCH was loaded or built before this one, it is recorded as the parent of the new PCH, so that PCHs can be stacked (e.g. CoreFoundation on top of the C standard library).
+		"""
+		
+		parser = self.ffi._parser
+		entry_state = self._state_digest()
+		macros_before = dict(self.pp.macros)
+		included_files_before = set(self.pp.included_files)
+		declarations_before = dict(parser._declarations)
+		included_declarations_before = set(parser._included_declarations)
+		int_constants_before = dict(parser._int_constants)
+		cdefsources_count = len(self.ffi._cdefsources)
+		deferred_count = len(self._deferred.declarations)
+		deferred_positions = self._deferred.pending_positions()
+		
+		old_dependencies, self.pp.dependencies = self.pp.dependencies, {}
+		try:
+			for header in headers:
+				self.pp.included_files.add(header)
+				self._cdef_include_cached(header, keep)
+		finally:
+			dependencies, self.pp.dependencies = self.pp.dependencies, old_dependencies
+		
+		if old_dependencies is not None:
+			old_dependencies.update(dependencies)
+		
+		metadata = {
+			"key": self._snapshot_key(),
+			"headers": list(headers),
+			"keep": None if keep is None else sorted(keep),
+			"parent": self._pch_files[-1] if self._pch_files else None,
+			"entry_state": entry_state,
+			"dependencies": dependencies,
+		}
+		body = {
+			"macros": {name: macro for name, macro in self.pp.macros.items() if macros_before.get(name) is not macro},
+			"undefined": set(macros_before) - set(self.pp.macros),
+			"included_files": self.pp.included_files - included_files_before,
+			"include_guards": self.pp.include_guards,
+			"declarations": {name: decl for name, decl in parser._declarations.items() if declarations_before.get(name) != decl},
+			"included_declarations": parser._included_declarations - included_declarations_before,
+			"anonymous_counter": parser._anonymous_counter,
+			"int_constants": {name: value for name, value in parser._int_constants.items() if int_constants_before.get(name) != value},
+			"cdefsources": self.ffi._cdefsources[cdefsources_count:],
+			"deferred": self._deferred.pending(deferred_count),
+			"taken": self._deferred.taken_since(deferred_positions),
+			"last_source": self._last_source,
+		}
+		
+		pch.write(filename, metadata, body, declarations_before)
+		self._pch_files.append(os.path.abspath(filename))
+	
+	def load_pch(self, filename, headers=None, keep=None):
+		"""Load a precompiled header created by build_pch from the given file.
+		
+		If the PCH was built on top of another PCH that hasn't been loaded yet, the parent is loaded first. Returns whether the PCH was loaded. It is not loaded if it is invalid or outdated, or if the current configuration or macro state doesn't match the one it was built with. If headers is given, it is also not loaded unless it was built for these headers and keep.
+		"""
+		
+		try:
+			metadata, body = pch.read(filename)
+		except (OSError, pch.PCHError):
+			return False
+		
+		if metadata["key"] != self._snapshot_key():
+			return False
+		
+		if headers is not None and (metadata["headers"] != list(headers) or metadata.get("keep") != (None if keep is None else sorted(keep))):
+			return False
+		
+		for depname, signature in metadata["dependencies"].items():
+			if not preprocessor.signature_valid(depname, signature):
+				return False
+		
+		if metadata["entry_state"] != self._state_digest():
+			parent = metadata["parent"]
+			if (
+				parent is None
+				or parent in self._pch_files
+				or not self.load_pch(parent)
+				or metadata["entry_state"] != self._state_digest()
+			):
+				return False
+		
+		parser = self.ffi._parser
+		try:
+			body = pch.load_body(body, parser._declarations)
+		except pch.PCHError:
+			return False
+		
+		for name in body["undefined"]:
+			self.pp.macros.pop(name, None)
+		self.pp.macros.update(body["macros"])
+		self.pp.invalidate_expansions(set(body["undefined"]) | set(body["macros"]))
+		self.pp.included_files.update(body["included_files"])
+		self.pp.include_guards.update(body["include_guards"])
+		self.pp.dependencies.update(metadata["dependencies"])
+		parser._declarations.update(body["declarations"])
+		parser._included_declarations.update(body["included_declarations"])
+		parser._anonymous_counter = body["anonymous_counter"]
+		parser._int_constants.update(body["int_constants"])
+		self.ffi._cdefsources.extend(body["cdefsources"])
+		self._deferred.discard(body["taken"])
+		self._deferred.add(body["deferred"])
+		self._last_source = body["last_source"]
+		self._pch_files.append(os.path.abspath(filename))
+		return True
+	
+	def _cache_load(self, key):
+		"""Replay the cache entry with the given key, if it exists and is still valid.
+		Returns whether the entry was used.
+		"""
+		
+		try:
+			with open(os.path.join(self.cache_dir, key + ".pickle"), "rb") as f:
+				entry = pickle.load(f)
+		except (OSError, EOFError, pickle.UnpicklingError):
+			return False
+		
+		if entry.get("version") != CACHE_VERSION:
+			return False
+		
+		for filename, signature in entry["dependencies"].items():
+			if not preprocessor.signature_valid(filename, signature):
+				return False
+		
+		for text, packed in entry["cdefs"]:
+			self._last_source = text
+			self._ffi_cdef(text, packed)
+		self._deferred.discard(entry["taken"])
+		self._deferred.add(entry["deferred"])
+		
+		self.pp.macros = entry["macros"]
+		self.pp.invalidate_expansions()
+		self.pp.included_files = entry["included_files"]
+		self.pp.include_guards.update(entry["include_guards"])
+		
+		if self.pp.dependencies is not None:
+			self.pp.dependencies.update(entry["dependencies"])
+		if self._cdef_log is not None:
+			self._cdef_log.extend(entry["cdefs"])
+		
+		return True
+	
+	def _cache_store(self, key, entry):
+		"""Write a cache entry with the given key. The file is replaced atomically, so concurrent readers never see a partial entry."""
+		
+		os.makedirs(self.cache_dir, exist_ok=True)
+		fd, tmpname = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+		try:
+			with os.fdopen(fd, "wb") as f:
+				pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL)
+			os.replace(tmpname, os.path.join(self.cache_dir, key + ".pickle"))
+		except BaseException:
+			os.unlink(tmpname)
+			raise
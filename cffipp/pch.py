@@ -0,0 +1,126 @@
+"""Precompiled header (PCH) files.
+
+A PCH file stores the macros and declarations that were added by including one or more headers, so that they can be loaded later without preprocessing and parsing the headers again.
+
+The file format is:
+
+	magic (8 bytes, b"CFFIPCH\\0")
+	format version (uint32, little endian)
+	metadata length (uint32, little endian)
+	body length (uint32, little endian)
+	SHA-256 digest of the compressed metadata and body (32 bytes)
+	metadata (zlib-compressed pickle)
+	body (zlib-compressed pickle)
+
+The metadata is small and can be checked (configuration, source file signatures, parent PCH) before the body is loaded. The body contains the actual macros and declarations. Declarations that existed before the PCH was built (for example those from a parent PCH) are not stored in the body, but referenced by name and resolved when the body is loaded.
+"""
+
+import hashlib
+import io
+import os
+import pickle
+import struct
+import tempfile
+import zlib
+
+__all__ = [
+	"MAGIC",
+	"VERSION",
+	"PCHError",
+	"write",
+	"read",
+	"load_body",
+]
+
+MAGIC = b"CFFIPCH\0"
+# Increment this whenever the format of the file or its contents changes.
+VERSION = 5
+
+_header = struct.Struct("<8sIII32s")
+
+class PCHError(Exception):
+	pass
+
+class _Pickler(pickle.Pickler):
+	def __init__(self, file, references):
+		super().__init__(file, pickle.HIGHEST_PROTOCOL)
+		self._references = {id(obj): name for name, (obj, quals) in references.items()}
+	
+	def persistent_id(self, obj):
+		return self._references.get(id(obj))
+
+class _Unpickler(pickle.Unpickler):
+	def __init__(self, file, references):
+		super().__init__(file)
+		self._references = references
+	
+	def persistent_load(self, pid):
+		try:
+			return self._references[pid][0]
+		except KeyError:
+			raise PCHError("PCH refers to missing declaration {!r}".format(pid))
+
+def write(filename, metadata, body, references):
+	"""Write a PCH file with the given metadata and body.
+	
+	references is a dict of declarations (in the format used by cffi's parser) that should be stored by name instead of being copied into the file.
+	"""
+	
+	f = io.BytesIO()
+	_Pickler(f, references).dump(body)
+	
+	meta_data = zlib.compress(pickle.dumps(metadata, pickle.HIGHEST_PROTOCOL))
+	body_data = zlib.compress(f.getvalue())
+	digest = hashlib.sha256(meta_data + body_data).digest()
+	
+	dirname = os.path.dirname(os.path.abspath(filename))
+	os.makedirs(dirname, exist_ok=True)
+	fd, tmpname = tempfile.mkstemp(dir=dirname, suffix=".tmp")
+	try:
+		with os.fdopen(fd, "wb") as f:
+			f.write(_header.pack(MAGIC, VERSION, len(meta_data), len(body_data), digest))
+			f.write(meta_data)
+			f.write(body_data)
+		os.replace(tmpname, filename)
+	except BaseException:
+		os.unlink(tmpname)
+		raise
+
+def read(filename):
+	"""Read and verify a PCH file.
+	
+	Returns a tuple (metadata, body), where body is still in serialized form and needs to be passed to load_body. Raises PCHError if the file is not a valid PCH file of the current version.
+	"""
+	
+	with open(filename, "rb") as f:
+		data = f.read()
+	
+	if len(data) < _header.size:
+		raise PCHError("File {} is too short to be a PCH file".format(filename))
+	
+	magic, version, meta_len, body_len, digest = _header.unpack_from(data)
+	if magic != MAGIC:
+		raise PCHError("File {} is not a PCH file".format(filename))
+	elif version != VERSION:
+		raise PCHError("PCH file {} has version {}, expected {}".format(filename, version, VERSION))
+	elif len(data) != _header.size + meta_len + body_len:
+		raise PCHError("PCH file {} has the wrong size".format(filename))
+	
+	contents = data[_header.size:]
+	if hashlib.sha256(contents).digest() != digest:
+		raise PCHError("PCH file {} is corrupted".format(filename))
+	
+	try:
+		metadata = pickle.loads(zlib.decompress(contents[:meta_len]))
+	except (zlib.error, pickle.UnpicklingError) as e:
+		raise PCHError("Could not read metadata of PCH file {}: {}".format(filename, e))
+	
+	return metadata, contents[meta_len:]
+
+def load_body(body, references):
+	"""Deserialize the body of a PCH file, resolving references to existing declarations using the given dict."""
+	
+	try:
+		return _Unpickler(io.BytesIO(zlib.decompress(body)), references).load()
+	except (zlib.error, pickle.UnpicklingError) as e:
+		raise PCHError("Could not read body of PCH file: {}".format(e))
@@ -3,16 +3,27 @@
 Most parts of the preprocessor are based on ply/cpp.py from the PLY library by David Beazley (http://www.dabeaz.com). See the LICENSE file for license info.
 """
 
-import copy
+import collections
+import hashlib
 import os
 import re
 import sys
+import threading
 import time
 
+from . import expression
+from .instrument import DIRECTIVE, EXPANSION, INCLUDE_ENTER, INCLUDE_EXIT, Event
+from .lexer import tokenize
+
 __all__ = [
+	"HeaderCache",
 	"Macro",
+	"OutputLine",
 	"Preprocessor",
 	"PreprocessorError",
+	"file_signature",
+	"header_cache",
+	"signature_valid",
 ]
 
 _trigraph_pat = re.compile(r'''\?\?[=/\'\(\)\!<>\-]''')
@@ -45,6 +56,140 @@ def trigraph(inp):
 	
 	return _trigraph_pat.sub(lambda g: _trigraph_rep[g.group()[-1]], inp)
 
+def file_signature(filename, data):
+	"""Return a signature for the file with the given name, whose (already read) contents are data.
+	The signature is a tuple (mtime, size, hash) that can later be checked using signature_valid.
+	"""
+	
+	st = os.stat(filename)
+	return (st.st_mtime_ns, st.st_size, hashlib.sha256(data.encode("utf-8")).hexdigest())
+
+def signature_valid(filename, signature):
+	"""Check whether the file with the given name still matches the given signature.
+	A signature of None means that the file did not exist, so it is only valid if it still doesn't.
+	
+	The file's contents are only hashed if its modification time or size has changed.
+	"""
+	
+	if signature is None:
+		return not os.path.exists(filename)
+	
+	try:
+		st = os.stat(filename)
+	except FileNotFoundError:
+		return False
+	
+	mtime, size, digest = signature
+	if st.st_mtime_ns == mtime and st.st_size == size:
+		return True
+	
+	with open(filename, "r", encoding="utf-8") as f:
+		data = f.read()
+	
+	return hashlib.sha256(data.encode("utf-8")).hexdigest() == digest
+
+class HeaderCache(object):
+	"""A cache of decoded header file contents, shared by all preprocessors in the process by default (see header_cache).
+	
+	Entries are validated using os.stat whenever they are used, and are reread if the file's modification time or size has changed. If the total size of all cached texts exceeds max_size bytes, the least recently used entries are evicted.
+	
+	The hits, misses and evictions attributes count how often the cache was used successfully, had to read a file, and dropped an entry.
+	"""
+	
+	def __init__(self, max_size=64*1024*1024):
+		self.max_size = max_size
+		self.size = 0
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		# Maps file names to lists [mtime, size, text, text size, signature]. The signature is computed lazily.
+		self._entries = collections.OrderedDict()
+		self._lock = threading.Lock()
+	
+	def read(self, filename):
+		"""Return the contents of the file with the given name, decoded as UTF-8.
+		Raises the same exceptions as open if the file can't be read.
+		"""
+		
+		st = os.stat(filename)
+		
+		with self._lock:
+			entry = self._entries.get(filename)
+			if entry is not None and entry[0] == st.st_mtime_ns and entry[1] == st.st_size:
+				self._entries.move_to_end(filename)
+				self.hits += 1
+				return entry[2]
+		
+		with open(filename, "r", encoding="utf-8") as f:
+			text = f.read()
+		
+		text_size = sys.getsizeof(text)
+		
+		with self._lock:
+			self.misses += 1
+			old = self._entries.pop(filename, None)
+			if old is not None:
+				self.size -= old[3]
+			
+			if text_size <= self.max_size:
+				self._entries[filename] = [st.st_mtime_ns, st.st_size, text, text_size, None]
+				self.size += text_size
+				self._evict()
+		
+		return text
+	
+	def signature(self, filename):
+		"""Return the signature (see file_signature) of the file with the given name.
+		If the file is cached, the cached contents are hashed (only once), without reading the file again.
+		"""
+		
+		with self._lock:
+			entry = self._entries.get(filename)
+			if entry is not None:
+				if entry[4] is None:
+					entry[4] = (entry[0], entry[1], hashlib.sha256(entry[2].encode("utf-8")).hexdigest())
+				return entry[4]
+		
+		return file_signature(filename, self.read(filename))
+	
+	def _evict(self):
+		while self.size > self.max_size:
+			filename, entry = self._entries.popitem(last=False)
+			self.size -= entry[3]
+			self.evictions += 1
+	
+	def resize(self, max_size):
+		"""Change the memory budget of the cache, evicting entries if necessary."""
+		
+		with self._lock:
+			self.max_size = max_size
+			self._evict()
+	
+	def clear(self):
+		"""Remove all entries from the cache. The statistics are not reset."""
+		
+		with self._lock:
+			self._entries.clear()
+			self.size = 0
+	
+	def stats(self):
+		"""Return a dict with statistics about the cache's usage."""
+		
+		with self._lock:
+			total = self.hits + self.misses
+			return {
+				"hits": self.hits,
+				"misses": self.misses,
+				"hit_rate": self.hits / total if total else 0.0,
+				"evictions": self.evictions,
+				"entries": len(self._entries),
+				"size": self.size,
+				"max_size": self.max_size,
+			}
+
+# The header cache that is used by default.
+header_cache = HeaderCache()
+
 class PreprocessorError(Exception):
 	def __init__(self, msg, file=None, line=None):
 		if file is not None:
@@ -67,29 +212,108 @@ class Macro(object):
 		.arglist - List of argument names
 		.variadic - Boolean indicating whether or not variadic macro
 		.vararg - Name of the variadic parameter
+		.source - Where the macro was defined, as a tuple (file name, line number), or None if it was not defined by a #define directive
 	
 	When a macro is created, the macro replacement token sequence is
 	pre-scanned and used to create patch lists that are later used
 	during macro expansion.
 	"""
 	
-	def __init__(self, name, value, arglist=None, variadic=False):
+	def __init__(self, name, value, arglist=None, variadic=False, source=None):
 		self.name = name
 		self.value = value
 		self.arglist = arglist
 		self.variadic = variadic
 		self.vararg = arglist[-1] if variadic else None
-		self.source = None
+		self.source = source
 	
 	def __repr__(self):
 		return "{cls.__module__}.{cls.__name__}(name={self.name!r}, value={self.value!r}, arglist={self.arglist!r}, variadic={self.variadic!r}, vararg={self.vararg!r}, source={self.source!r})".format(cls=type(self), self=self)
 
+class OutputLine(object):
+	"""A line of preprocessor output, as returned by Preprocessor.lines.
+	
+		.tokens - The tokens of the line, ending with the whitespace token that contains the newline (except for the last line)
+		.blank - Whether the line consists only of whitespace
+		.directive - If the line is a preprocessor directive that was passed through to the output (such as #pragma), its name, otherwise None
+		.args - The values of the non-whitespace tokens after the directive name
+	"""
+	
+	__slots__ = ("tokens", "blank", "directive", "args")
+	
+	def __init__(self, tokens, blank=False, directive=None, args=()):
+		self.tokens = tokens
+		self.blank = blank
+		self.directive = directive
+		self.args = args
+	
+	def __repr__(self):
+		return "{cls.__module__}.{cls.__name__}(tokens={self.tokens!r}, blank={self.blank!r}, directive={self.directive!r}, args={self.args!r})".format(cls=type(self), self=self)
+	
+	@property
+	def text(self):
+		return "".join(tok.value for tok in self.tokens)
+
+# Identifiers that expand_macros handles even if they are not defined as macros.
+_builtin_names = frozenset(("defined", "__has_include", "__LINE__"))
+
+def _stringify(tokens):
+	"""Convert a macro argument to a string literal, for the # operator."""
+	
+	return ('"%s"' % "".join([x.value for x in tokens])).replace("\\", "\\\\")
+
+def _join_all(rep, items, joinable):
+	"""Append items to rep, joining adjacent identifiers and integers."""
+	
+	for item in items:
+		if rep and item.type in joinable and rep[-1].type in joinable:
+			rep[-1] = rep[-1].copy(value=rep[-1].value + item.value)
+		else:
+			rep.append(item)
+
+def _join_run(rep, run, joinable):
+	"""Like _join_all, for a non-empty run of tokens that were already joined among themselves."""
+	
+	if rep and run[0].type in joinable and rep[-1].type in joinable:
+		rep[-1] = rep[-1].copy(value=rep[-1].value + run[0].value)
+		rep.extend(run[1:])
+	else:
+		rep.extend(run)
+
+class _NotCacheable(Exception):
+	"""Raised while expanding a macro for the expansion cache if the result can't be cached."""
+
+class _ExpansionFrame(object):
+	"""The state of one macro expansion in Preprocessor.expand_macros.
+	
+		.contexts - Stack of (iterator, macro name) pairs that tokens are read from
+		.output - The tokens produced so far
+		.call - The macro call that is waiting for its arguments to be expanded, if any
+	"""
+	
+	__slots__ = ("contexts", "output", "call")
+	
+	def __init__(self, tokens):
+		self.contexts = [(iter(tokens), None)]
+		self.output = []
+		self.call = None
+
 class Preprocessor(object):
 	"""Object representing a preprocessor.
 	Contains macro definitions, include directories, and other information.
 	"""
 	
-	def __init__(self, lexer=None):
+	# Results of lexprobe, keyed by the id of the lexer's rules.
+	_lexprobe_cache = {}
+	
+	def __init__(self, lexer=None, deterministic=False, compile_macros=False):
+		"""Create a new preprocessor.
+		
+		If deterministic is true, __DATE__ and __TIME__ are based on the SOURCE_DATE_EPOCH environment variable (or the Unix epoch if it is not set) instead of the current time, so that the macro table does not change between runs.
+		
+		If compile_macros is true, function-like macros are compiled into Python functions (see compile_macro) when they are defined, which makes expanding them faster, but defining them slower.
+		"""
+		
 		if lexer is None:
 			lexer = lex.lexer
 		self.lexer = lexer
@@ -98,11 +322,37 @@ class Preprocessor(object):
 		self.source = None
 		self.temp_path = []
 		self.included_files = set()
+		self.header_cache = header_cache
+		# Cached directory listings used to resolve includes, see listdir.
+		self.dir_index = {}
+		# The same listings with case-folded names, created when a lookup fails, see find_file.
+		self.dir_index_folded = {}
+		# Maps the names of files that are entirely wrapped in an include guard to the name of the guard macro.
+		self.include_guards = {}
+		# If not None, a dict that is filled with the signature of every file that include tries to read.
+		# Files that were not found are recorded with a signature of None.
+		self.dependencies = None
+		# Maps the names of object-like macros to their cached expansions, see expand_object_macro.
+		self.expansion_cache = {}
+		# Maps macro names to the names of the macros whose cached expansions depend on them.
+		self.expansion_deps = {}
+		self.compile_macros = compile_macros
+		# Maps the names of function-like macros to tuples (macro, function) of the macro and its compiled form.
+		self.compiled_macros = {}
+		# If not None, a callable that is called with a cffipp.instrument.Event for everything the preprocessor does.
+		self.instrument = None
+		# The include nesting depth of the file that is being processed, maintained while instrumentation is enabled.
+		self.include_depth = 0
+		# If not None, a cffipp.instrument.MacroProfile that records statistics about every macro expansion.
+		self.macro_profile = None
 		
 		# Probe the lexer for selected tokens
 		self.lexprobe()
 		
-		tm = time.localtime()
+		if deterministic:
+			tm = time.gmtime(int(os.environ.get("SOURCE_DATE_EPOCH", 0)))
+		else:
+			tm = time.localtime()
 		# These date and time formats are standardized.
 		# Do not modify (even though they are terrible).
 		self.define('__DATE__ "%s"' % time.strftime("%b %d %Y", tm))
@@ -115,22 +365,27 @@ class Preprocessor(object):
 	def tokenize(self, text):
 		"""Utility function. Given a string of text, tokenize into a list of tokens."""
 		
-		tokens = []
-		self.lexer.input(text)
-		while True:
-			tok = self.lexer.token()
-			if not tok:
-				break
-			tokens.append(tok)
-		return tokens
+		return tokenize(self.lexer, text)
 	
 	def lexprobe(self):
 		"""This method probes the preprocessor lexer object to discover
 		the token types of symbols that are important to the preprocessor.
 		If this works right, the preprocessor will simply "work"
 		with any suitable lexer regardless of how tokens have been named.
+		
+		The results are cached for lexers that share the same rules (such as clones of the same lexer), so each lexer only needs to be probed once.
 		"""
 		
+		try:
+			lexstatere, probed = self._lexprobe_cache[id(self.lexer.lexstatere)]
+		except KeyError:
+			pass
+		else:
+			# Check that the cached entry is for this lexer's rules and not for an older, garbage-collected object with the same id.
+			if lexstatere is self.lexer.lexstatere:
+				self.__dict__.update(probed)
+				return
+		
 		# Determine the token type for identifiers
 		self.lexer.input("identifier")
 		tok = self.lexer.token()
@@ -182,6 +437,9 @@ class Preprocessor(object):
 			tok = self.lexer.token()
 			if not tok or tok.value != c:
 				raise PreprocessorError("Unable to lex {!r} required for preprocessor".format(c))
+		
+		probed = {name: getattr(self, name) for name in ("t_ID", "t_INTEGER", "t_INTEGER_TYPE", "t_STRING", "t_SPACE", "t_NEWLINE", "t_WS")}
+		self._lexprobe_cache[id(self.lexer.lexstatere)] = (self.lexer.lexstatere, probed)
 	
 	def add_path(self, path):
 		"""Adds a search path to the preprocessor."""
@@ -195,7 +453,6 @@ class Preprocessor(object):
 		a line-by-line format.
 		"""
 		
-		lex = self.lexer.clone()
 		lines = [x.rstrip() for x in inp.splitlines()]
 		for i in range(len(lines)):
 			j = i+1
@@ -205,14 +462,9 @@ class Preprocessor(object):
 				j += 1
 		
 		inp = "\n".join(lines)
-		lex.input(inp)
-		lex.lineno = 1
 		
 		current_line = []
-		while True:
-			tok = lex.token()
-			if not tok:
-				break
+		for tok in tokenize(self.lexer, inp):
 			current_line.append(tok)
 			if tok.type in self.t_WS and '\n' in tok.value:
 				yield current_line
@@ -311,8 +563,7 @@ class Preprocessor(object):
 					# Conversion of argument to a string
 					if i > 0 and macro.value[i-1].value == '#':
 						##print("String conversion expansion here")
-						macro.value[i] = copy.copy(macro.value[i])
-						macro.value[i].type = self.t_STRING
+						macro.value[i] = macro.value[i].copy(type=self.t_STRING)
 						del macro.value[i-1]
 						macro.str_patch.append((argnum,i-1))
 						continue
@@ -350,173 +601,437 @@ class Preprocessor(object):
 			i += 1
 		macro.patch.sort(key=lambda x: x[2], reverse=True)
 	
-	def macro_expand_args(self, macro, args):
+	def macro_expand_args(self, macro, args, expanded_args=None):
 		"""Given a Macro and list of arguments (each a token list), this method
 		returns an expanded version of a macro. The return value is a token sequence
 		representing the replacement macro tokens.
+		
+		expanded_args maps argument numbers to the macro-expanded arguments.
+		Arguments that are needed but missing from it are expanded here.
 		"""
 		
 		##print("Expanding call of {} with args {}".format(macro.name, args))
 		
-		# Make a copy of the macro token sequence
-		rep = [copy.copy(_x) for _x in macro.value]
-		
-		# Make string expansion patches. These do not alter the length of the replacement sequence
+		if expanded_args is None:
+			expanded_args = {}
 		
-		str_expansion = {}
-		for argnum, i in macro.str_patch:
-			if argnum not in str_expansion:
-				str_expansion[argnum] = ('"%s"' % "".join([x.value for x in args[argnum]])).replace("\\", "\\\\")
-			rep[i] = copy.copy(rep[i])
-			rep[i].value = str_expansion[argnum]
+		patches = self.macro_patches(macro)
 		
 		# Make the variadic macro comma patch.  If the variadic macro argument is empty, we get rid
-		comma_patch = False
 		if macro.variadic and not args[-1]:
-			for i in macro.var_comma_patch:
-				rep[i] = None
-				comma_patch = True
+			removed = set(macro.var_comma_patch)
+		else:
+			removed = ()
+		
+		# Build the replacement in a single pass. Adjacent identifiers and integers
+		# (left over from ## concatenation) are joined to prevent incorrect expansion.
+		joinable = (self.t_ID, self.t_INTEGER)
+		rep = []
+		for i, tok in enumerate(macro.value):
+			if i in removed:
+				continue
+			
+			patch = patches.get(i)
+			if patch is None:
+				items = (tok,)
+			else:
+				ptype, argnum = patch
+				# String conversion
+				if ptype == 's':
+					items = (tok.copy(value=_stringify(args[argnum])),)
+				# Concatenation. Argument is left unexpanded
+				elif ptype == 'c':
+					items = args[argnum]
+				# Normal expansion. Argument is macro expanded first
+				else:
+					if argnum not in expanded_args:
+						expanded_args[argnum] = self.expand_macros(args[argnum])
+					items = expanded_args[argnum]
+			
+			_join_all(rep, items, joinable)
 		
-		# Make all other patches. The order of these matters. It is assumed that the patch list
-		# has been sorted in reverse order of patch location since replacements will cause the
-		# size of the replacement sequence to expand from the patch point.
+		return rep
+	
+	def macro_patches(self, macro):
+		"""Return a dict that maps positions in the macro token sequence to the patches (type, argument number) that are applied there. The type is 's' for string conversion and otherwise the type from macro.patch."""
 		
-		expanded = {}
+		patches = {}
+		for argnum, i in macro.str_patch:
+			patches[i] = ('s', argnum)
 		for ptype, argnum, i in macro.patch:
-			##print(ptype, argnum, i)
-			# Concatenation. Argument is left unexpanded
-			if ptype == 'c':
-				##print("Unexpanded {}".format(args[argnum]))
-				rep[i:i+1] = args[argnum]
-			# Normal expansion. Argument is macro expanded first
-			elif ptype == 'e':
-				if argnum not in expanded:
-					expanded[argnum] = self.expand_macros(args[argnum])
-				##print("Expanded {} to {}".format(args[argnum], expanded[argnum]))
-				rep[i:i+1] = expanded[argnum]
-		
-		# Join adjacent tokens to prevent incorrect expansion
-		for i in range(len(rep)-1, 0, -1):
-			if rep[i-1].type in (self.t_ID, self.t_INTEGER) and rep[i].type in (self.t_ID, self.t_INTEGER):
-				rep[i-1] = copy.copy(rep[i-1])
-				rep[i-1].value += rep[i].value
-				del rep[i]
-		
-		# Get rid of removed comma if necessary
-		if comma_patch:
-			rep = [_i for _i in rep if _i]
+			patches[i] = (ptype, argnum)
+		return patches
+	
+	def compile_macro(self, macro):
+		"""Compile a function-like macro into a Python function f(args, expanded_args) that returns the same replacement as macro_expand_args.
 		
-		return rep
+		The generated code appends precomputed runs of the macro's tokens and the arguments, so the patch lists don't need to be processed for every call.
+		Unlike with macro_expand_args, expanded_args must contain every argument that is substituted normally.
+		"""
+		
+		joinable = (self.t_ID, self.t_INTEGER)
+		patches = self.macro_patches(macro)
+		commas = set(macro.var_comma_patch) if macro.variadic else set()
+		
+		namespace = {
+			"_joinable": joinable,
+			"_join_all": _join_all,
+			"_join_run": _join_run,
+			"_stringify": _stringify,
+		}
+		lines = []
+		run = []
+		
+		def constant(value):
+			name = "_c{}".format(len(namespace))
+			namespace[name] = value
+			return name
+		
+		def flush():
+			if run:
+				lines.append("_join_run(rep, {}, _joinable)".format(constant(tuple(run))))
+				del run[:]
+		
+		for i, tok in enumerate(macro.value):
+			patch = patches.get(i)
+			if patch is None and i not in commas:
+				if run and tok.type in joinable and run[-1].type in joinable:
+					run[-1] = run[-1].copy(value=run[-1].value + tok.value)
+				else:
+					run.append(tok)
+				continue
+			
+			flush()
+			if patch is None:
+				# The comma before an empty variadic argument is removed.
+				lines.append("if args[-1]: rep.append({})".format(constant(tok)))
+			elif patch[0] == 's':
+				lines.append("rep.append({}.copy(value=_stringify(args[{}])))".format(constant(tok), patch[1]))
+			elif patch[0] == 'c':
+				lines.append("_join_all(rep, args[{}], _joinable)".format(patch[1]))
+			else:
+				lines.append("_join_all(rep, expanded_args[{}], _joinable)".format(patch[1]))
+		flush()
+		
+		source = "def expand(args, expanded_args):\n\trep = []\n{}\treturn rep\n".format("".join("\t{}\n".format(line) for line in lines))
+		exec(compile(source, "<macro {}>".format(macro.name), "exec"), namespace)
+		return namespace["expand"]
+	
+	def macro_replacement(self, macro, args, expanded_args):
+		"""Return the replacement of a call of a function-like macro, using its compiled form if compile_macros is enabled."""
+		
+		if not self.compile_macros:
+			return self.macro_expand_args(macro, args, expanded_args)
+		
+		compiled = self.compiled_macros.get(macro.name)
+		if compiled is None or compiled[0] is not macro:
+			# The macro was not defined by this preprocessor's define (for example, it was loaded from a cache).
+			compiled = self.compiled_macros[macro.name] = (macro, self.compile_macro(macro))
+		return compiled[1](args, expanded_args)
+	
+	def is_defined(self, name):
+		"""Check whether name is a defined macro, for the purposes of defined, #ifdef and #ifndef. This includes the built-in __has_include."""
+		
+		return name in self.macros or name == '__has_include'
+	
+	def needs_expansion(self, tokens, disabled=()):
+		"""Check whether macro expansion could change the given list of tokens."""
+		
+		t_ID = self.t_ID
+		macros = self.macros
+		for t in tokens:
+			if t.type == t_ID and ((t.value in macros and t.value not in disabled) or t.value in _builtin_names):
+				return True
+		return False
 	
 	def expand_macros(self, tokens, expanded=None):
-		"""Given a list of tokens, this function performs macro expansion.
-		The expanded argument is a dictionary that contains macros already
+		"""Given a list of tokens, this function performs macro expansion and
+		returns the expanded list of tokens.
+		The expanded argument is a collection of names of macros that must not be
 		expanded. This is used to prevent infinite recursion.
+		
+		Tokens are read from a stack of contexts (the input and the replacements of
+		the macros that are being expanded) and written to an output buffer, so the
+		time taken is linear in the number of tokens produced. A macro is disabled
+		while its replacement is being read, and identifiers that refer to a disabled
+		macro are marked so that they are never expanded later. Arguments of
+		function-like macros are expanded in frames of their own instead of by
+		recursion.
 		"""
 		
-		##joined = "".join(t.value for t in tokens)
-		##if joined.strip():
-		##	print("Expanded: {}, expanding: {}".format(expanded, tokens))
+		disabled = set(expanded) if expanded else set()
+		if not self.needs_expansion(tokens, disabled):
+			return tokens
 		
-		if expanded is None:
-			expanded = {}
+		return self._expand(tokens, disabled, set(), None)
+	
+	def _expand(self, tokens, disabled, painted, deps):
+		"""The macro expansion engine used by expand_macros.
 		
-		i = 0
+		disabled is the set of names of disabled macros, and painted is the set of identifier tokens that must not be expanded. Both are updated during the expansion.
+		If deps is not None, the names of all identifiers that the result depends on are added to it, and _NotCacheable is raised if the result can't be cached.
+		"""
 		
-		while i < len(tokens):
-			t = tokens[i]
-			if t.type == self.t_ID:
-				if t.value == 'defined':
-					j = i + 1
-					needparen = False
-					result = None
-					
-					while j < len(tokens):
-						if tokens[j].type in self.t_WS:
-							j += 1
-							continue
-						elif tokens[j].type == self.t_ID:
-							if tokens[j].value in self.macros:
-								result = "1"
-							else:
-								result = "0"
-							
-							if not needparen:
-								break
-						elif tokens[j].value == '(':
-							needparen = True
-						elif tokens[j].value == ')':
-							break
-						else:
-							raise PreprocessorError("Malformed defined()", self.source, t.lineno)
-						j += 1
-					
-					if result is None:
+		t_ID = self.t_ID
+		t_WS = self.t_WS
+		macros = self.macros
+		profile = self.macro_profile
+		# Line number of the outermost macro invocation, for __LINE__.
+		line = tokens[0].lineno if tokens else 0
+		
+		def read(contexts):
+			while contexts:
+				it, name = contexts[-1]
+				tok = next(it, None)
+				if tok is not None:
+					return tok
+				contexts.pop()
+				if name is not None:
+					disabled.discard(name)
+					if profile is not None:
+						profile.leave(name)
+			return None
+		
+		def read_nonspace(contexts):
+			tok = read(contexts)
+			while tok is not None and tok.type in t_WS:
+				tok = read(contexts)
+			return tok
+		
+		frames = [_ExpansionFrame(tokens)]
+		while True:
+			frame = frames[-1]
+			contexts = frame.contexts
+			output = frame.output
+			
+			t = read(contexts)
+			if t is None:
+				# The frame is finished.
+				if len(frames) == 1:
+					return output
+				
+				frames.pop()
+				frame = frames[-1]
+				m, args, expanded_args, todo = frame.call
+				expanded_args[todo.pop()] = output
+				if todo:
+					frames.append(_ExpansionFrame(args[todo[-1]]))
+				else:
+					frame.call = None
+					rep = self.macro_replacement(m, args, expanded_args)
+					if profile is not None:
+						profile.produce(len(rep))
+					frame.contexts.append((iter(rep), m.name))
+					disabled.add(m.name)
+				continue
+			
+			if t.type != t_ID or t in painted:
+				output.append(t)
+				continue
+			
+			name = t.value
+			if len(frames) == 1 and len(contexts) == 1:
+				line = t.lineno
+			if deps is not None:
+				deps.add(name)
+			
+			if name == 'defined':
+				# Replace "defined X" and "defined(X)" with 1 or 0.
+				tok = read_nonspace(contexts)
+				if tok is not None and tok.value == '(':
+					tok = read_nonspace(contexts)
+					close = read_nonspace(contexts)
+					if close is None or close.value != ')':
 						raise PreprocessorError("Malformed defined()", self.source, t.lineno)
+				if tok is None or tok.type != t_ID:
+					raise PreprocessorError("Malformed defined()", self.source, t.lineno)
+				
+				if deps is not None:
+					deps.add(tok.value)
+				output.append(t.copy(type=self.t_INTEGER, value=self.t_INTEGER_TYPE("1" if self.is_defined(tok.value) else "0")))
+			elif name == '__has_include' and name not in macros:
+				if deps is not None:
+					# The result depends on the file system.
+					raise _NotCacheable()
+				
+				tok = read_nonspace(contexts)
+				if tok is None or tok.value != '(':
+					raise PreprocessorError("Malformed __has_include()", self.source, t.lineno)
+				
+				args = []
+				tok = read(contexts)
+				while tok is not None and tok.value != ')':
+					args.append(tok)
+					tok = read(contexts)
+				
+				if tok is None:
+					raise PreprocessorError("Malformed __has_include()", self.source, t.lineno)
+				
+				args = self.tokenstrip(args)
+				if not args:
+					raise PreprocessorError("Malformed __has_include()", self.source, t.lineno)
+				
+				filename, angled = self.include_filename(args)
+				output.append(t.copy(type=self.t_INTEGER, value=self.t_INTEGER_TYPE(int(self.find_include(filename, angled) is not None))))
+			elif name in macros and name not in disabled:
+				# Yes, we found a macro match
+				m = macros[name]
+				if m.arglist is None:
+					# A simple macro. Use the cached expansion if it is valid here.
+					if profile is not None:
+						profile.enter(m)
+					entry = self.expansion_cache.get(name)
+					if entry is None and deps is None:
+						entry = self.expand_object_macro(m)
+					if entry and entry[2].isdisjoint(disabled):
+						output.extend(entry[0])
+						painted.update(entry[1])
+						if deps is not None:
+							deps.update(entry[2])
+						if profile is not None:
+							profile.produce(len(entry[0]))
+							profile.leave(name)
+					else:
+						if profile is not None:
+							profile.produce(len(m.value))
+						contexts.append((iter(m.value), name))
+						disabled.add(name)
+					continue
+				
+				# A macro with arguments. Look for the opening parenthesis.
+				skipped = []
+				tok = read(contexts)
+				while tok is not None and tok.type in t_WS:
+					skipped.append(tok)
+					tok = read(contexts)
+				
+				if tok is None or tok.value != '(':
+					# Macro function is not called - just move on
+					output.append(t)
+					output.extend(skipped)
+					if tok is not None:
+						contexts.append((iter((tok,)), None))
+					continue
+				
+				if profile is not None:
+					profile.enter(m)
+				
+				# Collect the arguments. Top-level commas are kept in the list, so that the variadic argument can include them.
+				argtokens = []
+				commas = []
+				nesting = 1
+				while True:
+					tok = read(contexts)
+					if tok is None:
+						raise PreprocessorError("Missing ')' in macro arguments", self.source, t.lineno)
 					
-					t.type = self.t_INTEGER
-					t.value = self.t_INTEGER_TYPE(result)
-					del tokens[i+1:j+1]
-				elif t.value in self.macros and t.value not in expanded:
-					# Yes, we found a macro match
-					expanded[t.value] = True
-					
-					m = self.macros[t.value]
-					if not m.arglist:
-						# A simple macro
-						ex = self.expand_macros([copy.copy(_x) for _x in m.value], expanded)
-						for e in ex:
-							e.lineno = t.lineno
-						tokens[i:i+1] = ex
-						i += len(ex)
+					value = tok.value
+					if value == '(':
+						nesting += 1
+					elif value == ')':
+						nesting -= 1
+						if nesting == 0:
+							break
+					elif value == ',' and nesting == 1:
+						commas.append(len(argtokens))
+					argtokens.append(tok)
+				
+				bounds = [-1] + commas + [len(argtokens)]
+				args = [self.tokenstrip(argtokens[bounds[k]+1:bounds[k+1]]) for k in range(len(bounds)-1)]
+				if len(args) == 1 and not args[0] and not m.arglist:
+					args = []
+				
+				if not m.variadic and len(args) != len(m.arglist):
+					raise PreprocessorError("Macro {} requires {} arguments".format(name, len(m.arglist)), self.source, t.lineno)
+				elif m.variadic and len(args) < len(m.arglist)-1:
+					if len(m.arglist) > 2:
+						raise PreprocessorError("Macro {} must have at least {} arguments".format(name, len(m.arglist)-1), self.source, t.lineno)
+					else:
+						raise PreprocessorError("Macro {} must have at least {} argument".format(name, len(m.arglist)-1), self.source, t.lineno)
+				
+				if m.variadic:
+					if len(args) == len(m.arglist)-1:
+						args.append([])
 					else:
-						# A macro with arguments
-						j = i + 1
-						while j < len(tokens) and tokens[j].type in self.t_WS:
-							j += 1
-						
-						if len(tokens) > j and tokens[j].value == '(':
-							# Macro function is called
-							tokcount, args, positions = self.collect_args(tokens[j:])
-							if not m.variadic and len(args) !=  len(m.arglist):
-								raise PreprocessorError("Macro {} requires {} arguments".format(t.value, len(m.arglist)), self.source, t.lineno)
-								i = j + tokcount
-							elif m.variadic and len(args) < len(m.arglist)-1:
-								if len(m.arglist) > 2:
-									raise PreprocessorError("Macro {} must have at least {} arguments".format(t.value, len(m.arglist)-1), self.source, t.lineno)
-								else:
-									raise PreprocessorError("Macro {} must have at least {} argument".format(t.value, len(m.arglist)-1), self.source, t.lineno)
-								i = j + tokcount
-							else:
-								if m.variadic:
-									if len(args) == len(m.arglist)-1:
-										args.append([])
-									else:
-										args[len(m.arglist)-1] = tokens[j+positions[len(m.arglist)-1]:j+tokcount-1]
-										del args[len(m.arglist):]
-										
-								# Get macro replacement text
-								rep = self.macro_expand_args(m, args)
-								##rep = self.expand_macros(rep, expanded)
-								for r in rep:
-									r.lineno = t.lineno
-								tokens[i:j+tokcount] = rep
-								##i += len(rep)
-								# Intentionally do not increment i and do not call expand_macros.
-								# Instead, in the next loop iteration, let the replacement get expanded.
-								# This is important for macro functions that return the name of a macro function, such as
-								# a(something)(whatever)
+						args[len(m.arglist)-1] = self.tokenstrip(argtokens[bounds[len(m.arglist)-1]+1:])
+						del args[len(m.arglist):]
+				
+				# Arguments that are substituted normally are macro expanded first, in a frame of their own.
+				expanded_args = {}
+				todo = []
+				for ptype, argnum, i in m.patch:
+					if ptype == 'e' and argnum not in expanded_args and argnum not in todo:
+						if self.needs_expansion(args[argnum], disabled):
+							todo.append(argnum)
 						else:
-							# Macro function is not called - just move on
-							i += 1
-					del expanded[t.value]
-					continue
-				elif t.value == '__LINE__':
-					t.type = self.t_INTEGER
-					t.value = self.t_INTEGER_TYPE(t.lineno)
-			
-			i += 1
-		return tokens
+							expanded_args[argnum] = args[argnum]
+				
+				if todo:
+					frame.call = (m, args, expanded_args, todo)
+					frames.append(_ExpansionFrame(args[todo[-1]]))
+				else:
+					# The replacement is read (and expanded) together with the tokens that follow it.
+					# This is important for macro functions that return the name of a macro function, such as
+					# a(something)(whatever)
+					rep = self.macro_replacement(m, args, expanded_args)
+					if profile is not None:
+						profile.produce(len(rep))
+					contexts.append((iter(rep), name))
+					disabled.add(name)
+			elif name in macros and name != '__LINE__':
+				# A disabled macro. It must not be expanded later, even if it is re-enabled.
+				t = t.copy()
+				painted.add(t)
+				output.append(t)
+			elif name == '__LINE__':
+				if deps is not None:
+					raise _NotCacheable()
+				output.append(t.copy(type=self.t_INTEGER, value=self.t_INTEGER_TYPE(t.lineno if len(frames) == 1 and len(contexts) == 1 else line)))
+			else:
+				output.append(t)
+	
+	def expand_object_macro(self, macro):
+		"""Expand the object-like macro on its own and store the result in the expansion cache.
+		
+		The cache entry is a tuple (tokens, painted, deps) of the expanded tokens, the tokens in it that must not be expanded and the names of the macros and identifiers that the expansion depends on.
+		It is valid wherever none of these macros are disabled, until one of them is defined or undefined.
+		If the expansion can't be cached (for example because it ends with the name of a function-like macro, which could take its arguments from the tokens that follow), the entry is False.
+		"""
+		
+		deps = {macro.name}
+		painted = set()
+		try:
+			tokens = self._expand(macro.value, {macro.name}, painted, deps)
+		except (_NotCacheable, PreprocessorError):
+			entry = False
+		else:
+			entry = (tokens, painted, deps)
+			for t in reversed(tokens):
+				if t.type not in self.t_WS:
+					last = self.macros.get(t.value) if t.type == self.t_ID and t not in painted else None
+					if last is not None and last.arglist is not None:
+						entry = False
+					break
+		
+		for name in deps:
+			self.expansion_deps.setdefault(name, set()).add(macro.name)
+		self.expansion_cache[macro.name] = entry
+		return entry
+	
+	def invalidate_expansions(self, names=None):
+		"""Remove the cached expansions that depend on any of the given macro names, or all cached expansions if names is None.
+		
+		define and undef do this automatically, but it must be called when self.macros is modified directly.
+		"""
+		
+		if names is None:
+			self.expansion_cache.clear()
+			self.expansion_deps.clear()
+			return
+		
+		for name in names:
+			for dependent in self.expansion_deps.pop(name, ()):
+				self.expansion_cache.pop(dependent, None)
 	
 	def evalexpr(self, tokens):
 		"""Evaluate an expression token sequence for the purposes of evaluating integral expressions."""
@@ -524,36 +1039,14 @@ class Preprocessor(object):
 		# tokens = tokenize(line)
 		
 		tokens = self.expand_macros(tokens)
-		for i, t in enumerate(tokens):
-			if t.type == self.t_ID:
-				tokens[i] = copy.copy(t)
-				tokens[i].type = self.t_INTEGER
-				tokens[i].value = self.t_INTEGER_TYPE("0")
-			elif t.type == self.t_INTEGER:
-				tokens[i] = copy.copy(t)
-				tokens[i].value = str(tokens[i].value)
-				
-				# Strip off any trailing suffixes
-				while tokens[i].value[-1] not in "0123456789abcdefABCDEF":
-					tokens[i].value = tokens[i].value[:-1]
-				
-				# Convert octal integers to Python 3 style
-				if len(tokens[i].value) >= 2 and tokens[i].value[0] == "0" and tokens[i].value[1] not in "bx":
-					tokens[i].value = oct(int(tokens[i].value, 8))
-		
-		expr = "".join(str(x.value) for x in tokens)
-		expr = expr.replace("&&", " and ")
-		expr = expr.replace("||", " or ")
-		expr = expr.replace("!", " not ")
+		key = tuple(" " if t.type in self.t_WS else t.value for t in tokens)
 		
 		try:
-			result = eval(expr, {"__builtins__": None})
-		except Exception:
+			return expression.evaluate(key)
+		except expression.ExpressionError as e:
 			raise PreprocessorError(
-				"Couldn't evaluate expression:\nOriginal: {}\nPython: {}"
-				.format("".join(t.value for t in tokens), expr), self.source, tokens[0].lineno)
-		
-		return result
+				"Couldn't evaluate expression {}: {}"
+				.format("".join(key).strip(), e.args[0]), self.source, tokens[0].lineno if tokens else None)
 	
 	def parsegen(self, inp, source="<parsegen>"):
 		"""Parse an input string."""
@@ -565,20 +1058,31 @@ class Preprocessor(object):
 		self.define('__FILE__ "{}"'.format(source.replace("\\", r"\\").replace('"', r'\"')))
 		
 		self.source = source
+		instrument = self.instrument
 		chunk = []
 		enable = True
 		iftrigger = False
 		ifstack = []
 		unknown_directive = False
+		# Include guard detection: 0 means nothing seen yet, 1 means inside the guard, 2 means after the guard's #endif, -1 means the file is not guarded.
+		guard = None
+		guard_state = 0
 		
 		for x in lines:
+			blank = True
 			for i, tok in enumerate(x):
 				if tok.type not in self.t_WS:
+					blank = False
 					break
 			
-			if tok.value == '#':
+			directive = tok.value == '#'
+			
+			if directive:
 				# Preprocessor directive
 				
+				if instrument is not None:
+					start = time.perf_counter()
+				
 				dirtokens = self.tokenstrip(x[i+1:])
 				if dirtokens:
 					name = dirtokens[0].value
@@ -609,6 +1113,7 @@ class Preprocessor(object):
 						for tok in self.include(args, once=(name == "import")):
 							yield tok
 						self.macros['__FILE__'] = oldfile
+						self.invalidate_expansions(('__FILE__',))
 						self.source = source
 				elif name == 'undef':
 					if enable:
@@ -619,7 +1124,7 @@ class Preprocessor(object):
 				elif name == 'ifdef':
 					ifstack.append((enable, iftrigger))
 					if enable:
-						if not args[0].value in self.macros:
+						if not self.is_defined(args[0].value):
 							enable = False
 							iftrigger = False
 						else:
@@ -627,7 +1132,7 @@ class Preprocessor(object):
 				elif name == 'ifndef':
 					ifstack.append((enable, iftrigger))
 					if enable:
-						if args[0].value in self.macros:
+						if self.is_defined(args[0].value):
 							enable = False
 							iftrigger = False
 						else:
@@ -684,26 +1189,62 @@ class Preprocessor(object):
 					for tok in x:
 						if tok.type in self.t_WS and '\n' in tok.value:
 							chunk.append(tok)
+				
+				if instrument is not None and name not in ("include", "import"):
+					instrument(Event(DIRECTIVE, name, start, self.include_depth, tokens=len(x), seconds=time.perf_counter() - start))
 			
 			else:
 				# Normal text
 				if enable:
 					chunk += x
 			
-			yield from (chunk if unknown_directive else self.expand_macros(chunk))
+			if not blank and guard_state != -1:
+				if guard_state == 0:
+					guard = self.guard_macro(name, args) if directive else None
+					guard_state = -1 if guard is None else 1
+				elif guard_state == 1:
+					if directive and name == "endif" and not ifstack:
+						guard_state = 2
+					elif directive and name in ("else", "elif") and len(ifstack) == 1:
+						guard_state = -1
+				else:
+					guard_state = -1
+			
+			if unknown_directive:
+				yield from chunk
+			elif instrument is None:
+				yield from self.expand_macros(chunk)
+			else:
+				start = time.perf_counter()
+				expanded = self.expand_macros(chunk)
+				if expanded is not chunk:
+					instrument(Event(EXPANSION, None, start, self.include_depth, tokens=len(chunk), seconds=time.perf_counter() - start))
+				yield from expanded
 			
 			chunk = []
-	
-	def include(self, tokens, once=False):
-		"""Implementation of file-inclusion.
 		
-		If once is true, behave like Objective-C #import, i. e. do not include the file again if it has been included previously.
+		if guard_state == 2:
+			self.include_guards[source] = guard
+	
+	def guard_macro(self, name, args):
+		"""If the directive with the given name and arguments can start an include guard (#ifndef X, #if !defined X or #if !defined(X)), return the name of the guard macro, otherwise None."""
+		
+		values = [tok.value for tok in args if tok.type not in self.t_WS]
+		if name == "ifndef" and len(values) == 1:
+			return values[0]
+		elif name == "if" and values[:2] == ["!", "defined"]:
+			if len(values) == 3:
+				return values[2]
+			elif len(values) == 5 and values[2] == "(" and values[4] == ")":
+				return values[3]
+		
+		return None
+	
+	def include_filename(self, tokens):
+		"""Extract the file name from the tokens of an #include directive (or __has_include).
+		Returns a tuple (filename, angled), where angled is true for <...> and false for "..." includes.
 		"""
 		
-		# Try to extract the filename and then process an include file
-		if not tokens:
-			raise PreprocessorError("Malformed #include", self.source)
-		
 		if tokens[0].value != '<' and tokens[0].type != self.t_STRING:
 			tokens = self.expand_macros(tokens)
 		
@@ -717,54 +1258,153 @@ class Preprocessor(object):
 			else:
 				raise PreprocessorError("Malformed #include <...>", self.source, tokens[0].lineno)
 			
-			filename = "".join(x.value for x in tokens[1:i])
-			path = self.path + [""] + self.temp_path
+			return "".join(x.value for x in tokens[1:i]), True
 		elif tokens[0].type == self.t_STRING:
-			filename = tokens[0].value[1:-1]
-			path = self.temp_path + [""] + self.path
+			return tokens[0].value[1:-1], False
 		else:
 			raise PreprocessorError("Malformed #include statement", self.source, tokens[0].lineno)
+	
+	def listdir(self, dirname):
+		"""Return a set of the names of all files in the given directory, or an empty set if it doesn't exist.
+		Directory listings are cached, so that each directory is only read once.
+		"""
 		
-		if once and filename in self.included_files:
-			return
+		try:
+			return self.dir_index[dirname]
+		except KeyError:
+			pass
+		
+		try:
+			with os.scandir(dirname or ".") as it:
+				names = frozenset(entry.name for entry in it if entry.is_file())
+		except OSError:
+			names = frozenset()
+		
+		self.dir_index[dirname] = names
+		return names
+	
+	def invalidate_dir_index(self, dirnames=None):
+		"""Forget the cached listings of the given directories (or of all directories if dirnames is None), so that files that were added or removed since they were read are found or no longer found."""
+		
+		if dirnames is None:
+			self.dir_index.clear()
+			self.dir_index_folded.clear()
 		else:
-			self.included_files.add(filename)
+			for dirname in dirnames:
+				self.dir_index.pop(dirname, None)
+				self.dir_index_folded.pop(dirname, None)
+	
+	def find_file(self, filename, path):
+		"""Find the file with the given (relative) name in the given list of directories.
+		Returns the full name of the file, or None if it is not found.
+		
+		This uses the cached directory listings instead of trying to open each candidate, so failed lookups in already known directories do not cost any system calls. The listings are compared case-sensitively. If only a file whose name differs in case is listed, it is checked with os.path.isfile, so that it is found on case-insensitive file systems (such as the default ones on iOS and macOS) like it would be by opening it.
 		
-		print('#include "{}" {{'.format(filename)) # }}
+		Files that are added to or removed from a directory after it was listed are not noticed until invalidate_dir_index is called.
+		"""
 		
 		for p in path:
 			iname = os.path.join(p, filename)
-			try:
-				with open(iname, "r", encoding="utf-8") as f:
-					data = f.read()
-				
-				dname = os.path.dirname(iname)
-				if dname:
-					self.temp_path.insert(0, dname)
-				
-				for tok in self.parsegen(data, iname):
-					yield tok
-				
-				if dname:
-					del self.temp_path[0]
-				
-				break
-			except FileNotFoundError:
-				pass
+			dirname, basename = os.path.split(iname)
+			names = self.listdir(dirname)
+			if basename in names:
+				return iname
+			elif names and basename.casefold() in self._listdir_folded(dirname) and os.path.isfile(iname):
+				return iname
+			elif self.dependencies is not None:
+				self.dependencies[iname] = None
+		
+		return None
+	
+	def _listdir_folded(self, dirname):
+		"""Return the cached listing of the given directory (see listdir) with case-folded names."""
+		
+		try:
+			return self.dir_index_folded[dirname]
+		except KeyError:
+			pass
+		
+		names = self.dir_index_folded[dirname] = frozenset(name.casefold() for name in self.listdir(dirname))
+		return names
+	
+	def find_include(self, filename, angled):
+		"""Find a header for an #include directive. Returns the full name of the header, or None if it is not found."""
+		
+		if angled:
+			path = self.path + [""] + self.temp_path
+		else:
+			path = self.temp_path + [""] + self.path
+		
+		return self.find_file(filename, path)
+	
+	def include(self, tokens, once=False):
+		"""Implementation of file-inclusion.
+		
+		If once is true, behave like Objective-C #import, i. e. do not include the file again if it has been included previously.
+		"""
+		
+		# Try to extract the filename and then process an include file
+		if not tokens:
+			raise PreprocessorError("Malformed #include", self.source)
+		
+		filename, angled = self.include_filename(tokens)
+		
+		if once and filename in self.included_files:
+			return
 		else:
+			self.included_files.add(filename)
+		
+		iname = self.find_include(filename, angled)
+		if iname is None:
 			raise PreprocessorError(
 				"Could not find header on include path: {}"
 				.format("".join(token.value for token in tokens)),
 				self.source, tokens[0].lineno,
 			)
 		
-		# {
-		print("}")
+		guard = self.include_guards.get(iname)
+		if guard is None or guard not in self.macros:
+			# Otherwise the file is wrapped in an include guard that is still defined, so including it again would have no effect.
+			data = self.header_cache.read(iname)
+			
+			if self.dependencies is not None:
+				self.dependencies[iname] = self.header_cache.signature(iname)
+			
+			dname = os.path.dirname(iname)
+			if dname:
+				self.temp_path.insert(0, dname)
+			
+			tokens = self.parsegen(data, iname)
+			if self.instrument is not None:
+				tokens = self.instrumented_file(tokens, iname, len(data), self.include_depth + 1)
+			yield from tokens
+			
+			if dname:
+				del self.temp_path[0]
+		elif self.instrument is not None:
+			yield from self.instrumented_file((), iname, 0, self.include_depth + 1)
+	
+	def instrumented_file(self, tokens, filename, size, depth):
+		"""Yield the given output tokens of a file, and report entering and leaving it to self.instrument. size is the size of the file's text, and depth its include nesting depth."""
+		
+		outer_depth = self.include_depth
+		self.instrument(Event(INCLUDE_ENTER, filename, time.perf_counter(), depth, bytes=size))
+		self.include_depth = depth
+		count = 0
+		try:
+			for tok in tokens:
+				count += 1
+				yield tok
+		finally:
+			# Also when preprocessing fails or the output is not consumed to the end, so that the instrument sees the file being left.
+			self.include_depth = outer_depth
+			self.instrument(Event(INCLUDE_EXIT, filename, time.perf_counter(), depth, tokens=count))
 	
 	def define(self, tokens):
-		"""Define a new macro."""
+		"""Define a new macro. tokens are the tokens of a #define directive after the directive name, or a string that is tokenized."""
 		
-		if isinstance(tokens, str):
+		directive = not isinstance(tokens, str)
+		if not directive:
 			tokens = self.tokenize(tokens)
 		
 		##print("Defining: {!r}".format("".join(t.value for t in tokens)))
@@ -772,16 +1412,18 @@ class Preprocessor(object):
 		linetok = tokens
 		try:
 			name = linetok[0]
+			source = (self.source, name.lineno) if directive else None
+			self.invalidate_expansions((name.value,))
 			if len(linetok) > 1:
 				mtype = linetok[1]
 			else:
 				mtype = None
 			if not mtype:
-				m = Macro(name.value,[])
+				m = Macro(name.value,[],source=source)
 				self.macros[name.value] = m
 			elif mtype.type in self.t_WS:
 				# A normal macro
-				m = Macro(name.value,self.tokenstrip(linetok[2:]))
+				m = Macro(name.value,self.tokenstrip(linetok[2:]),source=source)
 				self.macros[name.value] = m
 			elif mtype.value == '(':
 				# A macro with arguments
@@ -794,8 +1436,7 @@ class Preprocessor(object):
 					astr = "".join(str(_i.value) for _i in a)
 					if astr == "...":
 						variadic = True
-						a[0].type = self.t_ID
-						a[0].value = '__VA_ARGS__'
+						a[0] = a[0].copy(type=self.t_ID, value='__VA_ARGS__')
 						variadic = True
 						del a[1:]
 						continue
@@ -805,12 +1446,13 @@ class Preprocessor(object):
 						# If, for some reason, "." is part of the identifier, strip off the name for the purposes
 						# of macro expansion
 						if a[0].value[-3:] == '...':
-							a[0].value = a[0].value[:-3]
+							a[0] = a[0].copy(value=a[0].value[:-3])
 						continue
 					if len(a) > 1 or a[0].type != self.t_ID:
 						raise PreprocessorError("Invalid macro argument", self.source, tokens[0].lineno)
 				else:
 					mvalue = self.tokenstrip(linetok[1+tokcount:])
+					argnames = [x[0].value for x in args]
 					i = 0
 					while i < len(mvalue):
 						if i+1 < len(mvalue):
@@ -819,10 +1461,15 @@ class Preprocessor(object):
 								continue
 							elif mvalue[i].value == '##' and mvalue[i+1].type in self.t_WS:
 								del mvalue[i+1]
+							elif mvalue[i].value == '#' and mvalue[i+1].type in self.t_WS and i+2 < len(mvalue) and mvalue[i+2].value in argnames:
+								# Whitespace between # and the parameter that it converts to a string, as in # x
+								del mvalue[i+1]
 						i += 1
-					m = Macro(name.value,mvalue,[x[0].value for x in args],variadic)
+					m = Macro(name.value,mvalue,argnames,variadic,source)
 					self.macro_prescan(m)
 					self.macros[name.value] = m
+					if self.compile_macros:
+						self.compiled_macros[name.value] = (m, self.compile_macro(m))
 			else:
 				raise PreprocessorError("Bad macro definition", self.source, tokens[0].lineno)
 		except LookupError:
@@ -835,12 +1482,48 @@ class Preprocessor(object):
 			tokens = self.tokenize(tokens)
 		
 		self.macros.pop(tokens[0].value, None)
+		self.compiled_macros.pop(tokens[0].value, None)
+		self.invalidate_expansions((tokens[0].value,))
 	
 	def parse(self, inp, source=None, ignore={}):
 		"""Parse input text."""
 		
 		self.ignore = ignore
 		self.parser = self.parsegen(inp, source)
+		if self.instrument is not None:
+			self.parser = self.instrumented_file(self.parser, source, len(inp), 0)
+	
+	def lines(self):
+		"""Return the output of the current parse as a sequence of OutputLine objects.
+		
+		A line ends with the first whitespace token that contains a newline. Blank lines and directives are identified from the token types, so the text of the lines doesn't need to be scanned again.
+		"""
+		
+		t_SPACE = self.t_SPACE
+		t_WS = self.t_WS
+		tokens = []
+		# The index of the first token that is not whitespace, or None if there is none yet.
+		first = None
+		
+		for tok in self:
+			tokens.append(tok)
+			if tok.type == t_SPACE and "\n" in tok.value:
+				yield self._output_line(tokens, first)
+				tokens = []
+				first = None
+			elif first is None and tok.type not in t_WS:
+				first = len(tokens) - 1
+		
+		yield self._output_line(tokens, first)
+	
+	def _output_line(self, tokens, first):
+		if first is None:
+			return OutputLine(tokens, blank=True)
+		elif tokens[first].value != "#":
+			return OutputLine(tokens)
+		
+		words = [tok.value for tok in tokens[first+1:] if tok.type not in self.t_WS]
+		return OutputLine(tokens, directive=words[0] if words else "", args=words[1:])
 	
 	def token(self):
 		"""Method to return individual tokens."""
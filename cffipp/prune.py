@@ -0,0 +1,211 @@
+"""Pruning of preprocessed C declarations that are not needed.
+
+The preprocessed source is split into top-level declarations, and the names that each declaration defines and refers to are determined lexically (see cffipp.index.scan_header). Given a set of wanted names, only the declarations that are needed for them (directly or indirectly) are passed to the FFI. The others are kept in a DeclarationPool, so that they can still be declared later if they turn out to be needed.
+
+Names are plain identifiers for typedefs, functions, variables and enum constants, and "struct X", "union X" or "enum X" for tags.
+"""
+
+import hashlib
+import re
+
+from . import index
+
+__all__ = [
+	"Declaration",
+	"DeclarationPool",
+	"split_declarations",
+]
+
+# String and character literals (which may contain the other characters) and the characters that affect the structure of declarations.
+_structure_pat = re.compile(r""""(?:\\.|[^"\\\n])*"|'(?:\\.|[^'\\\n])*'|[{}();]""")
+_identifier_pat = re.compile(r""""(?:\\.|[^"\\\n])*"|'(?:\\.|[^'\\\n])*'|[A-Za-z_]\w*""")
+_forward_pat = re.compile(r"\s*(struct|union|enum)\s+([A-Za-z_]\w*)\s*;\s*\Z")
+_tag_keywords = frozenset(("struct", "union", "enum"))
+_tag_kinds = ("struct", "union", "enum")
+
+class Declaration(object):
+	"""A top-level declaration.
+	
+		.text - The source text of the declaration, including the final semicolon
+		.packed - Whether the declaration is in a #pragma cffi packed region
+		.defines - The names that the declaration defines
+		.refs - The names that the declaration refers to
+	"""
+	
+	__slots__ = ("text", "packed", "defines", "refs")
+	
+	def __init__(self, text, packed=False):
+		self.text = text
+		self.packed = packed
+		
+		symbols = index.scan_header(text)
+		defines = set()
+		for kind, names in symbols.items():
+			if kind in _tag_kinds:
+				defines.update(kind + " " + name for name in names)
+			else:
+				defines.update(names)
+		
+		match = _forward_pat.match(text)
+		if match is not None:
+			defines.add(match.group(1) + " " + match.group(2))
+		
+		refs = set()
+		tag = None
+		for ident in _identifier_pat.findall(text):
+			if ident[0] in "\"'":
+				continue
+			elif tag is not None:
+				refs.add(tag + " " + ident)
+				tag = None
+			elif ident in _tag_keywords:
+				tag = ident
+			else:
+				refs.add(ident)
+		
+		self.defines = frozenset(defines)
+		self.refs = frozenset(refs - defines)
+	
+	def __repr__(self):
+		return "{cls.__module__}.{cls.__name__}({self.text!r}, packed={self.packed!r})".format(cls=type(self), self=self)
+	
+	def __getstate__(self):
+		return (self.text, self.packed, self.defines, self.refs)
+	
+	def __setstate__(self, state):
+		self.text, self.packed, self.defines, self.refs = state
+
+def split_declarations(text):
+	"""Split preprocessed C source into a list of top-level declarations (strings). Whitespace before a declaration is kept with it."""
+	
+	parts = []
+	start = 0
+	braces = 0
+	parens = 0
+	body_start = 0
+	for match in _structure_pat.finditer(text):
+		c = match.group()
+		if c == "{":
+			if braces == 0:
+				body_start = match.start()
+			braces += 1
+		elif c == "}":
+			braces -= 1
+			# A function definition ends with its body.
+			if braces == 0 and parens == 0 and text[start:body_start].rstrip().endswith(")"):
+				parts.append(text[start:match.end()])
+				start = match.end()
+		elif c == "(":
+			parens += 1
+		elif c == ")":
+			parens -= 1
+		elif c == ";" and braces == 0 and parens == 0:
+			parts.append(text[start:match.end()])
+			start = match.end()
+	
+	if text[start:].strip():
+		parts.append(text[start:])
+	
+	return parts
+
+def _expand_root(name):
+	"""The names that a wanted name matches: a tag name as given, a plain name as any kind of symbol."""
+	
+	if " " in name:
+		return (name,)
+	return (name,) + tuple(kind + " " + name for kind in _tag_kinds)
+
+class DeclarationPool(object):
+	"""A collection of declarations that haven't been passed to the FFI yet."""
+	
+	def __init__(self):
+		# The declarations in order. Declarations that were taken are replaced with None.
+		self.declarations = []
+		# Maps names to the positions of the declarations that define them.
+		self._defined_by = {}
+		# Positions of the declarations that don't define any name and haven't been taken yet.
+		self._anonymous = []
+		# Cached result of digest, reset whenever the pool changes.
+		self._digest = None
+	
+	def add(self, declarations):
+		"""Add the given Declaration objects to the pool."""
+		
+		for decl in declarations:
+			if not decl.defines:
+				self._anonymous.append(len(self.declarations))
+			for name in decl.defines:
+				self._defined_by.setdefault(name, []).append(len(self.declarations))
+			self.declarations.append(decl)
+	
+	def pending(self, start=0):
+		"""Return the declarations from the given position on that haven't been taken yet."""
+		
+		return [decl for decl in self.declarations[start:] if decl is not None]
+	
+	def pending_positions(self):
+		"""Return the positions of the declarations that haven't been taken yet."""
+		
+		return [i for i, decl in enumerate(self.declarations) if decl is not None]
+	
+	def taken_since(self, positions):
+		"""Return the indices into positions (as returned by pending_positions earlier) of the declarations that have been taken since."""
+		
+		return [n for n, i in enumerate(positions) if self.declarations[i] is None]
+	
+	def discard(self, indices):
+		"""Remove the declarations at the given indices of the list returned by pending from the pool without returning them, as if they had been taken. This is used to replay the effect of an earlier take on a pool with the same contents."""
+		
+		positions = self.pending_positions()
+		for n in indices:
+			self.declarations[positions[n]] = None
+		self._anonymous = [i for i in self._anonymous if self.declarations[i] is not None]
+		self._digest = None
+	
+	def digest(self):
+		"""Return a digest of the declarations that haven't been taken yet, which identifies the contents of the pool."""
+		
+		if self._digest is None:
+			pending = [(decl.text, decl.packed) for decl in self.pending()]
+			self._digest = hashlib.sha256(repr(pending).encode("utf-8")).hexdigest()
+		return self._digest
+	
+	def take(self, names, declared=None):
+		"""Remove and return the declarations that are needed for the given names, in their original order.
+		
+		The declarations that define a name are needed if the name is wanted, or if another needed declaration refers to it. Declarations that don't define any name are always needed.
+		declared is an optional function that returns whether a name is already known to the FFI. Declarations aren't needed for such names.
+		"""
+		
+		needed = set()
+		seen = set()
+		wanted = []
+		for name in names:
+			wanted.extend(_expand_root(name))
+		for i in self._anonymous:
+			needed.add(i)
+			wanted.extend(self.declarations[i].refs)
+		self._anonymous = []
+		
+		while wanted:
+			name = wanted.pop()
+			if name in seen:
+				continue
+			seen.add(name)
+			
+			positions = [i for i in self._defined_by.get(name, ()) if self.declarations[i] is not None]
+			if not positions or (declared is not None and declared(name)):
+				continue
+			
+			for i in positions:
+				if i not in needed:
+					needed.add(i)
+					wanted.extend(self.declarations[i].refs)
+		
+		taken = []
+		for i in sorted(needed):
+			taken.append(self.declarations[i])
+			self.declarations[i] = None
+		if taken:
+			self._digest = None
+		return taken
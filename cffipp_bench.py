@@ -0,0 +1,370 @@
+"""Benchmarks for cffipp.
+
+Every workload is run several times in a fresh preprocessor, and the fastest run is reported. For each workload, the results contain the wall time, the exclusive time spent in each phase (lexing, directive handling, macro expansion, assembling the output, pycparser and building the cffi model), the lexer throughput in tokens and bytes per second, and the peak memory use (measured in a separate run with tracemalloc).
+
+The workloads that use the bundled headers only run the preprocessor, because the system headers that CFFIPreprocessor needs are not part of the repository. The synthetic workloads generate self-contained headers and run the complete cdef_include.
+
+Usage: python cffipp_bench.py [--repeat N] [--json FILE] [WORKLOAD ...]
+"""
+
+import argparse
+import contextlib
+import functools
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import warnings
+
+import cffi
+import pycparser
+
+import cffipp
+from cffipp import cffi_patches
+from cffipp import expression
+from cffipp import lexer
+from cffipp import main
+from cffipp import preprocessor
+
+INCLUDE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cffipp", "include")
+BUNDLED_INCLUDE_PATH = [os.path.join(INCLUDE_DIR, name) for name in ("builtin", "override", "clang")]
+
+# Definitions that CFFIPreprocessor.__init__ makes (see cffipp.main.BUILTIN_PRELUDE), without the parts that need the system headers.
+PRELUDE = """
+#include <builtin_arm.h>
+#include <builtin_arm64.h>
+#define __asm(...)
+#define __attribute__(...)
+#define __has_extension(...) 0
+#define __has_feature(...) 0
+#define __has_include_next(...) 0
+#define _Nonnull
+#define _Null_unspecified
+#define _Nullable
+"""
+
+PHASES = ["lex", "directives", "expansion", "assemble", "pycparser", "cffi_model"]
+
+class PhaseTimer(object):
+	"""Measures the time spent in each phase. Phases can be nested, and the time spent in an inner phase is not counted for the outer one."""
+	
+	def __init__(self):
+		self.times = dict.fromkeys(PHASES, 0.0)
+		self.tokens = 0
+		self.bytes = 0
+		self._stack = []
+		self._last = None
+	
+	def enter(self, phase):
+		now = time.perf_counter()
+		if self._stack:
+			self.times[self._stack[-1]] += now - self._last
+		self._stack.append(phase)
+		self._last = now
+	
+	def exit(self):
+		now = time.perf_counter()
+		self.times[self._stack.pop()] += now - self._last
+		self._last = now
+	
+	def wrap(self, phase, func):
+		"""Return a wrapper for func that counts the time spent in it for the given phase."""
+		
+		@functools.wraps(func)
+		def wrapper(*args, **kwargs):
+			self.enter(phase)
+			try:
+				return func(*args, **kwargs)
+			finally:
+				self.exit()
+		
+		return wrapper
+	
+	def wrap_generator(self, phase, func):
+		"""Return a wrapper for the generator function func that counts the time spent producing each item for the given phase."""
+		
+		@functools.wraps(func)
+		def wrapper(*args, **kwargs):
+			gen = func(*args, **kwargs)
+			while True:
+				self.enter(phase)
+				try:
+					item = next(gen)
+				except StopIteration:
+					return
+				finally:
+					self.exit()
+				yield item
+		
+		return wrapper
+	
+	def wrap_tokenize(self, func):
+		"""Return a wrapper for cffipp.lexer.tokenize that also counts the tokens and bytes that are lexed."""
+		
+		func = self.wrap("lex", func)
+		
+		@functools.wraps(func)
+		def wrapper(lex, data, *args, **kwargs):
+			tokens = func(lex, data, *args, **kwargs)
+			self.tokens += len(tokens)
+			self.bytes += len(data)
+			return tokens
+		
+		return wrapper
+
+@contextlib.contextmanager
+def instrumented(timer):
+	"""Patch the phase functions of cffipp to report to the given PhaseTimer while the context is active."""
+	
+	patches = [
+		(preprocessor, "tokenize", timer.wrap_tokenize(preprocessor.tokenize)),
+		(preprocessor.Preprocessor, "parsegen", timer.wrap_generator("directives", preprocessor.Preprocessor.parsegen)),
+		(preprocessor.Preprocessor, "expand_macros", timer.wrap("expansion", preprocessor.Preprocessor.expand_macros)),
+		(main, "_preprocess_chunks", timer.wrap_generator("assemble", main._preprocess_chunks)),
+		(cffi_patches._IncrementalCParser, "parse", timer.wrap("pycparser", cffi_patches._IncrementalCParser.parse)),
+		(cffi_patches.BetterParser, "_internal_parse", timer.wrap("cffi_model", cffi_patches.BetterParser._internal_parse)),
+	]
+	
+	originals = [(obj, name, getattr(obj, name)) for obj, name, _ in patches]
+	try:
+		for obj, name, func in patches:
+			setattr(obj, name, func)
+		yield timer
+	finally:
+		for obj, name, func in originals:
+			setattr(obj, name, func)
+
+class Workload(object):
+	"""A benchmark workload.
+	
+		.name - The name of the workload
+		.description - A short description
+		.headers - The names of the headers to include
+		.cdef - Whether to run the complete cdef_include (otherwise only the preprocessor runs)
+		.generate - A function that generates the headers in a given directory, or None for the bundled headers
+	"""
+	
+	def __init__(self, name, description, headers, cdef=False, generate=None):
+		self.name = name
+		self.description = description
+		self.headers = headers
+		self.cdef = cdef
+		self.generate = generate
+	
+	def run(self, directory):
+		"""Include the headers of the workload in a fresh preprocessor, with the generated headers (if any) in the given directory. Returns the number of lines and characters of output."""
+		
+		include_path = ([directory] if self.generate is not None else []) + BUNDLED_INCLUDE_PATH
+		
+		with warnings.catch_warnings():
+			warnings.simplefilter("ignore")
+			
+			if self.cdef:
+				pp = cffipp.CFFIPreprocessor(include_path=include_path, deterministic=True)
+				pp.output_stats = main.OutputStats()
+				for header in self.headers:
+					pp.cdef_include(header)
+				return pp.output_stats.lines, pp.output_stats.characters
+			
+			pp = preprocessor.Preprocessor(lexer.build(), deterministic=True)
+			for path in include_path:
+				pp.add_path(path)
+			for _ in main._preprocess_chunks(pp, PRELUDE, "<built-in>"):
+				pass
+			
+			stats = main.OutputStats()
+			for header in self.headers:
+				for _ in main._preprocess_chunks(pp, "#include <{}>\n".format(header), "<bench>", stats=stats):
+					pass
+			return stats.lines, stats.characters
+
+def _write(directory, name, text):
+	filename = os.path.join(directory, name)
+	os.makedirs(os.path.dirname(filename), exist_ok=True)
+	with open(filename, "w", encoding="utf-8") as f:
+		f.write(text)
+
+def _write_stubs(directory):
+	"""Write an empty sys/cdefs.h, which CFFIPreprocessor includes at startup."""
+	
+	_write(directory, "sys/cdefs.h", "#define __BEGIN_DECLS\n#define __END_DECLS\n")
+
+def generate_deep_nesting(directory, depth=100):
+	"""Headers that include each other in a chain, each with an include guard and a few declarations that use the previous ones."""
+	
+	_write_stubs(directory)
+	for i in range(depth):
+		lines = [
+			"#ifndef NEST_{}_H".format(i),
+			"#define NEST_{}_H".format(i),
+		]
+		if i + 1 < depth:
+			lines.append('#include "nest_{}.h"'.format(i + 1))
+		previous = "int" if i + 1 == depth else "nest_{}_t".format(i + 1)
+		lines += [
+			"#define NEST_{}_SIZE (NEST_{}_SIZE + 1)".format(i, i + 1) if i + 1 < depth else "#define NEST_{}_SIZE 1".format(i),
+			"typedef struct nest_{0} {{ {1} value; int values[NEST_{0}_SIZE]; }} nest_{0}_t;".format(i, previous),
+			"nest_{0}_t *nest_{0}_get(const {1} *value);".format(i, previous),
+			"#endif",
+			"",
+		]
+		_write(directory, "nest_{}.h".format(i), "\n".join(lines))
+	
+	# Include a header in the middle again, which the include guard optimization should skip.
+	_write(directory, "nest.h", '#include "nest_0.h"\n#include "nest_{}.h"\n'.format(depth // 2))
+
+def generate_heavy_macros(directory, count=2000):
+	"""A header whose declarations are mostly produced by nested function-like macros, token pasting and stringizing."""
+	
+	_write_stubs(directory)
+	lines = [
+		"#define CAT_(a, b) a ## b",
+		"#define CAT(a, b) CAT_(a, b)",
+		"#define STR_(x) #x",
+		"#define STR(x) STR_(x)",
+		"#define ADD(a, b) ((a) + (b))",
+		"#define MUL(a, b) ((a) * (b))",
+		"#define SQUARE(x) MUL(x, x)",
+		"#define POLY(x) ADD(SQUARE(x), ADD(MUL(3, x), 7))",
+		"#define FIELD(type, name) type CAT(field_, name);",
+		"#define STRUCT(name, a, b) struct CAT(s_, name) { FIELD(int, a) FIELD(long, b) FIELD(char, CAT(a, b)) };",
+		"#define FUNC(name, ...) int CAT(func_, name)(__VA_ARGS__);",
+		"#define CONST(name, x) enum { CAT(CONST_, name) = POLY(x) };",
+		"#if POLY(2) != 17",
+		"#error POLY is broken",
+		"#endif",
+	]
+	for i in range(count):
+		lines.append("STRUCT(s{0}, a{0}, b{0})".format(i))
+		lines.append("FUNC(f{0}, struct CAT(s_, s{0}) *, const char *name)".format(i))
+		lines.append("CONST(c{0}, {0})".format(i))
+	_write(directory, "macros.h", "\n".join(lines) + "\n")
+
+def generate_large_enum(directory, count=20000):
+	"""A header with a large enum, whose values are partly given by macros, and a matching set of #defines."""
+	
+	_write_stubs(directory)
+	lines = ["#define BIG_BASE 1000", "enum big {"]
+	for i in range(count):
+		lines.append("\tBIG_{0} = BIG_BASE + {0},".format(i) if i % 2 else "\tBIG_{},".format(i))
+	lines.append("};")
+	for i in range(0, count, 10):
+		lines.append("#define BIG_ALIAS_{0} BIG_{0}".format(i))
+	lines.append("int big_lookup(enum big value);")
+	_write(directory, "enum.h", "\n".join(lines) + "\n")
+
+WORKLOADS = [
+	Workload("clang_intrinsics", "Bundled clang intrinsics headers (preprocessor only)", ["arm_neon.h", "arm_acle.h"]),
+	Workload("clang_libc", "Bundled clang C library headers (preprocessor only)", ["float.h", "limits.h", "stdarg.h", "stddef.h", "stdint.h", "stdatomic.h"]),
+	Workload("deep_nesting", "Synthetic chain of 100 nested includes", ["nest.h"], cdef=True, generate=generate_deep_nesting),
+	Workload("heavy_macros", "Synthetic declarations generated by nested function-like macros", ["macros.h"], cdef=True, generate=generate_heavy_macros),
+	Workload("large_enum", "Synthetic enum with 20000 constants", ["enum.h"], cdef=True, generate=generate_large_enum),
+]
+
+def _reset_caches():
+	"""Clear the caches that are shared between preprocessors, so that every run starts cold (except for the file contents)."""
+	
+	expression.evaluate.cache_clear()
+	cffi_patches._ast_cache.clear()
+	cffi_patches._ast_cache_size = 0
+
+def run_workload(workload, repeat):
+	"""Run a workload and return its results as a dict."""
+	
+	directory = tempfile.mkdtemp(prefix="cffipp_bench_")
+	try:
+		if workload.generate is not None:
+			workload.generate(directory)
+		
+		best = None
+		for _ in range(repeat):
+			_reset_caches()
+			timer = PhaseTimer()
+			with instrumented(timer):
+				start = time.perf_counter()
+				lines, characters = workload.run(directory)
+				wall = time.perf_counter() - start
+			
+			if best is None or wall < best[0]:
+				best = (wall, timer, lines, characters)
+		
+		_reset_caches()
+		tracemalloc.start()
+		try:
+			workload.run(directory)
+			peak_memory = tracemalloc.get_traced_memory()[1]
+		finally:
+			tracemalloc.stop()
+	finally:
+		shutil.rmtree(directory)
+	
+	wall, timer, lines, characters = best
+	phases = dict(timer.times)
+	phases["other"] = max(0.0, wall - sum(phases.values()))
+	return {
+		"description": workload.description,
+		"cdef": workload.cdef,
+		"wall_seconds": wall,
+		"phase_seconds": phases,
+		"tokens": timer.tokens,
+		"bytes": timer.bytes,
+		"tokens_per_second": timer.tokens / wall,
+		"bytes_per_second": timer.bytes / wall,
+		"output_lines": lines,
+		"output_characters": characters,
+		"peak_memory_bytes": peak_memory,
+	}
+
+def print_results(results, file=sys.stdout):
+	columns = PHASES + ["other"]
+	print("{:<18} {:>8} {:>10} {:>10} {:>9}  {}".format("workload", "wall", "tokens/s", "bytes/s", "peak MB", "  ".join("{:>10}".format(phase) for phase in columns)), file=file)
+	for name, result in results.items():
+		print("{:<18} {:>7.3f}s {:>10.0f} {:>10.0f} {:>9.1f}  {}".format(
+			name,
+			result["wall_seconds"],
+			result["tokens_per_second"],
+			result["bytes_per_second"],
+			result["peak_memory_bytes"] / 1e6,
+			"  ".join("{:>9.3f}s".format(result["phase_seconds"][phase]) for phase in columns),
+		), file=file)
+
+def run(argv=None):
+	parser = argparse.ArgumentParser(description="Benchmark cffipp on real and synthetic headers.")
+	parser.add_argument("workloads", nargs="*", metavar="WORKLOAD", help="the workloads to run (default: all): {}".format(", ".join(workload.name for workload in WORKLOADS)))
+	parser.add_argument("--repeat", type=int, default=3, help="number of timed runs per workload (default: 3)")
+	parser.add_argument("--json", metavar="FILE", help='write the results as JSON to FILE ("-" for standard output)')
+	args = parser.parse_args(argv)
+	
+	workloads = {workload.name: workload for workload in WORKLOADS}
+	for name in args.workloads:
+		if name not in workloads:
+			parser.error("unknown workload {!r}".format(name))
+	
+	results = {}
+	for name in args.workloads or workloads:
+		results[name] = run_workload(workloads[name], args.repeat)
+	
+	report = {
+		"python": platform.python_version(),
+		"platform": platform.platform(),
+		"cffi": cffi.__version__,
+		"pycparser": pycparser.__version__,
+		"repeat": args.repeat,
+		"workloads": results,
+	}
+	
+	if args.json == "-":
+		json.dump(report, sys.stdout, indent=2)
+		print()
+	else:
+		print_results(results)
+		if args.json is not None:
+			with open(args.json, "w", encoding="utf-8") as f:
+				json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+	run()
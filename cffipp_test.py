@@ -1,7 +1,451 @@
+import collections
+import os
+import warnings
+
+import cffi
+import pytest
+
 import cffipp
+from cffipp import cffi_patches
+from cffipp import index
+from cffipp import lexer
+from cffipp import preprocessor
+
+INCLUDE_DIR = os.path.join(os.path.dirname(os.path.abspath(cffipp.__file__)), "include")
+# The bundled headers that don't need the iOS SDK. sys/cdefs.h, which is included at startup, is written by make_preprocessor.
+BUNDLED_INCLUDE_PATH = [os.path.join(INCLUDE_DIR, name) for name in ("builtin", "override", "clang")]
+
+def write_headers(directory, headers):
+	for name, text in headers.items():
+		path = os.path.join(str(directory), name)
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		with open(path, "w", encoding="utf-8") as f:
+			f.write(text)
+
+def make_preprocessor(directory, headers={}, **kwargs):
+	"""Return a CFFIPreprocessor whose include path is the directory, containing the given headers (a dict mapping names to texts), followed by the bundled headers."""
+	
+	write_headers(directory, dict({"sys/cdefs.h": "#define __BEGIN_DECLS\n#define __END_DECLS\n"}, **headers))
+	with warnings.catch_warnings():
+		warnings.simplefilter("ignore")
+		return cffipp.CFFIPreprocessor(include_path=[str(directory)] + BUNDLED_INCLUDE_PATH, **kwargs)
+
+def preprocess(text, compile_macros=False, pp=None):
+	"""Preprocess the text and return the values of the output tokens, without whitespace. If pp is given, this Preprocessor is used instead of a new one."""
+	
+	if pp is None:
+		pp = preprocessor.Preprocessor(lexer.build(), compile_macros=compile_macros)
+	pp.parse(text, "<test>")
+	values = []
+	while True:
+		tok = pp.token()
+		if tok is None:
+			return values
+		elif tok.type not in pp.t_WS:
+			values.append(tok.value)
+
+def assert_expands(text, expected):
+	pp = preprocessor.Preprocessor(lexer.build())
+	expected = [tok.value for tok in pp.tokenize(expected) if tok.type not in pp.t_WS]
+	for compile_macros in (False, True):
+		assert preprocess(text, compile_macros) == expected
+
+def test_expand_standard_examples():
+	# The examples in C11 6.10.3.5, except that m(f) is on a single line. Macro calls that span lines are not supported.
+	assert_expands("""
+#define x 3
+#define f(a) f(x * (a))
+#undef x
+#define x 2
+#define g f
+#define z z[0]
+#define h g(~
+#define m(a) a(w)
+#define w 0,1
+#define t(a) a
+#define p() int
+#define q(x) x
+#define r(x,y) x ## y
+#define str(x) # x
+f(y+1) + f(f(z)) % t(t(g)(0) + t)(1);
+g(x+(3,4)-w) | h 5) & m(f)^m(m);
+p() i[q()] = { q(1), r(2,3), r(4,), r(,5), r(,) };
+char c[2][6] = { str(hello), str() };
+""", """
+f(2 * (y+1)) + f(2 * (f(2 * (z[0])))) % f(2 * (0)) + t(1);
+f(2 * (2+(3,4)-0,1)) | f(2 * (~ 5)) & f(2 * (0,1))^m(0,1);
+int i[] = { 1, 23, 4, 5, };
+char c[2][6] = { "hello", "" };
+""")
+	
+	assert_expands("""
+#define showlist(...) puts(#__VA_ARGS__)
+#define report(test, ...) ((test)?puts(#test): printf(__VA_ARGS__))
+showlist(The first, second, and third items.);
+report(x>y, "x is %d but y is %d", x, y);
+""", """
+puts("The first, second, and third items.");
+((x>y)?puts("x>y"): printf("x is %d but y is %d", x, y));
+""")
+
+def test_expand_rescan():
+	# f(2)(9) is 2*9*g in C11 6.10.3.4, because the g at the end of the first expansion is followed by (9).
+	assert_expands("#define f(a) a*g\n#define g(a) f(a)\nf(2)(9);\n", "2*9*g;")
+	# The inner ID is not followed by ( in the argument, and is not expanded again when it is rescanned with (5), because that happens within the expansion of ID.
+	assert_expands("#define ID(x) x\nID(ID)(5);\n", "ID(5);")
+	# A macro that expands to its own name is not expanded again.
+	assert_expands("#define foo foo + bar\n#define bar foo\nfoo;\n", "foo + foo;")
+
+def test_expand_variadic_paste():
+	# , ## __VA_ARGS__ removes the comma if there are no variadic arguments.
+	assert_expands("""
+#define log(fmt, ...) printf(fmt, ## __VA_ARGS__)
+#define cat(a, b) a ## b
+log("a");
+log("b", 1, cat(x, 2));
+cat(c, at)(1, 2);
+""", """
+printf("a");
+printf("b", 1, x2);
+cat(1, 2);
+""")
+
+def test_expansion_cache_invalidated():
+	text = """
+#define B 1
+#define A B + C
+A;
+#undef B
+#define B 2
+A;
+#undef B
+A;
+#define C 3
+A;
+#define B (C + 1)
+A;
+#if A == 7
+redefined_in_if
+#endif
+"""
+	expected = ["1", "+", "C", ";", "2", "+", "C", ";", "B", "+", "C", ";", "B", "+", "3", ";", "(", "3", "+", "1", ")", "+", "3", ";", "redefined_in_if"]
+	for compile_macros in (False, True):
+		pp = preprocessor.Preprocessor(lexer.build(), compile_macros=compile_macros)
+		assert preprocess(text, pp=pp) == expected
+		# The last expansion of A is cached, so the ones before it were too.
+		assert "A" in pp.expansion_cache
+
+def test_if_semantics():
+	assert preprocess("""
+#if -1 > 0u
+unsigned_comparison
+#endif
+#if (0 ? 1u : -1) > 0
+unsigned_conditional
+#endif
+#if ~0u == 0xffffffffffffffff && (0u - 1) >> 63 == 1
+unsigned_arithmetic
+#endif
+#if -1 < 0 && 7 / -2 == -3 && -7 % 2 == -1
+signed_arithmetic
+#endif
+#if (1 ? 2 : 1/0) == 2
+conditional
+#endif
+#if 0 && 1/0
+#elif 1 || 1/0
+short_circuit
+#endif
+#if UNDEFINED == 0 && !defined UNDEFINED && 'A' == 65
+identifiers_and_characters
+#endif
+""") == ["unsigned_comparison", "unsigned_conditional", "unsigned_arithmetic", "signed_arithmetic", "conditional", "short_circuit", "identifiers_and_characters"]
+	
+	try:
+		preprocess("#if 1 && 1/0\n#endif\n")
+	except preprocessor.PreprocessorError as e:
+		assert "Division by zero" in str(e)
+	else:
+		assert False, "division by zero was not reported"
+
+def test_cache_and_pch_invalidated(tmp_path):
+	for option in ("cache_dir", "pch_dir"):
+		first = tmp_path / option / "first"
+		second = tmp_path / option / "second"
+		kwargs = {option: str(tmp_path / option / "cache")}
+		write_headers(second, {"edited.h": "#include <other.h>\n", "other.h": "struct edited { int a; };\n"})
+		sizes = []
+		for edit in (
+			{},
+			{second: {"other.h": "struct edited { int a[2]; };\n"}},
+			# A header that shadows the one later on the include path.
+			{first: {"other.h": "struct edited { int a[3]; };\n"}},
+		):
+			for directory, headers in edit.items():
+				write_headers(directory, headers)
+			pp = make_preprocessor(first, **kwargs)
+			pp.pp.add_path(str(second))
+			pp.cdef_include("edited.h")
+			sizes.append(pp.ffi.sizeof("struct edited"))
+		
+		assert sizes == [4, 8, 12]
+
+def test_snapshot(tmp_path):
+	snapshot = str(tmp_path / "snapshot.pickle")
+	pp = make_preprocessor(tmp_path / "include", {"saved.h": "#define SAVED 2\nstruct saved { int a[SAVED]; };\n"}, snapshot=snapshot)
+	pp.cdef_include("saved.h")
+	pp.save_snapshot(snapshot)
+	
+	# The snapshot is restored when the next CFFIPreprocessor is created, including the state added after initialization.
+	pp = make_preprocessor(tmp_path / "include", snapshot=snapshot)
+	assert pp.ffi.sizeof("struct saved") == 8
+	assert "SAVED" in pp.pp.macros
+	assert "saved.h" in pp.pp.included_files
+	
+	pp = make_preprocessor(tmp_path / "include")
+	assert pp.load_snapshot(snapshot)
+	
+	pp = make_preprocessor(tmp_path / "include")
+	pp.abi = "arm32"
+	assert not pp.load_snapshot(snapshot)
+	
+	pp = make_preprocessor(tmp_path / "include")
+	pp.pp.add_path(str(tmp_path / "other"))
+	assert not pp.load_snapshot(snapshot)
+	
+	# A file that was read before the snapshot was saved has changed.
+	write_headers(tmp_path / "include", {"saved.h": "struct saved { int a; };\n"})
+	pp = make_preprocessor(tmp_path / "include")
+	assert not pp.load_snapshot(snapshot)
+	assert "struct saved" not in pp.ffi._parser._declarations
+
+def test_scan_header_names():
+	symbols = index.scan_header("""
+enum { CF_FOO_A, CF_FOO_B, QOS_CLASS_USER = 0x21 };
+typedef unsigned int UINT_32;
+extern int SOME_GLOBAL_NAME;
+extern char path[MAX_PATH_LEN];
+extern const CFStringRef kFoo API_AVAILABLE(macos(10.0));
+unsigned char *CC_SHA256(const void *data, CC_LONG len, unsigned char *md) API_AVAILABLE(macos(10.4));
+CF_EXPORT API_AVAILABLE(macos(10.0)) CFTypeRef CFFoo(void) CF_SWIFT_NAME(foo());
+struct __attribute__((packed)) s { int a; };
+""")
+	assert symbols["constant"] == {"CF_FOO_A", "CF_FOO_B", "QOS_CLASS_USER"}
+	assert symbols["typedef"] == {"UINT_32"}
+	assert symbols["variable"] == {"SOME_GLOBAL_NAME", "path", "kFoo"}
+	assert symbols["function"] == {"CC_SHA256", "CFFoo"}
+	assert symbols["struct"] == {"s"}
+
+def test_keep_with_constant_array_size(tmp_path):
+	pp = make_preprocessor(tmp_path, {
+		"keep.h": "enum { kA = 1, BUF_LEN = 4 };\nstruct s { int arr[BUF_LEN]; };\nvoid unused(void);\n",
+	})
+	pp.cdef_include("keep.h", keep=["struct s"])
+	assert pp.ffi.sizeof("struct s") == 16
+
+def test_keep_takes_deferred_when_cached(tmp_path):
+	for option in ("cache_dir", "pch_dir"):
+		kwargs = {option: str(tmp_path / option)}
+		states = []
+		for run in range(2):
+			pp = make_preprocessor(tmp_path / "include", {"h.h": "void f(struct B b);\n"}, **kwargs)
+			pp.cdef("struct A { int a; }; struct B { int b[2]; };", keep={"struct A"})
+			pp.cdef_include("h.h", keep={"f"})
+			# The second run is a cache hit, which has to take struct B out of the pool just like the first run did.
+			states.append((pp._deferred.pending(), sorted(pp.ffi._parser._declarations)))
+			assert pp.ffi.sizeof("struct B") == 8
+		
+		assert states[0][0] == []
+		assert states[1] == states[0]
+		
+		# A different pool doesn't reuse the entry.
+		pp = make_preprocessor(tmp_path / "include", **kwargs)
+		pp.cdef("struct A { int a; }; struct B { int b[3]; };", keep={"struct A"})
+		pp.cdef_include("h.h", keep={"f"})
+		assert pp.ffi.sizeof("struct B") == 12
+
+def test_stream_size(tmp_path):
+	headers = {"stream.h": """
+#define COUNT 3
+typedef unsigned int u32;
+typedef struct { u32 a; } anon_t;
+enum color { RED, GREEN = COUNT, BLUE };
+struct node { struct node *next; u32 values[COUNT]; anon_t anon; };
+typedef int (*callback)(struct node *, enum color);
+union value { int i; double d; };
+void walk(struct node *, callback);
+extern u32 counter;
+"""}
+	results = []
+	for stream_size in (None, 16):
+		pp = make_preprocessor(tmp_path, headers, stream_size=stream_size)
+		chunks = []
+		pp._cdef_log = chunks
+		pp.cdef_include("stream.h")
+		
+		# The types of different FFIs can't be compared directly.
+		declarations = {}
+		for name, (tp, quals) in pp.ffi._parser._declarations.items():
+			fields = None
+			if getattr(tp, "fldnames", None) is not None:
+				fields = list(zip(tp.fldnames, [fldtype._get_c_name() for fldtype in tp.fldtypes]))
+			declarations[name] = (tp._get_c_name(), quals, fields, getattr(tp, "enumerators", None), getattr(tp, "enumvalues", None))
+		results.append((declarations, pp.ffi._parser._int_constants))
+		assert (len(chunks) > 1) == (stream_size is not None)
+	
+	assert results[1] == results[0]
+	assert results[0][1] == {"RED": 0, "GREEN": 3, "BLUE": 4}
+
+def test_include_many_matches_sequential(tmp_path):
+	headers = {
+		"redefine.h": "#undef SIZE\n#define SIZE 9\n",
+		# Uses SIZE only through COUNT.
+		"indirect.h": "struct indirect { int a[COUNT]; };\n",
+		"base.h": "#ifndef BASE_H\n#define BASE_H\ntypedef int base_t;\n#endif\n",
+		"first.h": "#include \"base.h\"\nstruct first { base_t a; };\n",
+		"second.h": "#include \"base.h\"\nstruct second { base_t a[2]; };\n",
+	}
+	sizes = []
+	for workers in (1, 2):
+		pp = make_preprocessor(tmp_path / str(workers), headers)
+		pp.cdef("#define SIZE 1\n#define COUNT SIZE\n")
+		pp.cdef_include_many(["redefine.h", "indirect.h", "first.h", "second.h"], workers=workers)
+		sizes.append([pp.ffi.sizeof(name) for name in ("struct indirect", "struct first", "struct second")])
+	
+	assert sizes[0] == [36, 4, 8]
+	assert sizes[1] == sizes[0]
+
+def test_pch_reused(tmp_path):
+	headers = {
+		"a/b_c.h": "struct first { int a; };\n",
+		"a_b/c.h": "struct second { int a[2]; };\n",
+	}
+	pch_files = []
+	for run in range(2):
+		pp = make_preprocessor(tmp_path / "include", headers, pch_dir=str(tmp_path / "pch"))
+		if run == 0:
+			pp.cdef_include("a/b_c.h")
+			pp.cdef_include("a_b/c.h")
+		else:
+			# cdef_include_many uses the same PCHs as cdef_include.
+			pp.cdef_include_many(["a/b_c.h", "a_b/c.h"], workers=2)
+		assert pp.ffi.sizeof("struct first") == 4
+		assert pp.ffi.sizeof("struct second") == 8
+		assert len(pp._pch_files) == 4
+		# The second run loads the PCHs instead of building them again.
+		pch_files.append({entry.name: entry.stat().st_mtime_ns for entry in os.scandir(str(tmp_path / "pch"))})
+	
+	# builtin_arm.h, builtin_arm64.h and the two headers.
+	assert len(pch_files[0]) == 4
+	assert pch_files[1] == pch_files[0]
+
+def test_integer_macros(tmp_path):
+	pp = make_preprocessor(tmp_path)
+	pp.cdef("""
+enum { DECLARED = 7 };
+#define DECLARED 7
+#define NEGATIVE -1
+#define WRAPAROUND (0u - 1)
+#define FLAGS (1 << 3) | 0x5
+#define BASE 4
+#define DERIVED (BASE * 2 + 1)
+#define CHARACTER 'a'
+#define FLOATING 1.5
+#define IDENTIFIER some_name
+#define STRING "s"
+#define DIVISION_BY_ZERO (1 / 0)
+#define FUNCTION(x) x
+""")
+	integers = {"DECLARED": 7, "NEGATIVE": -1, "WRAPAROUND": 2**64 - 1, "FLAGS": 13, "BASE": 4, "DERIVED": 9}
+	names = ["DECLARED", "NEGATIVE", "WRAPAROUND", "FLAGS", "BASE", "DERIVED", "CHARACTER", "FLOATING", "IDENTIFIER", "STRING", "DIVISION_BY_ZERO", "FUNCTION", "UNDEFINED"]
+	assert pp.integer_macros(names) == integers
+	assert {name: value for name, value in pp.integer_macros().items() if name in names} == integers
+	
+	# DECLARED is already a constant of the FFI.
+	declared = pp.cdef_integer_macros(names)
+	assert declared == {name: value for name, value in integers.items() if name != "DECLARED"}
+	lib = pp.ffi.dlopen(None)
+	assert [getattr(lib, name) for name in sorted(integers)] == [value for name, value in sorted(integers.items())]
+	assert pp.cdef_integer_macros(names) == {}
+
+def test_find_file_after_invalidate(tmp_path):
+	pp = preprocessor.Preprocessor(lexer.build())
+	assert pp.find_file("new.h", [str(tmp_path)]) is None
+	
+	write_headers(tmp_path, {"new.h": ""})
+	# The directory listing is cached until it is invalidated.
+	assert pp.find_file("new.h", [str(tmp_path)]) is None
+	pp.invalidate_dir_index([str(tmp_path)])
+	assert pp.find_file("new.h", [str(tmp_path)]) == os.path.join(str(tmp_path), "new.h")
+
+def test_reload_finds_new_header(tmp_path):
+	pp = make_preprocessor(tmp_path / "first", {}, watch=True)
+	pp.pp.add_path(str(tmp_path / "second"))
+	write_headers(tmp_path / "second", {
+		"watched.h": "#include <shadowed.h>\n",
+		"shadowed.h": "struct shadowed { int a; };\n",
+	})
+	pp.cdef_include("watched.h")
+	assert pp.ffi.sizeof("struct shadowed") == 4
+	
+	write_headers(tmp_path / "first", {"shadowed.h": "struct shadowed { int a[3]; };\n"})
+	assert pp.changed_includes() == ["watched.h"]
+	assert pp.reload() == ["watched.h"]
+	assert pp.ffi.sizeof("struct shadowed") == 12
+	assert pp.changed_includes() == []
+
+@pytest.fixture
+def parsed(monkeypatch):
+	"""An empty in-memory AST cache, and a list of the sources that are parsed by pycparser (rather than taken from a cache)."""
+	
+	monkeypatch.setattr(cffi_patches, "_ast_cache", collections.OrderedDict())
+	monkeypatch.setattr(cffi_patches, "_ast_cache_size", 0)
+	sources = []
+	parse_uncached = cffi_patches.BetterParser._parse_uncached
+	monkeypatch.setattr(cffi_patches.BetterParser, "_parse_uncached", lambda self, csource: sources.append(csource) or parse_uncached(self, csource))
+	return sources
+
+def test_ast_cache(tmp_path, monkeypatch, parsed):
+	source = "struct cached { int a[3]; };"
+	for ast_cache_dir, clear_memory, parse_count in (
+		(None, False, 1),
+		# A hit in memory.
+		(None, False, 1),
+		# Stored on disk.
+		(str(tmp_path), True, 2),
+		# A hit on disk.
+		(str(tmp_path), True, 2),
+	):
+		if clear_memory:
+			monkeypatch.setattr(cffi_patches, "_ast_cache", collections.OrderedDict())
+		ffi = cffi_patches.FFIWithBetterParser()
+		ffi._parser.ast_cache_dir = ast_cache_dir
+		ffi.cdef(source)
+		assert ffi.sizeof("struct cached") == 12
+		assert parsed.count(source) == parse_count
+		
+		# A hit must not hide that the struct is declared twice.
+		with pytest.raises(cffi.CDefError, match="duplicate declaration of struct cached"):
+			ffi.cdef(source)
+
+def test_ast_cache_typedef_names(parsed):
+	types = []
+	for typedef in ("typedef int T;", "typedef long T;"):
+		ffi = cffi_patches.FFIWithBetterParser()
+		ffi.cdef(typedef)
+		ffi.cdef("int f(T);")
+		types.append(ffi._parser._declarations["function f"][0].args[0].name)
+	
+	# The AST only depends on T being a typedef name, not on its type.
+	assert types == ["int", "long"]
+	assert parsed.count("int f(T);") == 1
+	
+	ffi = cffi_patches.FFIWithBetterParser()
+	with pytest.raises(cffi.CDefError, match="unknown type 'T'"):
+		ffi.cdef("int f(T);")
+	assert parsed.count("int f(T);") == 2
 
 if __name__ == "__main__":
 	pp = cffipp.CFFIPreprocessor()
 	pp.cdef_include("objc/objc.h")
 	pp.cdef_include("CoreFoundation/CoreFoundation.h", once=True)
-